@@ -0,0 +1,96 @@
+"""
+Checkpoints for resuming interrupted dumps.
+
+Before dumpchunks writes any chunk file it saves its plan, the models and key
+ranges that go into every numbered file, as the first line of
+``<filespec>.checkpoint`` next to the chunk directory. The manifest entries of
+each chunk's files are appended as another line once the chunk is complete. If the dump
+dies, ``dumpchunks --resume`` reads the plan back instead of planning again,
+so the remaining files get exactly the rows they would have had, and only
+writes the chunks that have no entry yet. The checkpoint is removed once the
+manifest has been written.
+
+Lines are JSON documents and are flushed to disk as they are written; a line
+cut short by a crash is ignored.
+"""
+import os
+
+from django.db.models import get_model
+from django.utils import simplejson
+from django.utils.encoding import smart_unicode
+
+from chunkdata.manifest import manifest_value
+
+CHECKPOINT_EXTENSION = 'checkpoint'
+
+def checkpoint_path(directory, name):
+    return os.path.join(directory, '%s.%s' % (name, CHECKPOINT_EXTENSION))
+
+def start_checkpoint(path, header):
+    f = open(path, 'wb')
+    try:
+        _write_line(f, header)
+    finally:
+        f.close()
+
+def record_checkpoint(path, entry):
+    f = open(path, 'ab')
+    try:
+        _write_line(f, entry)
+    finally:
+        f.close()
+
+def read_checkpoint(path):
+    """Return the header of a checkpoint and the entries recorded after it.
+
+    The header is None if the dump stopped before it was written in full.
+    """
+    f = open(path, 'rb')
+    try:
+        lines = f.read().split('\n')
+    finally:
+        f.close()
+    records = []
+    for line in lines:
+        if not line:
+            continue
+        try:
+            records.append(simplejson.loads(line))
+        except ValueError:
+            # The last line was being written when the dump stopped.
+            break
+    if not records:
+        return None, []
+    return records[0], records[1:]
+
+def _write_line(f, data):
+    f.write(simplejson.dumps(data, sort_keys=True))
+    f.write('\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+def encode_plan(plan):
+    """Turn a dump plan into data that can be saved as JSON.
+
+    Key values are stored as manifest values, which lookups accept back.
+    """
+    return [[[[smart_unicode(model._meta), encode_bounds(bounds)] for model, bounds in parts], count]
+            for parts, count in plan]
+
+def decode_plan(data):
+    return [([(get_model(*label.split('.')), decode_bounds(bounds)) for label, bounds in parts], count)
+            for parts, count in data]
+
+def encode_bounds(bounds):
+    if bounds is None:
+        return None
+    if isinstance(bounds, slice):
+        return {'start': bounds.start, 'stop': bounds.stop}
+    return [[manifest_value(value) for value in key] if key is not None else None for key in bounds]
+
+def decode_bounds(data):
+    if data is None:
+        return None
+    if isinstance(data, dict):
+        return slice(data['start'], data['stop'])
+    return tuple(tuple(key) if key is not None else None for key in data)
@@ -0,0 +1,185 @@
+"""
+A compact binary, column-wise encoding of fixture objects.
+
+The columnar format (see chunkdata.serializers.columnar) stores the objects
+the json format would write, but instead of repeating every field name for
+every object it stores runs of up to BLOCK_ROWS objects of one model a
+column at a time. A file is MAGIC followed by blocks; each block is
+
+    header length, header  - JSON: {"model": label, "rows": n,
+                             "columns": [[name, type], ...]}, the primary
+                             key first and then the fields
+    for each column:
+        nulls length, nulls - a byte per row, 1 where the value is null;
+                              empty if none are
+        data length, data   - the column's non-null values
+
+with lengths as little-endian unsigned 32 bit integers. Column types are
+'q' (64 bit integers), 'd' (doubles) and 'b' (booleans, a byte each), packed
+with struct, 't' (text) and 'j' (JSON, for anything else: dates, decimals,
+natural keys, many-to-many lists), stored as the length of each value in
+bytes followed by all of them as UTF-8. Lengths are counted in bytes since
+narrow and wide Python builds count characters outside the BMP differently.
+Each column is decoded in one pass, with one struct.unpack and, unless it
+holds non-ASCII text, one UTF-8 decode.
+"""
+import struct
+from itertools import izip
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
+
+MAGIC = 'CHUNKCOL\x02'
+
+BLOCK_ROWS = 4096
+
+LENGTH = struct.Struct('<I')
+
+INT64_RANGE = (-(1 << 63), (1 << 63) - 1)
+
+PACKED_TYPES = {'q': 'q', 'd': 'd', 'b': 'B'}
+
+def column_type(values):
+    """Return the type code for a column's non-null values."""
+    kinds = set([type(value) for value in values])
+    if kinds <= set([bool]):
+        return 'b'
+    if kinds <= set([int, long]) and (not values or INT64_RANGE[0] <= min(values) and max(values) <= INT64_RANGE[1]):
+        return 'q'
+    if kinds <= set([float]):
+        return 'd'
+    if kinds <= set([unicode, str]):
+        return 't'
+    return 'j'
+
+def encode_column(values):
+    """Return (type, nulls, data) for a column's values."""
+    present = [value for value in values if value is not None]
+    if len(present) < len(values):
+        nulls = ''.join([value is None and '\x01' or '\x00' for value in values])
+    else:
+        nulls = ''
+    kind = column_type(present)
+    if kind in PACKED_TYPES:
+        data = struct.pack('<%d%s' % (len(present), PACKED_TYPES[kind]), *present)
+    else:
+        if kind == 'j':
+            encoder = DjangoJSONEncoder()
+            present = [encoder.encode(value) for value in present]
+        else:
+            present = [unicode(value) for value in present]
+        present = [value.encode('utf-8') for value in present]
+        data = struct.pack('<%dI' % len(present), *[len(value) for value in present]) + ''.join(present)
+    return kind, nulls, data
+
+def decode_column(kind, rows, nulls, data):
+    """Return the list of a column's rows values from what encode_column gave."""
+    count = rows - nulls.count('\x01')
+    if kind in PACKED_TYPES:
+        values = struct.unpack('<%d%s' % (count, PACKED_TYPES[kind]), data)
+        if kind == 'b':
+            values = [bool(value) for value in values]
+    else:
+        lengths = struct.unpack('<%dI' % count, data[:4 * count])
+        blob = data[4 * count:]
+        text = blob.decode('utf-8')
+        values = []
+        start = 0
+        if len(text) == len(blob):
+            # All ASCII, so byte lengths are character lengths too.
+            for length in lengths:
+                values.append(text[start:start + length])
+                start += length
+        else:
+            for length in lengths:
+                values.append(blob[start:start + length].decode('utf-8'))
+                start += length
+        if kind == 'j':
+            values = [simplejson.loads(value) for value in values]
+    if not nulls:
+        return list(values)
+    values = iter(values)
+    return [values.next() if null == '\x00' else None for null in nulls]
+
+class BlockWriter(object):
+    """Writes objects, as dicts like the python serializer's, to stream a block at a time."""
+
+    def __init__(self, stream, block_rows=BLOCK_ROWS):
+        self.stream = stream
+        self.block_rows = block_rows
+        self.objects = []
+        self.model = None
+        stream.write(MAGIC)
+
+    def write(self, obj):
+        if self.objects and (obj['model'] != self.model or len(self.objects) >= self.block_rows):
+            self.flush()
+        self.model = obj['model']
+        self.objects.append(obj)
+
+    def flush(self):
+        objects, self.objects = self.objects, []
+        if not objects:
+            return
+        names = []
+        for obj in objects:
+            for name in obj['fields']:
+                if name not in names:
+                    names.append(name)
+        columns = [[obj['pk'] for obj in objects]]
+        columns.extend([[obj['fields'].get(name) for obj in objects] for name in names])
+        encoded = [encode_column(values) for values in columns]
+        header = simplejson.dumps({
+            'model': self.model,
+            'rows': len(objects),
+            'columns': [[name, kind] for name, (kind, nulls, data) in zip(['pk'] + names, encoded)],
+        })
+        parts = [LENGTH.pack(len(header)), header]
+        for kind, nulls, data in encoded:
+            parts.extend([LENGTH.pack(len(nulls)), nulls, LENGTH.pack(len(data)), data])
+        self.stream.write(''.join(parts))
+
+    def close(self):
+        self.flush()
+
+def write_objects(objects, stream, block_rows=BLOCK_ROWS):
+    writer = BlockWriter(stream, block_rows)
+    for obj in objects:
+        writer.write(obj)
+    writer.close()
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise ValueError("Truncated columnar fixture")
+        data += more
+    return data
+
+def read_blocks(stream, decode=True):
+    """Yield (header, columns) for each block of a columnar stream; columns is None unless decode."""
+    if read_exactly(stream, len(MAGIC)) != MAGIC:
+        raise ValueError("Not a columnar fixture")
+    while True:
+        length = stream.read(LENGTH.size)
+        if not length:
+            return
+        if len(length) < LENGTH.size:
+            length += read_exactly(stream, LENGTH.size - len(length))
+        header = simplejson.loads(read_exactly(stream, LENGTH.unpack(length)[0]))
+        columns = []
+        for name, kind in header['columns']:
+            nulls = read_exactly(stream, LENGTH.unpack(read_exactly(stream, LENGTH.size))[0])
+            data = read_exactly(stream, LENGTH.unpack(read_exactly(stream, LENGTH.size))[0])
+            if decode:
+                columns.append(decode_column(kind, header['rows'], nulls, data))
+        yield header, decode and columns or None
+
+def read_objects(stream):
+    """Yield the objects of a columnar stream as dicts like the python serializer's, a block at a time."""
+    for header, columns in read_blocks(stream):
+        model = header['model']
+        names = [name for name, kind in header['columns'][1:]]
+        for values in izip(*columns):
+            yield {'model': model, 'pk': values[0], 'fields': dict(izip(names, values[1:]))}
@@ -0,0 +1,80 @@
+"""
+Streaming compression of chunk files.
+
+Chunk files are compressed as they are written, a block at a time, so the
+serialized text is never held in memory uncompressed, and they are read back
+through the matching decompressing file object. Compressed chunks are named
+after their uncompressed name with the compression's extension appended,
+e.g. ``foo.000001.json.gz``.
+"""
+import gzip
+import zlib
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# compression name: (file extension, compressor factory, reader class)
+COMPRESSION_TYPES = {
+    'gzip': ('gz', lambda: zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+             gzip.GzipFile),
+}
+if bz2 is not None:
+    COMPRESSION_TYPES['bz2'] = ('bz2', bz2.BZ2Compressor, bz2.BZ2File)
+if lzma is not None:
+    COMPRESSION_TYPES['xz'] = ('xz', lzma.LZMACompressor, lzma.LZMAFile)
+
+COMPRESSION_EXTENSIONS = dict((ext, name) for name, (ext, compressor, reader) in COMPRESSION_TYPES.items())
+
+class CompressedFile(object):
+    """Write-only file object that compresses everything written to it into fileobj."""
+
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self.compressor = compressor
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+        self.fileobj.close()
+
+def compressed_name(filename, compression):
+    if compression:
+        return '%s.%s' % (filename, COMPRESSION_TYPES[compression][0])
+    return filename
+
+def split_compression(filename):
+    """Split a file name into its uncompressed name and compression (None if uncompressed)."""
+    base, ext = filename.rsplit('.', 1) if '.' in filename else (filename, '')
+    if ext in COMPRESSION_EXTENSIONS:
+        return base, COMPRESSION_EXTENSIONS[ext]
+    return filename, None
+
+def compress(fileobj, compression=None):
+    """Wrap a writable file object so that what is written to it is compressed."""
+    if compression:
+        return CompressedFile(fileobj, COMPRESSION_TYPES[compression][1]())
+    return fileobj
+
+def open_for_reading(path):
+    """Open a chunk file, decompressing it as it is read if its name says it is compressed."""
+    compression = split_compression(path)[1]
+    if compression:
+        return COMPRESSION_TYPES[compression][2](path, 'rb')
+    return open(path, 'rb')
@@ -0,0 +1,143 @@
+"""
+Constraint checks and secondary indexes during loads.
+
+A restore into an empty database doesn't need the database to check every
+foreign key or update every index as each row goes in. defer_constraints
+postpones foreign key checks (to the end of the transaction on SQLite, until
+restore_constraints on MySQL) and has to be called again after every commit.
+drop_indexes drops the plain db_index indexes of the models being loaded so
+create_indexes can build them again once the rows are in.
+
+Django already creates foreign keys on PostgreSQL as DEFERRABLE INITIALLY
+DEFERRED, so there defer_constraints only affects deferrable constraints
+created some other way as INITIALLY IMMEDIATE.
+"""
+import re
+
+from django.core.management.color import no_style
+
+CREATE_INDEX = re.compile(r'^CREATE INDEX (\S+) ON (\S+)')
+
+def backend(connection):
+    """Return 'postgresql', 'mysql', 'sqlite' or None for the connection's database."""
+    engine = connection.settings_dict['ENGINE'].split('.')[-1]
+    if engine.startswith('postg'):
+        return 'postgresql'
+    if engine.startswith('mysql'):
+        return 'mysql'
+    if engine in ('sqlite3', 'spatialite'):
+        return 'sqlite'
+    return None
+
+DEFER_CONSTRAINTS = {
+    'postgresql': 'SET CONSTRAINTS ALL DEFERRED',
+    'mysql': 'SET FOREIGN_KEY_CHECKS = 0',
+    'sqlite': 'PRAGMA defer_foreign_keys = ON',
+}
+
+RESTORE_CONSTRAINTS = {
+    'mysql': 'SET FOREIGN_KEY_CHECKS = 1',
+}
+
+INDEX_NAMES = {
+    'postgresql': 'SELECT indexname FROM pg_indexes WHERE tablename = %s',
+    'sqlite': "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s",
+}
+
+def defer_constraints(connection):
+    """Postpone foreign key checks; on PostgreSQL and SQLite this lasts until the transaction ends.
+
+    Django's own foreign keys on PostgreSQL are deferred already.
+    """
+    vendor = backend(connection)
+    sql = DEFER_CONSTRAINTS.get(vendor)
+    if vendor == 'sqlite':
+        # The pragma is reset when the transaction it was issued in ends, and
+        # pysqlite commits before anything but DML and only begins a
+        # transaction at the first write, so it is begun here instead.
+        connection.cursor()
+        raw = connection.connection
+        isolation_level = raw.isolation_level
+        raw.isolation_level = None
+        try:
+            raw.execute('BEGIN')
+            raw.execute(sql)
+        finally:
+            raw.isolation_level = isolation_level
+    elif sql:
+        connection.cursor().execute(sql)
+
+def restore_constraints(connection):
+    sql = RESTORE_CONSTRAINTS.get(backend(connection))
+    if sql:
+        connection.cursor().execute(sql)
+
+def index_names(connection, table):
+    """Return the set of names of the indexes on table, or None if the backend can't tell."""
+    vendor = backend(connection)
+    cursor = connection.cursor()
+    if vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % connection.ops.quote_name(table))
+        return set([row[2] for row in cursor.fetchall()])
+    if vendor in INDEX_NAMES:
+        cursor.execute(INDEX_NAMES[vendor], [table])
+        return set([row[0] for row in cursor.fetchall()])
+    return None
+
+def secondary_indexes(connection, models):
+    """Return (name, table, create statement) for the db_index indexes of models and their many-to-many tables.
+
+    MySQL needs the indexes on foreign key columns for its constraints, so
+    those are left out there.
+    """
+    tables = []
+    for model in models:
+        tables.append(model)
+        tables.extend([field.rel.through for field in model._meta.local_many_to_many
+                       if field.rel.through._meta.auto_created])
+    indexes = []
+    seen = set()
+    for model in tables:
+        if model in seen:
+            continue
+        seen.add(model)
+        for field in model._meta.local_fields:
+            if field.rel is not None and backend(connection) == 'mysql':
+                continue
+            for sql in connection.creation.sql_indexes_for_field(model, field, no_style()):
+                match = CREATE_INDEX.match(sql)
+                if match:
+                    name, table = [unquote(part) for part in match.groups()]
+                    indexes.append((name, table, sql.rstrip(';')))
+    return indexes
+
+def unquote(name):
+    return name.strip('"`[]')
+
+def drop_indexes(connection, models):
+    """Drop the secondary indexes of models that exist, returning them for create_indexes."""
+    dropped = []
+    existing = {}
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for name, table, sql in secondary_indexes(connection, models):
+        if table not in existing:
+            existing[table] = index_names(connection, table)
+        if not existing[table] or name not in existing[table]:
+            continue
+        if backend(connection) == 'mysql':
+            cursor.execute('DROP INDEX %s ON %s' % (qn(name), qn(table)))
+        else:
+            cursor.execute('DROP INDEX %s' % qn(name))
+        dropped.append((name, table, sql))
+    return dropped
+
+def create_indexes(connection, indexes):
+    """Create the indexes drop_indexes dropped, skipping any a rollback has already brought back."""
+    existing = {}
+    cursor = connection.cursor()
+    for name, table, sql in indexes:
+        if table not in existing:
+            existing[table] = index_names(connection, table) or set()
+        if name not in existing[table]:
+            cursor.execute(sql)
@@ -0,0 +1,160 @@
+"""
+CSV chunks: a file per table, loaded with the database's own bulk import.
+
+With ``--format csv`` every chunk of a dump is written as one CSV file per
+model, named ``<filespec>.<number>.<app_label>.<model>.csv``, plus one for
+each of the model's many-to-many through tables holding the rows of the
+chunk's objects. A file holds a table's rows as they are stored: a header of
+column names, then the column values, with foreign keys as their raw values.
+Through tables are models of their own, so their files are planned, ordered
+and loaded like any other.
+
+Numbers are written bare and everything else quoted, with quotes doubled, and
+NULL is an unquoted ``\\N``. That is what PostgreSQL's ``COPY ... CSV`` reads
+with ``NULL '\\N'`` and what MySQL's ``LOAD DATA`` can be told to read, so
+import_table hands a file to
+
+    PostgreSQL  COPY ... FROM STDIN, reading the (decompressed) stream
+    MySQL       LOAD DATA LOCAL INFILE, for uncompressed files
+    others      executemany of batch_size rows, in the caller's transaction
+
+Since MySQL and Python's csv module can't tell ``\\N`` from ``"\\N"``, a text
+value of exactly ``\\N`` can't be dumped as CSV.
+"""
+import csv
+import decimal
+import os
+
+from django.db.models import get_model
+from django.utils.encoding import smart_unicode
+
+from chunkdata.compression import split_compression
+from chunkdata.constraints import backend
+from chunkdata.loader import batches, insert_rows
+from chunkdata.prefetch import pk_sources, prefetched_fields
+
+CSV_FORMAT = 'csv'
+
+NULL = '\\N'
+
+NUMBER_TYPES = (int, long, float, decimal.Decimal)
+
+def table_filename(filespec, count, model):
+    return '%s.%06d.%s.%s.%s' % (filespec, count, model._meta.app_label, model._meta.module_name, CSV_FORMAT)
+
+def table_model(path):
+    """Return the model whose table a CSV chunk file holds, from the file's name."""
+    name = os.path.basename(split_compression(path)[0])
+    app_label, module_name = name.split('.')[-3:-1]
+    return get_model(app_label, module_name)
+
+def table_querysets(qs):
+    """Yield (model, querysets) for the rows of qs and then for their rows in each through table."""
+    yield qs.model, [qs]
+    fields = prefetched_fields(qs.model)
+    if not fields:
+        return
+    sources = pk_sources(qs)
+    for field in fields:
+        through = field.rel.through._base_manager.using(qs.db)
+        yield field.rel.through, [through.filter(**{'%s__in' % field.m2m_field_name(): pks}).order_by('pk')
+                                  for pks in sources]
+
+def format_value(value):
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return value and '1' or '0'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, NUMBER_TYPES):
+        return str(value)
+    text = smart_unicode(value)
+    if text == NULL:
+        raise ValueError("Can't write the text value %s to CSV: it reads back as NULL" % NULL)
+    return '"%s"' % text.replace('"', '""').encode('utf-8')
+
+def write_table(stream, model, querysets):
+    """Write the rows of querysets of model to stream as CSV after a header of column names.
+
+    Returns the number of rows and the range of their primary keys.
+    """
+    fields = model._meta.local_fields
+    names = [field.name for field in fields]
+    # An explicit primary key needn't be the first column.
+    pk_index = names.index(model._meta.pk.name)
+    stream.write(','.join([field.column for field in fields]) + '\n')
+    count = 0
+    pk_range = None
+    for qs in querysets:
+        for row in qs.values_list(*names).iterator():
+            stream.write(','.join([format_value(value) for value in row]) + '\n')
+            count += 1
+            pk = row[pk_index]
+            if pk_range is None:
+                pk_range = [pk, pk]
+            elif pk < pk_range[0]:
+                pk_range[0] = pk
+            elif pk > pk_range[1]:
+                pk_range[1] = pk
+    return count, pk_range
+
+def table_columns(model, header):
+    """Return the fields of model for the columns named in a CSV header."""
+    by_column = dict((field.column, field) for field in model._meta.local_fields)
+    fields = []
+    for column in header:
+        if column not in by_column:
+            raise ValueError("Unknown column for %s: %s" % (smart_unicode(model._meta), column))
+        fields.append(by_column[column])
+    return fields
+
+def import_table(connection, model, stream, path=None, batch_size=1000):
+    """Load the CSV rows in stream into model's table and return how many there were.
+
+    path is the file stream reads, which MySQL reads itself when it isn't
+    compressed. Nothing is committed.
+    """
+    header = csv.reader([stream.readline()]).next()
+    fields = table_columns(model, header)
+    table = model._meta.db_table
+    vendor = backend(connection)
+    if vendor == 'postgresql':
+        return copy_rows(connection, table, header, stream)
+    if vendor == 'mysql' and path and not split_compression(path)[1]:
+        return load_data_infile(connection, table, header, path)
+    converters = [column_converter(connection, field) for field in fields]
+    count = 0
+    for rows in batches(csv.reader(iter(stream.readline, '')), batch_size):
+        insert_rows(connection, table, header,
+                    [[convert(value) for convert, value in zip(converters, row)] for row in rows])
+        count += len(rows)
+    return count
+
+def column_converter(connection, field):
+    """Return a function giving the value to insert in field's column for its CSV text."""
+    def convert(value):
+        if value == NULL:
+            return None
+        return field.get_db_prep_save(field.to_python(value.decode('utf-8')), connection=connection)
+    return convert
+
+def copy_rows(connection, table, columns, stream):
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.copy_expert("COPY %s (%s) FROM STDIN WITH NULL AS E'\\\\N' CSV" % (
+        qn(table), ', '.join([qn(column) for column in columns])), stream)
+    return cursor.rowcount
+
+def load_data_infile(connection, table, columns, path):
+    """Load a CSV file with LOAD DATA LOCAL INFILE, which needs local_infile in the database OPTIONS."""
+    qn = connection.ops.quote_name
+    variables = ['@c%d' % i for i in range(len(columns))]
+    cursor = connection.cursor()
+    cursor.execute("LOAD DATA LOCAL INFILE %%s INTO TABLE %s CHARACTER SET utf8 FIELDS TERMINATED BY ',' "
+                   "OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' LINES TERMINATED BY '\\n' IGNORE 1 LINES (%s) SET %s" % (
+                       qn(table), ', '.join(variables),
+                       ', '.join(["%s = NULLIF(%s, '\\\\N')" % (qn(column), variable)
+                                  for column, variable in zip(columns, variables)])),
+                   [os.path.abspath(path)])
+    return cursor.rowcount
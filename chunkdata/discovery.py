@@ -0,0 +1,78 @@
+"""
+Finding fixture files.
+
+loaddata looks for a label in every app's fixtures directory, in
+FIXTURE_DIRS and in the current directory, trying each combination of
+format and compression as a file name, and loadchunks searched the same
+directories for chunk sets before handing labels to it. With many apps,
+labels and chunk files that adds up. A FixtureIndex lists each fixture
+directory once per command and answers every label from those listings, so
+loadchunks can hand loaddata absolute paths it opens without searching.
+"""
+import os
+from itertools import product
+
+# The compressions loaddata recognises in file names.
+LOADDATA_COMPRESSIONS = ('gz', 'zip', 'bz2')
+
+class FixtureIndex(object):
+    """Cached listings of the fixture directories and the directories within them."""
+
+    def __init__(self, fixture_dirs):
+        # loaddata's order, which decides what a label found in several
+        # directories loads.
+        self.fixture_dirs = []
+        for path in fixture_dirs:
+            path = os.path.abspath(path)
+            if path not in self.fixture_dirs:
+                self.fixture_dirs.append(path)
+        self.listings = {}
+        for path in self.fixture_dirs:
+            self.listdir(path)
+
+    def listdir(self, path):
+        """Return the set of names in the directory path, or None if it isn't a directory."""
+        if path not in self.listings:
+            try:
+                self.listings[path] = set(os.listdir(path))
+            except OSError:
+                self.listings[path] = None
+        return self.listings[path]
+
+    def exists(self, path):
+        names = self.listdir(os.path.dirname(path))
+        return names is not None and os.path.basename(path) in names
+
+    def isdir(self, path):
+        return self.exists(path) and self.listdir(path) is not None
+
+    def fixture_files(self, label, formats, using):
+        """Return the absolute paths of the files loaddata would load for label.
+
+        Returns None when loaddata should search for the label itself: when
+        nothing matches, so it reports that, or when one directory has
+        several matches, which it refuses to load.
+        """
+        directory, name = os.path.split(label)
+        parts = name.split('.')
+        if len(parts) > 1 and parts[-1] in LOADDATA_COMPRESSIONS:
+            compressions = [parts[-1]]
+            parts = parts[:-1]
+        else:
+            compressions = [None] + list(LOADDATA_COMPRESSIONS)
+        if len(parts) > 1:
+            if parts[-1] not in formats:
+                return None
+            name, formats = '.'.join(parts[:-1]), [parts[-1]]
+
+        paths = []
+        for fixture_dir in self.fixture_dirs:
+            names = self.listdir(os.path.join(fixture_dir, directory))
+            if not names:
+                continue
+            found = ['.'.join([p for p in combo if p]) for combo in product([name], [using, None], formats, compressions)]
+            found = [file_name for file_name in found if file_name in names]
+            if len(found) > 1:
+                return None
+            paths.extend([os.path.join(fixture_dir, directory, file_name) for file_name in found])
+        return paths or None
@@ -0,0 +1,159 @@
+"""
+Incremental reading of json and jsonl fixtures.
+
+simplejson.load reads a whole fixture and builds every object in it before
+the first can be saved, so loading a chunk takes several times its size in
+memory. JSONArrayReader decodes the objects of the fixture's array one at a
+time as the file is read instead, so memory use depends on how many objects
+the loader holds at once rather than on the size of the file. Django's xml
+deserializer already reads its stream incrementally with pulldom.
+
+JSON Lines fixtures (the jsonl format, see chunkdata.serializers.jsonl) hold
+an object per line, so they can be read a line at a time, and a big file can
+be split at line boundaries and decoded by several processes at once with
+parse_parallel.
+"""
+from collections import deque
+from itertools import islice
+import multiprocessing
+import os
+import re
+
+from django.utils import simplejson
+
+from chunkdata.workers import wait_for, worker_pids
+
+READ_SIZE = 1 << 16
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class JSONArrayReader(object):
+    """Iterates over the items of the JSON array in stream, decoding them one at a time.
+
+    The stream is read read_size bytes at a time, and only the item being
+    decoded and the rest of the block it is in are kept.
+    """
+
+    def __init__(self, stream, read_size=READ_SIZE):
+        self.stream = stream
+        self.read_size = read_size
+        self.decoder = simplejson.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self):
+        if self.next_char() != '[':
+            raise ValueError("Expected a JSON array")
+        self.pos += 1
+        if self.next_char() == ']':
+            self.pos += 1
+        else:
+            while True:
+                if not self.next_char():
+                    raise ValueError("Unexpected end of the JSON array")
+                yield self.decode()
+                char = self.next_char()
+                self.pos += 1
+                if char == ']':
+                    break
+                if char != ',':
+                    raise ValueError("Expected ',' or ']' after an item of the JSON array, found %r" % char)
+        if self.next_char():
+            raise ValueError("Extra data after the JSON array")
+
+    def fill(self, size):
+        """Add the next size bytes of the stream to the buffer, returning False at its end."""
+        if self.eof:
+            return False
+        data = self.stream.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def next_char(self):
+        """Skip whitespace and return the next character, or '' at the end of the stream."""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill(self.read_size):
+                return ''
+
+    def decode(self):
+        size = self.read_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # The item goes on past the buffer, unless the stream has ended.
+                if not self.fill(size):
+                    raise
+                # Reading more each time keeps a huge item from being decoded
+                # over and over.
+                size *= 2
+                continue
+            if end == len(self.buffer) and self.fill(size):
+                # A number could go on in the next block.
+                continue
+            self.pos = end
+            return value
+
+def iter_json_lines(stream):
+    """Yield the object on each line of a JSON Lines stream, skipping blank lines."""
+    for line in iter(stream.readline, ''):
+        line = line.strip()
+        if line:
+            yield simplejson.loads(line)
+
+# Bytes of a JSON Lines file decoded per parse_parallel task.
+PARSE_BLOCK = 1 << 22
+
+def line_ranges(path, block_size):
+    size = os.path.getsize(path)
+    return [(start, min(start + block_size, size)) for start in xrange(0, size, block_size)]
+
+def read_lines(path, start, end):
+    """Return the objects on the lines of a JSON Lines file that start between byte start and byte end."""
+    f = open(path, 'rb')
+    try:
+        if start:
+            # The line running into start belongs to the range before.
+            f.seek(start - 1)
+            f.readline()
+        objects = []
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            line = line.strip()
+            if line:
+                objects.append(simplejson.loads(line))
+        return objects
+    finally:
+        f.close()
+
+def parse_parallel(path, jobs, block_size=None):
+    """Yield the objects of an uncompressed JSON Lines file in order, decoded by a pool of jobs processes.
+
+    The file is split into blocks of block_size bytes at line boundaries. No
+    more than two blocks per process are decoded ahead of the one being
+    read, so memory use doesn't grow with the size of the file.
+    """
+    ranges = iter(line_ranges(path, block_size or PARSE_BLOCK))
+    pool = multiprocessing.Pool(jobs)
+    pids = worker_pids(pool)
+    try:
+        pending = deque([pool.apply_async(read_lines, (path,) + bounds) for bounds in islice(ranges, jobs * 2)])
+        while pending:
+            objects = wait_for(pending.popleft(), pool, pids)
+            for bounds in islice(ranges, 1):
+                pending.append(pool.apply_async(read_lines, (path,) + bounds))
+            for obj in objects:
+                yield obj
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,142 @@
+"""
+Keyset pagination for splitting a model's rows across chunk files.
+
+Slicing a queryset becomes ``LIMIT/OFFSET``, which makes the database walk
+past every row before the offset, so writing the later chunks of a big table
+gets slower and slower. Keyset pagination instead remembers the ordering key
+of the last row of a page and starts the next page with
+``WHERE key > last_key ORDER BY key``, which an index can answer directly.
+"""
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+
+def keyset_ordering(model):
+    """Return the ordering a model's rows are paged by as (name, field, descending) triples.
+
+    The model's Meta.ordering is used when every field in it is a non-null
+    local column, with the primary key appended to break ties unless the
+    ordering already ends in a unique field. Orderings that can't be used for
+    keyset comparisons (random, nullable or related fields) fall back to
+    ordering by primary key.
+    """
+    pk = model._meta.pk
+    keys = []
+    for name in model._meta.ordering:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == 'pk':
+            field = pk
+        else:
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                # '?' and lookups that span relations
+                return [('pk', pk, False)]
+            if field.null or (field.rel and not field.primary_key):
+                return [('pk', pk, False)]
+        keys.append((name, field, descending))
+        if field.primary_key or field.unique:
+            return keys
+    keys.append(('pk', pk, False))
+    return keys
+
+def order_by_keys(keys):
+    return ['%s%s' % (descending and '-' or '', name) for name, field, descending in keys]
+
+def after_key(keys, values):
+    """Build a filter matching rows that sort after the key values.
+
+    For keys (a, b) that is ``a > x OR (a = x AND b > y)``.
+    """
+    condition = None
+    for i, (name, field, descending) in enumerate(keys):
+        lookups = dict((keys[j][0], values[j]) for j in range(i))
+        lookups['%s__%s' % (name, descending and 'lt' or 'gt')] = values[i]
+        if condition is None:
+            condition = Q(**lookups)
+        else:
+            condition = condition | Q(**lookups)
+    return condition
+
+def page_bounds(qs, size):
+    """Split qs into pages of at most size rows, yielding the bounds of each page.
+
+    Bounds are a (lower, upper) pair of ordering key values; the page holds
+    the rows after lower up to and including upper, and either end may be None
+    for an open range. Because a page is a self-contained key range it can be
+    queried on its own, in any order or in another process. Finding each
+    boundary costs one query that reads at most two rows past the start of the
+    page. Querysets that can no longer be filtered (they were already sliced
+    by a custom manager) are paged with offsets instead, and their bounds are
+    slice objects.
+    """
+    if not qs.query.can_filter():
+        count = qs.count()
+        for start in range(0, count, size):
+            yield slice(start, start + size)
+        return
+
+    keys = keyset_ordering(qs.model)
+    names = [name for name, field, descending in keys]
+    ordered = qs.order_by(*order_by_keys(keys))
+    lower = None
+    while True:
+        page = ordered if lower is None else ordered.filter(after_key(keys, lower))
+        boundary = list(page.values_list(*names)[size - 1:size + 1])
+        if not boundary:
+            yield (lower, None)
+            return
+        yield (lower, boundary[0])
+        if len(boundary) == 1:
+            return
+        lower = boundary[0]
+
+def get_page(qs, bounds):
+    """Return the rows of qs within bounds as produced by page_bounds.
+
+    bounds of None means the whole queryset.
+    """
+    if bounds is None:
+        return qs
+    if isinstance(bounds, slice):
+        return qs[bounds]
+    keys = keyset_ordering(qs.model)
+    page = qs.order_by(*order_by_keys(keys))
+    lower, upper = bounds
+    if lower is not None:
+        page = page.filter(after_key(keys, lower))
+    if upper is not None:
+        page = page.exclude(after_key(keys, upper))
+    return page
+
+def key_runs(qs):
+    """Return the primary keys of qs's rows as [first, last] runs of consecutive integers.
+
+    Returns None if the primary keys aren't integers.
+    """
+    runs = []
+    for pk in qs.order_by('pk').values_list('pk', flat=True).iterator():
+        if not isinstance(pk, (int, long)):
+            return None
+        if runs and pk == runs[-1][1] + 1:
+            runs[-1][1] = pk
+        else:
+            runs.append([pk, pk])
+    return runs
+
+def missing_keys(previous, runs):
+    """Return the keys of the runs in previous that aren't in any of runs, in order."""
+    missing = []
+    i = 0
+    for start, end in previous:
+        key = start
+        while key <= end:
+            while i < len(runs) and runs[i][1] < key:
+                i += 1
+            if i == len(runs) or runs[i][0] > end:
+                missing.extend(xrange(key, end + 1))
+                break
+            if runs[i][0] > key:
+                missing.extend(xrange(key, runs[i][0]))
+            key = runs[i][1] + 1
+    return missing
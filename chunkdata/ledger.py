@@ -0,0 +1,45 @@
+"""
+The load ledger.
+
+loadchunks records every chunk file it commits in the LoadedChunk table of the
+target database, in the same transaction as the chunk's objects. A load
+started with --resume skips the chunks recorded for its fixture, as long as
+the file still has the checksum it had when it was loaded; any other load
+starts by forgetting what was recorded for its fixture. Chunks the manifest
+gives no checksum for are recorded with their size and modification time
+rather than hashed, so that a load doesn't read every file twice. Databases that don't
+have the table (chunkdata's tables were never created there) are loaded
+without a ledger.
+"""
+import os
+
+from django.db import connections
+
+from chunkdata.models import LoadedChunk
+
+def file_fingerprint(path):
+    """Return what a chunk file without a manifest checksum is recorded with."""
+    stat = os.stat(path)
+    return 'stat:%d:%d' % (stat.st_size, int(stat.st_mtime * 1000000))
+
+def has_ledger(using):
+    connection = connections[using]
+    return LoadedChunk._meta.db_table in connection.introspection.table_names()
+
+def loaded_chunks(using, fixture):
+    """Map the names of the chunk files recorded for fixture to their checksums."""
+    return dict(LoadedChunk.objects.using(using).filter(fixture=fixture).values_list('file', 'checksum'))
+
+def forget_chunks(using, fixture):
+    LoadedChunk.objects.using(using).filter(fixture=fixture).delete()
+
+def record_chunk(using, fixture, path, checksum=None):
+    """Record a chunk file as loaded; call it inside the transaction that loads it."""
+    name = os.path.basename(path)
+    LoadedChunk.objects.using(using).filter(fixture=fixture, file=name).delete()
+    LoadedChunk.objects.using(using).create(fixture=fixture, file=name, checksum=checksum or file_fingerprint(path))
+
+def is_loaded(loaded, path, checksum=None):
+    """Whether a chunk file is among the loaded chunks with an unchanged checksum."""
+    name = os.path.basename(path)
+    return name in loaded and loaded[name] == (checksum or file_fingerprint(path))
@@ -0,0 +1,401 @@
+"""
+Bulk loading of deserialized fixture objects.
+
+loaddata saves objects one at a time: a query to see whether the row exists
+and another to insert or update it, plus one per many-to-many field. The
+BulkLoader batches consecutive objects of the same model instead, finds the
+rows that already exist with one query per batch, inserts the rest with a
+single executemany, updates the ones that exist with another, and writes the
+batch's many-to-many rows in bulk as soon as it has been saved. The rows it
+writes are the ones a raw save_base would write, so the resulting database
+matches what loaddata produces.
+
+With match_natural_keys the loader applies a fixture as a delta: objects of
+models with natural keys replace the existing row with the same natural key,
+whatever its primary key, and are added as new rows otherwise.
+
+Given a NaturalKeyCache (see chunkdata.naturalkeys), the loader resolves the
+natural keys each batch of a fixture in one of the formats it reads as Python
+data (json, jsonl, columnar and yaml) refers to through it before
+deserializing, and remembers the natural keys of the objects it saves.
+
+json and jsonl fixtures are decoded an object at a time as they are read (see
+chunkdata.jsonstream), and columnar ones a block at a time, so the memory a
+load takes depends on batch_size rather than on the size of the file.
+"""
+from django.core import serializers
+from django.core.serializers.python import Deserializer as PythonDeserializer
+from django.db import connections, router, models, DEFAULT_DB_ALIAS
+from django.db.models import get_model, signals
+from django.db.models.fields.related import ManyToManyRel
+from django.dispatch.dispatcher import _make_id
+from django.core.management.color import no_style
+from django.utils.encoding import smart_unicode
+
+from chunkdata.columnar import read_objects
+from chunkdata.jsonstream import JSONArrayReader, iter_json_lines
+
+# Keep the number of parameters in one statement under SQLite's limit of 999.
+MAX_QUERY_PARAMS = 500
+
+class BulkLoader(object):
+    """Saves deserialized objects in batches of up to batch_size rows."""
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, batch_size=1000, match_natural_keys=False, key_cache=None,
+                 metrics=None):
+        self.using = using
+        self.connection = connections[using]
+        self.batch_size = batch_size
+        self.match_natural_keys = match_natural_keys
+        self.key_cache = key_cache
+        self.metrics = metrics
+        self.references = {}
+        self.batch = []
+        self.m2m = []
+        self.models = set()
+        self.count = 0
+
+    def load_fixture(self, format, stream):
+        """Deserialize and save a fixture, returning the number of objects saved."""
+        if format == 'json':
+            return self.load_data(JSONArrayReader(stream))
+        if format == 'jsonl':
+            return self.load_data(iter_json_lines(stream))
+        if format == 'columnar':
+            return self.load_data(read_objects(stream))
+        if format == 'yaml':
+            import yaml
+            return self.load_data(yaml.safe_load(stream))
+        return self.load(serializers.deserialize(format, stream, using=self.using), flush_referenced=True)
+
+    def load_data(self, data):
+        """Save fixture objects given as Python data, the way the json and yaml formats parse them.
+
+        data can be any iterable of objects. It is read batch_size objects at a
+        time, so a JSONArrayReader is never read further ahead than that.
+
+        Natural keys are looked up while the deserializer builds an object, so
+        the pending batch is saved whenever the next object is of another
+        model, before the deserializer gets to resolve its references.
+
+        With a key cache, the natural keys each batch of objects refers to are
+        looked up together first, one query per referenced model where
+        possible, and replaced by the primary keys they resolve to.
+        """
+        return self.load(PythonDeserializer(self.flushing(data), using=self.using))
+
+    def flushing(self, data):
+        for window in batches(data, self.batch_size):
+            if self.key_cache is not None:
+                self.resolve_references(window)
+            for d in window:
+                if self.batch:
+                    model = self.batch[0].object.__class__
+                    label = smart_unicode(model._meta)
+                    if d['model'] != label or (is_natural_key_target(model) and refers_to(model, model)):
+                        self.flush()
+                if self.key_cache is not None:
+                    d = self.replace_natural_keys(d)
+                yield d
+
+    def natural_key_references(self, label):
+        """Return (field name, target model, many) for the fields of label's model that can hold natural keys."""
+        if label not in self.references:
+            references = []
+            model = get_model(*label.split('.'))
+            if model is not None:
+                for field in model._meta.fields + model._meta.many_to_many:
+                    rel = field.rel
+                    if rel is None or not is_natural_key_target(rel.to):
+                        continue
+                    many = isinstance(rel, ManyToManyRel)
+                    # Foreign keys to another field than the primary key are left to the deserializer.
+                    if many or rel.field_name == rel.to._meta.pk.name:
+                        references.append((field.name, rel.to, many))
+            self.references[label] = references
+        return self.references[label]
+
+    def resolve_references(self, data):
+        keys = {}
+        for d in data:
+            fields = d['fields']
+            for name, target, many in self.natural_key_references(d['model']):
+                values = fields.get(name)
+                if values is None:
+                    continue
+                for value in many and values or [values]:
+                    if hasattr(value, '__iter__'):
+                        keys.setdefault(target, []).append(value)
+        for target, target_keys in keys.items():
+            self.key_cache.resolve(target, target_keys, self.using)
+
+    def replace_natural_keys(self, d):
+        """Return d with the natural keys it refers to replaced by primary keys where they resolve."""
+        fields = None
+        for name, target, many in self.natural_key_references(d['model']):
+            values = d['fields'].get(name)
+            if values is None:
+                continue
+            if many:
+                value = [self.natural_key_pk(target, v) for v in values]
+            else:
+                value = self.natural_key_pk(target, values)
+            if fields is None:
+                fields = dict(d['fields'])
+            fields[name] = value
+        if fields is None:
+            return d
+        return dict(d, fields=fields)
+
+    def natural_key_pk(self, model, value):
+        if not hasattr(value, '__iter__'):
+            return value
+        pk = self.key_cache.lookup(model, value, self.using)
+        if pk is None:
+            # Left for the deserializer to report.
+            return value
+        return pk
+
+    def load(self, objects, flush_referenced=False):
+        """Save every object from the deserializer and return how many were saved.
+
+        With flush_referenced, objects of models that can be referred to by
+        natural key are saved straight away, since there is no telling when
+        the deserializer will look them up.
+        """
+        for obj in objects:
+            self.add(obj)
+            if flush_referenced and is_natural_key_target(obj.object.__class__):
+                self.flush()
+        self.flush()
+        return self.count
+
+    def add(self, obj):
+        model = obj.object.__class__
+        if not router.allow_syncdb(self.using, model):
+            return
+        if self.batch and (self.batch[0].object.__class__ is not model or len(self.batch) >= self.batch_size):
+            self.flush()
+        self.batch.append(obj)
+
+    def flush(self):
+        """Save the current batch, which only holds objects of one model."""
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        model = batch[0].object.__class__
+        self.models.add(model)
+        self.count += len(batch)
+        if self.metrics is None:
+            self.save_batch(model, batch)
+            return
+        label = smart_unicode(model._meta)
+        self.metrics.count(label, len(batch))
+        self.metrics.switch(label)
+        try:
+            self.save_batch(model, batch)
+        finally:
+            self.metrics.switch(None)
+
+    def save_batch(self, model, batch):
+        """Insert the objects of batch, all of them of model, or update those that exist."""
+        if self.match_natural_keys and is_natural_key_target(model) and hasattr(model, 'natural_key'):
+            self.match_natural_key_rows(model, batch)
+        if not can_bulk_insert(model):
+            for obj in batch:
+                obj.save(using=self.using)
+            self.remember_natural_keys(model, batch)
+            return
+
+        existing = self.existing_pks(model, [obj.object.pk for obj in batch if obj.object.pk is not None])
+        new = []
+        changed = []
+        for obj in batch:
+            exists = obj.object.pk in existing
+            if obj.object.pk is None:
+                models.Model.save_base(obj.object, using=self.using, raw=True)
+            elif exists:
+                changed.append(obj.object)
+            else:
+                new.append(obj.object)
+            if obj.m2m_data:
+                self.m2m.append((model, obj.object.pk, obj.m2m_data, exists))
+
+        fields = model._meta.local_fields
+        insert_rows(self.connection, model._meta.db_table, [f.column for f in fields],
+                    [[raw_db_value(self.connection, f, obj) for f in fields] for obj in new])
+        pk = model._meta.pk
+        non_pks = [f for f in fields if not f.primary_key]
+        update_rows(self.connection, model._meta.db_table, pk.column, [f.column for f in non_pks],
+                    [[raw_db_value(self.connection, f, obj, add=False) for f in non_pks] +
+                     [pk.get_db_prep_save(obj.pk, connection=self.connection)] for obj in changed])
+        # Written with their batch, so they take no more memory than it does.
+        self.flush_m2m()
+        self.remember_natural_keys(model, batch)
+
+    def remember_natural_keys(self, model, batch):
+        """Put the natural keys of saved objects in the key cache, replacing what it held for their rows."""
+        if self.key_cache is None or not is_natural_key_target(model) or not hasattr(model, 'natural_key'):
+            return
+        if self.key_cache.can_resolve(model):
+            for obj in batch:
+                self.key_cache.set(model, obj.object.natural_key(), obj.object.pk)
+        else:
+            # Working out these natural keys could take queries of its own.
+            for obj in batch:
+                self.key_cache.discard(model, obj.object.pk)
+
+    def match_natural_key_rows(self, model, batch):
+        """Give each object the primary key of the existing row with its natural key.
+
+        Objects without a matching row lose their primary key, so they are
+        added as new rows instead of overwriting whatever row has that key.
+        """
+        if self.key_cache is not None:
+            keys = [obj.object.natural_key() for obj in batch]
+            pks = self.key_cache.resolve(model, keys, self.using)
+            if pks is not None:
+                # Taken from what resolve found, since a batch can have more
+                # keys than the cache holds.
+                for obj, pk in zip(batch, pks):
+                    obj.object.pk = pk
+            else:
+                for obj, key in zip(batch, keys):
+                    obj.object.pk = self.key_cache.lookup(model, key, self.using)
+            return
+        manager = model._default_manager.db_manager(self.using)
+        for obj in batch:
+            try:
+                obj.object.pk = manager.get_by_natural_key(*obj.object.natural_key()).pk
+            except model.DoesNotExist:
+                obj.object.pk = None
+
+    def existing_pks(self, model, pks):
+        manager = model._base_manager.using(self.using)
+        existing = set()
+        for i in range(0, len(pks), MAX_QUERY_PARAMS):
+            existing.update(manager.filter(pk__in=pks[i:i + MAX_QUERY_PARAMS]).values_list('pk', flat=True))
+        return existing
+
+    def flush_m2m(self):
+        """Write the many-to-many rows of the objects saved since the last call.
+
+        Like assigning the relation on a saved object, this replaces the
+        relations of objects that already existed.
+        """
+        rows = {}
+        cleared = {}
+        for model, pk, m2m_data, existed in self.m2m:
+            for name, related_pks in m2m_data.items():
+                field = model._meta.get_field(name)
+                if not field.rel.through._meta.auto_created:
+                    raise AttributeError("Cannot set values on a ManyToManyField which specifies an intermediary "
+                                         "model. Use %s.%s's Manager instead." % (
+                                         field.rel.through._meta.app_label, field.rel.through._meta.object_name))
+                source = model._meta.pk.get_db_prep_save(pk, connection=self.connection)
+                if existed:
+                    cleared.setdefault(field, []).append(source)
+                related_pk = field.rel.to._meta.pk
+                field_rows = rows.setdefault(field, set())
+                for value in related_pks:
+                    field_rows.add((source, related_pk.get_db_prep_save(related_pk.to_python(value),
+                                                                        connection=self.connection)))
+        self.m2m = []
+
+        qn = self.connection.ops.quote_name
+        cursor = self.connection.cursor()
+        for field, pks in cleared.items():
+            for i in range(0, len(pks), MAX_QUERY_PARAMS):
+                batch = pks[i:i + MAX_QUERY_PARAMS]
+                cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                    qn(field.m2m_db_table()), qn(field.m2m_column_name()), ', '.join(['%s'] * len(batch))), batch)
+        for field, field_rows in rows.items():
+            insert_rows(self.connection, field.m2m_db_table(),
+                        [field.m2m_column_name(), field.m2m_reverse_name()], sorted(field_rows))
+
+def batches(iterable, size):
+    """Yield lists of up to size consecutive items of iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def is_natural_key_target(model):
+    return hasattr(model._default_manager, 'get_by_natural_key')
+
+def refers_to(model, target):
+    for field in model._meta.fields + model._meta.many_to_many:
+        if getattr(field.rel, 'to', None) is target:
+            return True
+    return False
+
+def can_bulk_insert(model):
+    """Whether objects of model can be inserted without going through save_base.
+
+    save_base computes _order for order_with_respect_to models, and pre_save and
+    post_save receivers expect to see every object, so those models are saved
+    one at a time.
+    """
+    if model._meta.order_with_respect_to:
+        return False
+    for signal in (signals.pre_save, signals.post_save):
+        if hasattr(signal, 'has_listeners'):
+            if signal.has_listeners(model):
+                return False
+        elif signal._live_receivers(_make_id(model)):
+            return False
+    return True
+
+def raw_db_value(connection, field, obj, add=True):
+    # The value save_base(raw=True) writes for field.
+    return field.get_db_prep_save(getattr(obj, field.attname) or field.pre_save(obj, add), connection=connection)
+
+def insert_rows(connection, table, columns, rows):
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(table), ', '.join([qn(column) for column in columns]), ', '.join(['%s'] * len(columns)))
+    connection.cursor().executemany(sql, rows)
+
+def update_rows(connection, table, pk_column, columns, rows):
+    """Update rows given as their column values followed by their primary key."""
+    if not rows or not columns:
+        return
+    qn = connection.ops.quote_name
+    sql = "UPDATE %s SET %s WHERE %s = %%s" % (
+        qn(table), ', '.join(['%s = %%s' % qn(column) for column in columns]), qn(pk_column))
+    connection.cursor().executemany(sql, rows)
+
+def delete_rows(using, model, keys):
+    """Delete the objects of model with the given primary keys or natural keys, as QuerySet.delete would.
+
+    Natural keys are given as lists. Returns the number of keys that matched an object.
+    """
+    manager = model._base_manager.db_manager(using)
+    pks = []
+    for key in keys:
+        if isinstance(key, (list, tuple)):
+            try:
+                pks.append(model._default_manager.db_manager(using).get_by_natural_key(*key).pk)
+            except model.DoesNotExist:
+                pass
+        else:
+            pks.append(model._meta.pk.to_python(key))
+    deleted = 0
+    for i in range(0, len(pks), MAX_QUERY_PARAMS):
+        qs = manager.filter(pk__in=pks[i:i + MAX_QUERY_PARAMS])
+        deleted += qs.count()
+        qs.delete()
+    return deleted
+
+def reset_sequences(connection, models):
+    sequence_sql = connection.ops.sequence_reset_sql(no_style(), models)
+    if sequence_sql:
+        cursor = connection.cursor()
+        for line in sequence_sql:
+            cursor.execute(line)
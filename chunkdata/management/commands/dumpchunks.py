@@ -1,15 +1,41 @@
 from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand, CommandError
 from django.core import serializers
-try:
-    from django.db import connections, router, DEFAULT_DB_ALIAS
-except ImportError:
-    connections = router = DEFAULT_DB_ALIAS = None
+from chunkdata.compression import COMPRESSION_TYPES, compress, compressed_name
+from chunkdata.csvchunks import CSV_FORMAT, table_filename, table_querysets, write_table
+from chunkdata.checkpoint import (checkpoint_path, decode_plan, encode_plan, read_checkpoint, record_checkpoint,
+                                  start_checkpoint)
+from chunkdata.metrics import (ChunkMetrics, MeteredFile, RunMetrics, describe, has_receivers, switching,
+                               switching_objects, watch_queries)
+from chunkdata.manifest import (ChecksumFile, delta_name, latest_manifest, manifest_path, manifest_value,
+                                read_manifest, write_manifest)
+from chunkdata.keyset import get_page, key_runs, missing_keys, page_bounds
+from chunkdata.loader import is_natural_key_target
+from chunkdata.models import LoadedChunk
+from chunkdata.pipeline import BackgroundWriter, ReadAhead, SyncedFile
+from chunkdata.progress import DEFAULT_INTERVAL, PROGRESS_STEP, Progress
+from chunkdata.prefetch import iter_prefetched
+from chunkdata.serializers import get_serializer
+from chunkdata.serializers.rows import ROW_FORMATS, iter_rows, write_rows
+from chunkdata.workers import WorkerDied, iter_unordered
+from django.db import connections, router, DEFAULT_DB_ALIAS
 from django.utils.datastructures import SortedDict
-from django.db.models import get_app, get_apps, get_models, get_model
+from django.utils.encoding import smart_unicode
+from django.db.models import get_app, get_apps, get_models, get_model, Max
+from django.db.models.fields import FieldDoesNotExist
 
+from fractions import Fraction
 from optparse import make_option
+from StringIO import StringIO
+import multiprocessing
 import os
+import sys
+
+# Objects per second loaddata manages on a typical model, for --target-seconds.
+DEFAULT_LOAD_RATE = 1000
+
+# Rows serialized per model to estimate the size of its objects.
+SAMPLE_SIZE = 20
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -27,6 +53,56 @@ class Command(BaseCommand):
         make_option('-a', '--all', action='store_true', dest='use_base_manager', default=False,
             help="Use Django's base manager to dump all models stored in the database, including those that would otherwise be filtered or modified by a custom manager."),
         make_option('-c', '--chunk', dest='chunk', type='int', help='Set a maximum number of objects to serialize at once. Requires -f/--filespec to be set.'),
+        make_option('--chunk-for', dest='chunk_for', action='append', default=[],
+            help='Set the maximum number of objects per file for one model, as appname.ModelName=N. Use multiple '
+                 '--chunk-for for several models.'),
+        make_option('--target-bytes', dest='target_bytes',
+            help='Pick the number of objects per file for each model so that its files come to about this size, '
+                 'from the serialized size of a sample of its rows. Accepts K, M and G suffixes.'),
+        make_option('--target-seconds', dest='target_seconds', type='float',
+            help='Pick the number of objects per file for each model so that a file takes about this long to '
+                 'load at --load-rate objects per second.'),
+        make_option('--load-rate', dest='load_rate', type='float', default=DEFAULT_LOAD_RATE,
+            help='Objects per second assumed for --target-seconds. Defaults to %d.' % DEFAULT_LOAD_RATE),
+        make_option('--max-bytes', dest='max_bytes',
+            help='Close a chunk file once this much serialized data has been written to it and carry on in '
+                 'another file. Accepts K, M and G suffixes. Can be combined with -c/--chunk.'),
+        make_option('--fast', action='store_true', dest='fast', default=False,
+            help='Serialize rows read with values_list() instead of model instances, for the json and yaml formats. '
+                 'Fields with custom value_to_string methods are still converted by them.'),
+        make_option('-s', '--stream', action='store_true', dest='stream', default=False,
+            help='Write objects to stdout as they are serialized instead of returning the whole fixture at once.'),
+        make_option('-j', '--jobs', dest='jobs', type='int', default=1,
+            help='Write chunk files concurrently from this many worker processes, each with its own database connection. '
+                 'Each worker reads its chunks in its own transaction.'),
+        make_option('--pipeline', action='store_true', dest='pipeline', default=False,
+            help='Overlap reading, serializing and writing: objects are read a batch at a time by a thread '
+                 'with its own database connection, running ahead into the next chunk, and files are compressed, '
+                 'written and fsynced by another thread. With an in-memory SQLite database, objects are read in '
+                 'the main thread.'),
+        make_option('-z', '--compress', dest='compression', choices=sorted(COMPRESSION_TYPES.keys()),
+            help='Compress chunk files as they are written with one of: %s.' % ', '.join(sorted(COMPRESSION_TYPES.keys()))),
+        make_option('-i', '--incremental', action='store_true', dest='incremental', default=False,
+            help='Only dump the rows added or changed since the last dump of the same filespec, as a delta chunk set '
+                 'named <filespec>-delta-<n>.'),
+        make_option('-u', '--updated-field', dest='updated_fields', action='append', default=[],
+            help='A field (or appname.ModelName=field) holding the time a row was last changed, used as the '
+                 'high-water mark for --incremental instead of the primary key. Use multiple --updated-field '
+                 'for several models.'),
+        make_option('--deletions', action='store_true', dest='deletions', default=False,
+            help='Record the primary keys of every model in the manifest, so that the next --incremental dump '
+                 'lists the rows deleted since. Models with integer primary keys and no natural key only.'),
+        make_option('--metrics-file', dest='metrics_file',
+            help='Time every chunk of a dump to -f/--filespec and write the figures, per chunk and per model, '
+                 'to this file as JSON.'),
+        make_option('--progress', action='store_true', dest='progress', default=False,
+            help='Report the objects written out of the total, the rate and the time left on stderr while '
+                 'dumping to -f/--filespec.'),
+        make_option('--progress-interval', dest='progress_interval', type='float', default=DEFAULT_INTERVAL,
+            help='Seconds between progress reports. Defaults to %d.' % DEFAULT_INTERVAL),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+            help='Finish a dump that was interrupted, writing only the chunks its checkpoint has no record of. '
+                 'The plan and options of the interrupted dump are used.'),
         make_option('-f', '--filespec', dest='filespec', 
             help="""Set the base file name. Example: if filespec is "foo" and format is "json" and total number of output files
                     is 1 then the single output file is foo.json. If there are two, it is foo1.json, foo2.json."""),
@@ -43,13 +119,39 @@ class Command(BaseCommand):
         using = options.get('database', DEFAULT_DB_ALIAS)
         chunk = options.get('chunk', None)
         filespec = options.get('filespec', None)
-        if chunk and not filespec:
+        stream = options.get('stream', False)
+        jobs_count = options.get('jobs', None) or 1
+        compression = options.get('compression', None)
+        incremental = options.get('incremental', False)
+        track_deletions = options.get('deletions', False)
+        fast = options.get('fast', False)
+        pipeline = options.get('pipeline', False)
+        max_bytes = options.get('max_bytes', None)
+        if max_bytes:
+            max_bytes = parse_size(max_bytes)
+        target_bytes = options.get('target_bytes', None)
+        if target_bytes:
+            target_bytes = parse_size(target_bytes)
+        target_seconds = options.get('target_seconds', None)
+        load_rate = options.get('load_rate', None) or DEFAULT_LOAD_RATE
+        chunk_for = {}
+        for spec in options.get('chunk_for', []):
+            label, size = spec.split('=', 1) if '=' in spec else (spec, '')
+            model_obj = get_model(*label.split('.', 1)) if '.' in label else None
+            if not model_obj:
+                raise CommandError('Unknown model in --chunk-for: %s' % label)
+            if not size.isdigit() or not int(size):
+                raise CommandError('Invalid chunk size for %s: %s' % (label, size))
+            chunk_for[model_obj] = int(size)
+        chunking = bool(chunk or chunk_for or target_bytes or target_seconds)
+        if compression and compression not in COMPRESSION_TYPES:
+            raise CommandError("Unknown compression type: %s" % compression)
+        if (chunking or incremental or track_deletions or max_bytes or format == CSV_FORMAT) and not filespec:
             if len(app_labels) == 1:
                 filespec = app_labels[0]
             else:
                 filespec = 'chunks'
-        if connections:
-            connection = connections[using]
+        connection = connections[using]
         excludes = options.get('exclude',[])
         show_traceback = options.get('traceback', False)
         use_natural_keys = options.get('use_natural_keys', False)
@@ -71,6 +173,17 @@ class Command(BaseCommand):
                 except ImproperlyConfigured:
                     raise CommandError('Unknown app in excludes: %s' % exclude)
 
+        updated_fields = {}
+        for updated_field in options.get('updated_fields', []):
+            if '=' in updated_field:
+                label, field_name = updated_field.split('=', 1)
+                model_obj = get_model(*label.split('.', 1)) if '.' in label else None
+                if not model_obj:
+                    raise CommandError('Unknown model in updated fields: %s' % label)
+                updated_fields[model_obj] = field_name
+            else:
+                updated_fields[None] = updated_field
+
         if len(app_labels) == 0:
             if verbosity >= 2:
                 print "No app labels passed!"
@@ -111,104 +224,449 @@ class Command(BaseCommand):
 
         # Check that the serialization format exists; this is a shortcut to
         # avoid collating all the objects and _then_ failing.
-        if format not in serializers.get_public_serializer_formats():
-            raise CommandError("Unknown serialization format: %s" % format)
+        if format == CSV_FORMAT:
+            # Written a table at a time from rows, so --fast changes nothing.
+            if stream:
+                raise CommandError("The csv format writes a file per table; it can't be streamed to stdout.")
+            if max_bytes:
+                raise CommandError("--max-bytes can't split the files of the csv format.")
+        else:
+            if format not in serializers.get_public_serializer_formats():
+                raise CommandError("Unknown serialization format: %s" % format)
 
-        try:
-            serializers.get_serializer(format)
-        except KeyError:
-            raise CommandError("Unknown serialization format: %s" % format)
+            try:
+                serializers.get_serializer(format)
+            except KeyError:
+                raise CommandError("Unknown serialization format: %s" % format)
+            if fast and format not in ROW_FORMATS:
+                raise CommandError("--fast can't write the %s format" % format)
+            if max_bytes and format == 'columnar':
+                # Rows are buffered into blocks, so the size of a file isn't
+                # known until a whole block has been written.
+                raise CommandError("--max-bytes can't split the files of the columnar format.")
 
-        # Now collate the objects to be serialized.
-        objects = []
-        filecount = 0
+        # Now plan the chunk files. Each chunk is a list of (model, bounds)
+        # parts, where bounds select a key range of the model's rows (None for
+        # all of them). Nothing is fetched yet: rows are streamed straight
+        # into the serializer when the chunk's file is written.
+        plan = []
+        parts = []
+        dumped_models = []
+        watermarks = {}
+        keys = {}
+        deletions = {}
+        filters = {}
         obj_count = 0
+        fill = 0
         total_obj_count = 0
+        checkpoint = None
         if filespec:
             path_spec = (get_dirspec(app_labels), filespec)
-        for model in sort_dependencies(app_list.items(), verbosity):
-            if model in excluded_models:
+            if incremental:
+                previous_path = latest_manifest(*path_spec)
+                if previous_path is None:
+                    raise CommandError("No previous dump of %s to continue from; run dumpchunks without "
+                                       "--incremental first." % filespec)
+                previous = read_manifest(previous_path)
+                since = previous.get('watermarks', {})
+                delta = previous.get('delta', 0) + 1
+                path_spec = (path_spec[0], delta_name(filespec, delta))
+            checkpoint_file = checkpoint_path(*path_spec)
+            if options.get('resume') and os.path.exists(checkpoint_file):
+                checkpoint, checkpointed = read_checkpoint(checkpoint_file)
+            if checkpoint:
+                format, compression, indent, use_natural_keys, use_base_manager, max_bytes, fast = [
+                    checkpoint['options'].get(key) for key in
+                    ('format', 'compression', 'indent', 'use_natural_keys', 'use_base_manager', 'max_bytes', 'fast')]
+                plan = decode_plan(checkpoint['plan'])
+                filters = dict((get_model(*label.split('.')), lookups)
+                               for label, lookups in checkpoint['filters'].items())
+            elif options.get('resume') and verbosity >= 1:
+                print "Nothing to resume for %s, starting a new dump." % path_spec[1]
+        for model in ([] if checkpoint else sort_dependencies(app_list.items(), verbosity)):
+            if model in excluded_models or model is LoadedChunk:
                 continue
-            if not model._meta.proxy and (not router or router.allow_syncdb(using, model)):
+            if not model._meta.proxy and router.allow_syncdb(using, model):
                 if verbosity >= 2:
                     print "Attempting to export model: %s" % model.__name__
-                if use_base_manager:
-                    manager = model._base_manager.using(using) if connections else model._base_manager
-                    qs = manager.all()
-                else:
-                    manager = model._default_manager.using(using) if connections else model._default_manager
-                    qs = manager.all()
+                label = smart_unicode(model._meta)
+                dumped_models.append(label)
+                qs = get_queryset(model, using, use_base_manager)
+                if filespec and track_deletions and not (is_natural_key_target(model) and
+                                                         hasattr(model, 'natural_key')):
+                    # Loaded deltas match these models by primary key, so
+                    # their deletions can be listed by primary key too.
+                    runs = key_runs(qs)
+                    if runs is not None:
+                        keys[label] = runs
+                        if incremental and previous.get('keys', {}).get(label) is not None:
+                            deleted = missing_keys(previous['keys'][label], runs)
+                            if deleted:
+                                deletions[label] = deleted
+                if filespec:
+                    field = watermark_field(model, updated_fields)
+                    high = qs.aggregate(high=Max(field))['high']
+                    watermarks[label] = {'field': field, 'value': manifest_value(high)}
+                    if incremental:
+                        if high is None:
+                            continue
+                        # Rows changed while the dump runs are left for the
+                        # next one.
+                        filters[model] = {'%s__lte' % field: high}
+                        mark = since.get(label)
+                        if mark and mark['field'] == field and mark['value'] is not None:
+                            filters[model]['%s__gt' % field] = mark['value']
+                        qs = qs.filter(**filters[model])
+                        if not chunking and not qs.exists():
+                            continue
 
-                if chunk:
+                if chunking:
                     qs_count = qs.count()
-                    if qs_count:
-                        if obj_count + qs_count > chunk:
-                            if verbosity >= 2:
-                                print "Found %d objects." % qs_count
-                            try:
-                                if objects:
-                                    filecount += 1
-                                    write_file(path_spec, filecount, format, objects, 
-                                               indent=indent, use_natural_keys=use_natural_keys,
-                                               verbosity=verbosity)
-                                    objects = []
-                                    obj_count += qs_count
-                            except Exception, e:
-                                if show_traceback:
-                                    raise
-                                raise CommandError("Unable to serialize database: %s" % e)
-
-                            if qs_count > chunk:
-                                chunk_start = 0
-                                chunk_end = chunk
-                                while chunk_end <= qs_count:
-                                    filecount += 1
-                                    write_file(path_spec, filecount, format, qs[chunk_start:chunk_end],
-                                               indent=indent, use_natural_keys=use_natural_keys, 
-                                               verbosity=verbosity)
-                                    if chunk_end == qs_count: 
-                                        break
-                                    chunk_start = chunk_end
-                                    if chunk_end + chunk <= qs_count:
-                                        chunk_end = chunk_end + chunk
-                                    else:
-                                        chunk_end = qs_count
-                        else:
-                            objects.extend(qs)
-                            obj_count += qs_count
-
-                        total_obj_count += qs_count
+                    if not qs_count:
+                        continue
+                    if verbosity >= 2:
+                        print "Found %d objects." % qs_count
+                    if model in chunk_for:
+                        size = chunk_for[model]
+                    elif target_bytes or target_seconds:
+                        row_bytes = sample_row_bytes(qs, format, indent=indent, use_natural_keys=use_natural_keys)
+                        size = adaptive_chunk_size(row_bytes, target_bytes, target_seconds, load_rate, chunk)
+                        if verbosity >= 2:
+                            print "About %d bytes per object, %d objects per file." % (row_bytes, size)
+                    elif chunk:
+                        size = chunk
+                    else:
+                        size = qs_count
+                    # Models with different chunk sizes share a file in
+                    # proportion to their sizes.
+                    share = Fraction(qs_count, size)
+                    if fill + share > 1 and parts:
+                        plan.append((parts, obj_count))
+                        parts = []
+                        obj_count = 0
+                        fill = 0
+
+                    if qs_count > size:
+                        remaining = qs_count
+                        for bounds in page_bounds(qs, size):
+                            plan.append(([(model, bounds)], min(size, remaining)))
+                            remaining -= size
+                    else:
+                        parts.append((model, None))
+                        obj_count += qs_count
+                        fill += share
+
+                    total_obj_count += qs_count
                 else:
-                    objects.extend(qs)
-                            
-        try:
+                    parts.append((model, None))
+                    if filespec and options.get('progress'):
+                        total_obj_count += qs.count()
+
+        if incremental and not (parts or plan or deletions or checkpoint):
+            return "No changes since %s\n" % previous_path
 
-            if filespec and (objects or filecount):
-                if objects:
-                    filecount += 1
-                    write_file(path_spec, filecount, format, objects,
-                               indent=indent, use_natural_keys=use_natural_keys, 
-                               verbosity=verbosity)
-                    total_obj_count += len(objects)
+        try:
+            if filespec and (parts or plan or deletions):
+                if parts:
+                    plan.append((parts, chunking and obj_count or None))
+                done = {}
+                if checkpoint:
+                    manifest = checkpoint['manifest']
+                    for entries in checkpointed:
+                        paths = [os.path.join(path_spec[0], path_spec[1], entry['file']) for entry in entries]
+                        if [os.path.exists(path) and os.path.getsize(path) for path in paths] == \
+                                [entry['bytes'] for entry in entries]:
+                            done[entries[0]['number']] = entries
+                    if verbosity >= 1:
+                        print "Resuming %s: %d of %d chunks already written." % (path_spec[1], len(done), len(plan))
+                else:
+                    manifest = {
+                        'name': path_spec[1],
+                        'format': format,
+                        'compression': compression,
+                        'models': dumped_models,
+                        'watermarks': watermarks,
+                    }
+                    if chunking:
+                        manifest['objects'] = total_obj_count
+                    if track_deletions:
+                        manifest['keys'] = keys
+                    if deletions:
+                        manifest['deletions'] = deletions
+                    if incremental:
+                        manifest.update(base=filespec, delta=delta, since=since)
+                    if not os.path.exists(path_spec[0]):
+                        os.makedirs(path_spec[0])
+                    if not plan:
+                        # Deletions only: loadchunks looks for the manifest
+                        # next to the chunk directory.
+                        os.makedirs(os.path.join(*path_spec))
+                    start_checkpoint(checkpoint_file, {
+                        'manifest': manifest,
+                        'options': dict(format=format, compression=compression, indent=indent,
+                                        use_natural_keys=use_natural_keys, use_base_manager=use_base_manager,
+                                        max_bytes=max_bytes, fast=fast),
+                        'plan': encode_plan(plan),
+                        'filters': dict((smart_unicode(model._meta),
+                                         dict((key, manifest_value(value)) for key, value in lookups.items()))
+                                        for model, lookups in filters.items()),
+                    })
+                run_metrics = None
+                if options.get('metrics_file') or has_receivers() or verbosity >= 2:
+                    run_metrics = RunMetrics(Command, options.get('metrics_file'), command='dumpchunks',
+                                             name=path_spec[1], format=format, database=using)
+                jobs = [(path_spec, filecount, format, chunk_parts, chunk_count, using, use_base_manager, filters,
+                         dict(indent=indent, use_natural_keys=use_natural_keys, compression=compression,
+                              verbosity=verbosity, max_bytes=max_bytes, fast=fast, measure=bool(run_metrics),
+                              pipeline=pipeline))
+                        for filecount, (chunk_parts, chunk_count) in enumerate(plan, 1) if filecount not in done]
+                parallel = jobs_count > 1 and len(jobs) > 1 and not is_process_local(connection)
+                progress = None
+                if options.get('progress'):
+                    progress = Progress(path_spec[1], manifest.get('objects') or total_obj_count or None,
+                                        done=sum([entry['objects'] for entries in done.values() for entry in entries]),
+                                        interval=options.get('progress_interval', DEFAULT_INTERVAL))
+                    if not parallel:
+                        # Serial chunks report as they go; workers' chunks
+                        # are counted here once they are written.
+                        for job in jobs:
+                            job[-1]['progress'] = progress
+                pool = None
+                reader = None
+                if parallel:
+                    # Workers open their own connections; the parent's must
+                    # not be inherited across the fork.
+                    connection.close()
+                    pool = multiprocessing.Pool(min(jobs_count, len(jobs)))
+                    entries = iter_unordered(pool, write_chunk, jobs)
+                else:
+                    if jobs_count > 1 and verbosity >= 2:
+                        print "Writing chunks serially: worker processes can't share this database."
+                    if pipeline and can_read_ahead(format, using):
+                        # One reader thread for every chunk, so it can get
+                        # ahead into the next one.
+                        reader = ReadAhead([chunk_objects(job) for job in jobs], using)
+                        entries = (write_chunk(job, reader) for job in jobs)
+                    else:
+                        if pipeline and format != CSV_FORMAT and verbosity >= 2:
+                            print "Reading objects in the main thread: a reader thread can't share this database."
+                        entries = (write_chunk(job) for job in jobs)
+                try:
+                    for chunk_entries, metrics in entries:
+                        record_checkpoint(checkpoint_file, chunk_entries)
+                        done[chunk_entries[0]['number']] = chunk_entries
+                        if progress is not None and pool is not None:
+                            progress.add(sum([entry['objects'] for entry in chunk_entries]))
+                        if metrics is not None:
+                            if verbosity >= 2:
+                                print "Wrote chunk %d: %s" % (metrics['number'], describe(metrics))
+                            run_metrics.add(metrics)
+                except WorkerDied, err:
+                    raise CommandError("%s" % err)
+                finally:
+                    if pool is not None:
+                        pool.terminate()
+                        pool.join()
+                    if reader is not None:
+                        reader.close()
+                written = []
+                for number in sorted(done):
+                    written.extend(done[number])
+                filecount = len(written)
+                if 'objects' not in manifest:
+                    manifest['objects'] = sum([entry['objects'] for entry in written])
+                total_obj_count = manifest['objects']
+                write_manifest(manifest_path(path_spec[0], path_spec[1]), dict(manifest, chunks=written))
+                os.remove(checkpoint_file)
+                if run_metrics is not None:
+                    run_metrics.finish()
+                if progress is not None:
+                    progress.finish()
                 prefix = "Wrote serialized database (%d objects) to" % total_obj_count
-                if filecount > 1:
+                extension = compressed_name(format, compression)
+                if not filecount:
+                    msg = "Wrote the deletions since %s to %s\n" % (previous_path, manifest_path(*path_spec))
+                elif format == CSV_FORMAT:
+                    msg = "%s %s/%s/%s.######.<app>.<model>.%s (%d files)\n" % (prefix, path_spec[0], path_spec[1],
+                                                  path_spec[1], extension, filecount)
+                elif max_bytes:
+                    msg = "%s %s/%s/%s.######.####.%s (%d files)\n" % (prefix, path_spec[0], path_spec[1],
+                                                  path_spec[1], extension, filecount)
+                elif filecount > 1:
                     msg = "%s %s/%s/%s.######.%s (%d files)\n" % (prefix, path_spec[0], path_spec[1], 
-                                                  path_spec[1], format, filecount)
+                                                  path_spec[1], extension, filecount)
                 else:
-                    msg = "%s %s/%s.%s\n" % (prefix, path_spec[0], path_spec[1], format)
+                    msg = "%s %s/%s.%s\n" % (prefix, path_spec[0], path_spec[1], extension)
                 return msg
 
-            return serialize(format, objects, indent=indent, use_natural_keys=use_natural_keys)
+            querysets = [get_page(get_queryset(model, using, use_base_manager, filters.get(model)), bounds)
+                         for model, bounds in parts]
+            if fast:
+                out = stream and getattr(self, 'stdout', sys.stdout) or StringIO()
+                write_rows(format, iter_rows(querysets, use_natural_keys), out, indent=indent)
+                if not stream:
+                    return out.getvalue()
+                return
+            if stream:
+                serialize(format, iter_objects(querysets), indent=indent, use_natural_keys=use_natural_keys,
+                          stream=getattr(self, 'stdout', sys.stdout))
+                return
+            return serialize(format, iter_objects(querysets), indent=indent, use_natural_keys=use_natural_keys)
         except Exception, e:
             if show_traceback:
                 raise
             raise CommandError("Unable to serialize database: %s" % e)
 
-def serialize(format, objects, indent=None, use_natural_keys=False):
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+def parse_size(size):
+    """Parse a size in bytes, optionally with a K, M or G suffix."""
+    digits = str(size).strip().upper()
+    multiplier = SIZE_SUFFIXES.get(digits[-1:], 1)
+    if digits[-1:] in SIZE_SUFFIXES:
+        digits = digits[:-1]
+    try:
+        value = int(digits) * multiplier
+    except ValueError:
+        value = 0
+    if value <= 0:
+        raise CommandError("Invalid size: %s" % size)
+    return value
+
+def sample_row_bytes(qs, format, indent=None, use_natural_keys=False, sample_size=SAMPLE_SIZE):
+    """Estimate the serialized size of one of qs's objects from a sample of its rows."""
+    if format == CSV_FORMAT:
+        out = StringIO()
+        rows = write_table(out, qs.model, [qs[:sample_size]])[0]
+        return rows and max(1, len(out.getvalue().split('\n', 1)[1]) // rows)
+    sample = list(qs[:sample_size])
+    if not sample:
+        return 0
+    empty = len(serialize(format, [], indent=indent, use_natural_keys=use_natural_keys))
+    data = serialize(format, sample, indent=indent, use_natural_keys=use_natural_keys)
+    return max(1, (len(data) - empty) // len(sample))
+
+def adaptive_chunk_size(row_bytes, target_bytes=None, target_seconds=None, load_rate=DEFAULT_LOAD_RATE, chunk=None):
+    """Return the number of objects of row_bytes each that fit in a file within every target given."""
+    sizes = []
+    if target_bytes:
+        sizes.append(target_bytes // max(row_bytes, 1))
+    if target_seconds:
+        sizes.append(int(target_seconds * load_rate))
+    if chunk:
+        sizes.append(chunk)
+    return max(1, min(sizes))
+
+def get_queryset(model, using, use_base_manager=False, lookups=None):
+    if use_base_manager:
+        manager = model._base_manager.using(using)
+    else:
+        manager = model._default_manager.using(using)
+    if lookups:
+        return manager.filter(**lookups)
+    return manager.all()
+
+def watermark_field(model, updated_fields):
+    """Return the name of the field whose highest value marks how far model was dumped.
+
+    updated_fields maps models to their modification-time field, with the
+    None key naming a field to use for every model that has it. Other models
+    are marked by primary key, which only catches rows that were added.
+    """
+    if model in updated_fields:
+        try:
+            model._meta.get_field(updated_fields[model])
+        except FieldDoesNotExist:
+            raise CommandError("Unknown field in updated fields: %s.%s" % (smart_unicode(model._meta),
+                                                                            updated_fields[model]))
+        return updated_fields[model]
+    if None in updated_fields:
+        try:
+            model._meta.get_field(updated_fields[None])
+            return updated_fields[None]
+        except FieldDoesNotExist:
+            pass
+    return model._meta.pk.name
+
+def is_process_local(connection):
+    """True if a connection's data can't be seen from other processes, as with in-memory SQLite."""
+    return (connection.settings_dict['ENGINE'].endswith('sqlite3') and
+            connection.settings_dict['NAME'] in ('', ':memory:'))
+
+def write_chunk(job, reader=None):
+    """Write one chunk of the dump plan and return the manifest entries of its files and its metrics.
+
+    This is the unit of work handed to --jobs worker processes, so it only
+    takes picklable arguments and looks the querysets up itself. The metrics
+    are None unless the options ask to measure. reader is a ReadAhead that
+    reads the chunk's objects in another thread; with the pipeline option and
+    none given, the chunk gets a reader thread of its own where it can.
+    """
+    path_spec, filecount, format, parts, obj_count, using, use_base_manager, filters, options = job
+    options = dict(options)
+    querysets = [get_page(get_queryset(model, using, use_base_manager, filters.get(model)), bounds)
+                 for model, bounds in parts]
+    own_reader = None
+    if reader is None and options.get('pipeline') and can_read_ahead(format, using):
+        reader = own_reader = ReadAhead([chunk_objects(job)], using)
+    try:
+        if not options.pop('measure', False):
+            return write_file(path_spec, filecount, format, querysets, obj_count=obj_count, reader=reader,
+                              **options), None
+        metrics = ChunkMetrics()
+        unwatch = watch_queries(connections[using], metrics)
+        try:
+            entries = write_file(path_spec, filecount, format, querysets, obj_count=obj_count, metrics=metrics,
+                                 reader=reader, **options)
+        finally:
+            unwatch()
+    finally:
+        if own_reader is not None:
+            own_reader.close()
+    for entry in entries:
+        for stats in entry['models']:
+            metrics.count(stats['model'], stats['objects'])
+    return entries, metrics.finish(number=filecount, files=[entry['file'] for entry in entries],
+                                   file_bytes=sum([entry['bytes'] for entry in entries]))
+
+def chunk_objects(job):
+    """Yield the objects write_chunk serializes for job, for a ReadAhead to read in its thread."""
+    path_spec, filecount, format, parts, obj_count, using, use_base_manager, filters, options = job
+    querysets = [get_page(get_queryset(model, using, use_base_manager, filters.get(model)), bounds)
+                 for model, bounds in parts]
+    if options.get('fast'):
+        objects = iter_rows(querysets, options.get('use_natural_keys', False))
+    else:
+        objects = iter_objects(querysets)
+    for obj in objects:
+        yield obj
+
+def can_read_ahead(format, using):
+    """Whether a ReadAhead thread can read the objects of a dump in format from the database using."""
+    return format != CSV_FORMAT and not is_process_local(connections[using])
+
+def iter_objects(querysets):
+    """Yield the objects of each queryset in turn without caching them.
+
+    Their many-to-many relations are prefetched a batch of objects at a time.
+    """
+    for qs in querysets:
+        for obj in iter_prefetched(qs):
+            yield obj
+
+def serialize(format, objects, indent=None, use_natural_keys=False, stream=None):
+    """Serialize objects, writing them to stream as they go if one is given.
+
+    Without a stream the serialized data is returned as a string.
+    """
+    serializer = get_serializer(format)()
+    options = {'indent': indent}
+    if stream is not None:
+        options['stream'] = stream
     try:
-        return serializers.serialize(format, objects, indent=indent, use_natural_keys=use_natural_keys)
+        return serializer.serialize(objects, use_natural_keys=use_natural_keys, **options)
     except TypeError:
-        return serializers.serialize(format, objects, indent=indent)
+        return serializer.serialize(objects, **options)
 
 def get_dirspec(app_labels):
     if len(app_labels) == 1:
@@ -218,22 +676,245 @@ def get_dirspec(app_labels):
 
     return 'fixtures'
 
-def write_file(spec, count, format, objects, indent=None, use_natural_keys=False, verbosity=0):
-    serialized = serialize(format, objects, indent=indent, use_natural_keys=use_natural_keys)
+def write_file(spec, count, format, querysets, obj_count=None, indent=None, use_natural_keys=False,
+               compression=None, verbosity=0, max_bytes=None, fast=False, metrics=None, progress=None,
+               pipeline=False, reader=None):
+    """Stream the objects of querysets into the file for chunk number count.
+
+    With max_bytes, a file is closed as soon as the serialized (uncompressed)
+    data written to it reaches max_bytes, and the chunk carries on in another
+    file: foo.000001.0001.json, foo.000001.0002.json and so on. With fast the
+    rows are serialized without building model instances. obj_count is only
+    used for reporting. With metrics, a ChunkMetrics, the time spent on each
+    model and in writing is measured, and progress, a Progress, is told about
+    the objects as they are written. With pipeline each file is compressed,
+    written and fsynced by a BackgroundWriter, and given a reader, a
+    ReadAhead, the objects come from it rather than from querysets. Returns
+    the manifest entries of the files written.
+    """
     dirspec, filespec = spec
-    if count == 0:
-        filename = '%s.%s' % (filespec, format)
-    else:
+    if count != 0:
         dirspec = os.path.join(dirspec, filespec)
-        filename = '%s.%06d.%s' % (filespec, count, format)
     if not os.path.exists(dirspec):
-        os.makedirs(dirspec)
-    filepath = os.path.join(dirspec, filename) if dirspec else filename
-    if verbosity >= 2:
-        print "Writing %d objects to %s" % (len(objects), filepath)
-    f = open(filepath, 'wb')
-    f.write(serialized)
-    f.close()
+        try:
+            os.makedirs(dirspec)
+        except OSError:
+            # Another --jobs worker got there first.
+            if not os.path.isdir(dirspec):
+                raise
+    if verbosity >= 2 and obj_count is not None:
+        print "Writing %d objects to chunk %d" % (obj_count, count)
+
+    if reader is not None:
+        objects = reader.chunk(metrics)
+        if metrics is not None:
+            objects = switching_objects(objects, metrics)
+    elif metrics is not None:
+        querysets = switching(querysets, metrics)
+    if format == CSV_FORMAT:
+        return write_tables(dirspec, filespec, count, querysets, compression=compression, verbosity=verbosity,
+                            metrics=metrics, progress=progress, pipeline=pipeline)
+    if reader is None:
+        if fast:
+            objects = iter_rows(querysets, use_natural_keys)
+        else:
+            objects = iter_objects(querysets)
+    first = None
+    part = max_bytes and 1 or 0
+    entries = []
+    while True:
+        filename = compressed_name(chunk_filename(filespec, count, format, part), compression)
+        filepath = os.path.join(dirspec, filename) if dirspec else filename
+        if verbosity >= 2:
+            print "Writing objects to %s" % filepath
+        raw, f = open_chunk_file(filepath, compression, pipeline)
+        f = SizeCounter(f)
+        tracker = ChunkTracker(objects, first=first, size=f if max_bytes else None, size_limit=max_bytes,
+                               progress=progress)
+        out = metrics is not None and MeteredFile(f, metrics) or f
+        try:
+            if fast:
+                write_rows(format, tracker, out, indent=indent)
+            else:
+                serialize(format, tracker, indent=indent, use_natural_keys=use_natural_keys, stream=out)
+        finally:
+            f.close()
+        if progress is not None:
+            progress.add(tracker.count % PROGRESS_STEP)
+        entry = {
+            'number': count,
+            'file': filename,
+            'format': format,
+            'compression': compression,
+            'models': tracker.models.values(),
+            'objects': tracker.count,
+            'bytes': raw.bytes,
+            'checksum': raw.checksum,
+        }
+        if part:
+            entry['part'] = part
+        entries.append(entry)
+        if tracker.next_object is None:
+            return entries
+        first = tracker.next_object
+        part += 1
+
+def write_tables(dirspec, filespec, count, querysets, compression=None, verbosity=0, metrics=None, progress=None,
+                 pipeline=False):
+    """Write chunk number count as a CSV file per table (see chunkdata.csvchunks).
+
+    Each model's file is followed by the files of its many-to-many through
+    tables, leaving out those with no rows for the chunk. Returns the
+    manifest entries of the files written.
+    """
+    entries = []
+    for qs in querysets:
+        for model, table_qs in table_querysets(qs):
+            filename = compressed_name(table_filename(filespec, count, model), compression)
+            filepath = os.path.join(dirspec, filename)
+            if verbosity >= 2:
+                print "Writing objects to %s" % filepath
+            raw, f = open_chunk_file(filepath, compression, pipeline)
+            out = metrics is not None and MeteredFile(f, metrics) or f
+            try:
+                rows, pk_range = write_table(out, model, table_qs)
+            finally:
+                f.close()
+            if model is not qs.model:
+                if not rows:
+                    os.remove(filepath)
+                    continue
+            elif progress is not None:
+                progress.add(rows)
+            label = smart_unicode(model._meta)
+            entries.append({
+                'number': count,
+                'file': filename,
+                'format': CSV_FORMAT,
+                'compression': compression,
+                'models': [{'model': label, 'objects': rows, 'pk_range': pk_range}],
+                'objects': rows,
+                'bytes': raw.bytes,
+                'checksum': raw.checksum,
+            })
+    return entries
+
+def open_chunk_file(filepath, compression=None, pipeline=False):
+    """Open a chunk file for writing, returning its ChecksumFile and the file object to write to.
+
+    With pipeline what is written is compressed and written to disk by a
+    BackgroundWriter thread, which also fsyncs the file when it is closed.
+    """
+    if not pipeline:
+        raw = ChecksumFile(open(filepath, 'wb'))
+        return raw, compress(raw, compression)
+    raw = ChecksumFile(SyncedFile(open(filepath, 'wb')))
+    return raw, BackgroundWriter(compress(raw, compression))
+
+def chunk_filename(filespec, count, format, part=0):
+    if count == 0:
+        return '%s.%s' % (filespec, format)
+    if part:
+        return '%s.%06d.%04d.%s' % (filespec, count, part, format)
+    return '%s.%06d.%s' % (filespec, count, format)
+
+class SizeCounter(object):
+    """Write-through file wrapper that counts the bytes written to fileobj."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+class ChunkTracker(object):
+    """Iterator wrapper that counts the objects passing through it.
+
+    Objects are also counted per model, along with the range of primary keys
+    seen for each, for the chunk's manifest entry. Given a size, a file with
+    a bytes attribute, iteration stops once size.bytes reaches size_limit;
+    the next object (None if there are no more) is kept in next_object so
+    that the following file can start with it. A progress is told about the
+    objects every PROGRESS_STEP of them.
+    """
+
+    def __init__(self, iterable, first=None, size=None, size_limit=None, progress=None):
+        self.iterable = iter(iterable)
+        self.first = first
+        self.size = size
+        self.size_limit = size_limit
+        self.progress = progress
+        self.next_object = None
+        self.count = 0
+        self.models = SortedDict()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.first is not None:
+            obj, self.first = self.first, None
+        else:
+            if self.size is not None and self.count and self.size.bytes >= self.size_limit:
+                for self.next_object in self.iterable:
+                    break
+                raise StopIteration
+            obj = self.iterable.next()
+        self.count += 1
+        if self.progress is not None and not self.count % PROGRESS_STEP:
+            self.progress.add(PROGRESS_STEP)
+        if isinstance(obj, dict):
+            # A row serialized by --fast
+            label, pk = obj['model'], obj['pk']
+        else:
+            label, pk = smart_unicode(obj._meta), obj._get_pk_val()
+        stats = self.models.get(label)
+        if stats is None:
+            self.models[label] = {'model': label, 'objects': 1, 'pk_range': [pk, pk]}
+        else:
+            stats['objects'] += 1
+            pk_range = stats['pk_range']
+            if pk < pk_range[0]:
+                pk_range[0] = pk
+            elif pk > pk_range[1]:
+                pk_range[1] = pk
+        return obj
+
+def get_model_dependencies(model, all_relations=False):
+    """Return the models whose objects must exist before model's can be loaded.
+
+    By default these are the natural key dependencies that serialization order
+    has to respect: explicit natural_key.dependencies plus any FK or M2M
+    relation to a model that defines a natural key. With all_relations every
+    FK and M2M target counts, which is what loading into a database that
+    enforces foreign keys needs.
+    """
+    # Add any explicitly defined dependencies
+    if hasattr(model, 'natural_key'):
+        deps = [get_model(*d.split('.')) for d in getattr(model.natural_key, 'dependencies', [])]
+    else:
+        deps = []
+
+    # Now add a dependency for any FK or M2M relation with
+    # a model that defines a natural key
+    for field in model._meta.fields:
+        if hasattr(field.rel, 'to'):
+            rel_model = field.rel.to
+            if all_relations or hasattr(rel_model, 'natural_key'):
+                deps.append(rel_model)
+    for field in model._meta.many_to_many:
+        rel_model = field.rel.to
+        if all_relations or hasattr(rel_model, 'natural_key'):
+            deps.append(rel_model)
+    return deps
 
 def sort_dependencies(app_list, verbosity=0):
     """Sort a list of app,modellist pairs into a single list of models.
@@ -252,26 +933,7 @@ def sort_dependencies(app_list, verbosity=0):
 
         for model in model_list:
             models.add(model)
-            # Add any explicitly defined dependencies
-            if hasattr(model, 'natural_key'):
-                deps = getattr(model.natural_key, 'dependencies', [])
-                if deps:
-                    deps = [get_model(*d.split('.')) for d in deps]
-            else:
-                deps = []
-
-            # Now add a dependency for any FK or M2M relation with
-            # a model that defines a natural key
-            for field in model._meta.fields:
-                if hasattr(field.rel, 'to'):
-                    rel_model = field.rel.to
-                    if hasattr(rel_model, 'natural_key'):
-                        deps.append(rel_model)
-            for field in model._meta.many_to_many:
-                rel_model = field.rel.to
-                if hasattr(rel_model, 'natural_key'):
-                    deps.append(rel_model)
-            model_dependencies.append((model, deps))
+            model_dependencies.append((model, get_model_dependencies(model)))
 
     model_dependencies.reverse()
     # Now sort the models to ensure that dependencies are met. This
@@ -1,15 +1,31 @@
 import os
+import sys
 from optparse import make_option
+from xml.dom import pulldom
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.core import management, serializers
 
-try:
-    from django.db import DEFAULT_DB_ALIAS
-except ImportError:
-    DEFAULT_DB_ALIAS = None
-from django.db.models import get_apps
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_apps, get_model
+from django.utils.encoding import smart_unicode
+
+from chunkdata.compression import open_for_reading, split_compression
+from chunkdata.constraints import create_indexes, defer_constraints, drop_indexes, restore_constraints
+from chunkdata.discovery import FixtureIndex
+from chunkdata.columnar import read_blocks
+from chunkdata.csvchunks import CSV_FORMAT, import_table, table_model
+from chunkdata.jsonstream import JSONArrayReader, iter_json_lines, parse_parallel
+from chunkdata.ledger import forget_chunks, has_ledger, is_loaded, loaded_chunks, record_chunk
+from chunkdata.loader import BulkLoader, delete_rows, reset_sequences
+from chunkdata.metrics import ChunkMetrics, MeteredFile, RunMetrics, describe, has_receivers, watch_queries
+from chunkdata.manifest import ManifestError, manifest_path, read_manifest, verify_chunk
+from chunkdata.models import LoadedChunk
+from chunkdata.progress import DEFAULT_INTERVAL, Progress
+from chunkdata.naturalkeys import DEFAULT_SIZE, NaturalKeyCache
+from chunkdata.management.commands.dumpchunks import is_process_local
+from chunkdata.scheduler import chunk_dependencies, run_scheduled, WorkerError
 
 class MultipleFixturesFoundError(Exception):
     pass
@@ -18,16 +34,124 @@ class Command(BaseCommand):
     help = 'Installs the named fixture(s) in the database.'
     args = "fixture [fixture ...]"
 
-    option_list = BaseCommand.option_list
-    if DEFAULT_DB_ALIAS:
-        option_list = option_list + (
-            make_option('--database', action='store', dest='database',
-                default=DEFAULT_DB_ALIAS, help='Nominates a specific database to load '
-                    'fixtures into. Defaults to the "default" database.'),
-        )
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--bulk', action='store_true', dest='bulk', default=False,
+            help='Insert the objects of chunked fixtures in batches with executemany instead of saving them one '
+                 'at a time. Models with save signal receivers or order_with_respect_to are still saved singly.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Maximum number of objects per insert batch with --bulk. Defaults to 1000.'),
+        make_option('-d', '--delta', action='store_true', dest='delta', default=False,
+            help='Apply the chunks on top of the existing data: objects are upserted in batches, matched by natural '
+                 'key for models that have one and by primary key otherwise, and the objects listed in the '
+                 "manifest's deletions are deleted. Implies --bulk."),
+        make_option('--key-cache', dest='key_cache_size', type='int', default=DEFAULT_SIZE,
+            help='Remember the primary keys of up to this many natural keys across the chunks of a --bulk or '
+                 '--delta load. Defaults to %d.' % DEFAULT_SIZE),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+            help='Skip the chunks that an earlier, interrupted load of the same fixture committed.'),
+        make_option('--verify', action='store_true', dest='verify', default=False,
+            help="Check every chunk's size and checksum against the chunk set's manifest before loading."),
+        make_option('-j', '--jobs', dest='jobs', type='int', default=1,
+            help='Load chunks from this many worker processes, each in its own transaction. A chunk is '
+                 'only loaded once the chunks of every model it refers to have been loaded.'),
+        make_option('--single-transaction', action='store_true', dest='single_transaction', default=False,
+            help='Load every chunk and fixture in one transaction, committed at the end.'),
+        make_option('--commit-every', dest='commit_every', type='int', default=1,
+            help='Commit once every N chunks instead of after each chunk. Chunks are recorded in the ledger '
+                 'in the same transactions.'),
+        make_option('--defer-constraints', action='store_true', dest='defer_constraints', default=False,
+            help='Postpone foreign key checks until each chunk\'s transaction (or the --commit-every or '
+                 '--single-transaction one) commits on SQLite, or until the load is done on MySQL. On '
+                 'PostgreSQL this only changes deferrable constraints that aren\'t initially deferred; Django '
+                 'creates its own as DEFERRABLE INITIALLY DEFERRED already.'),
+        make_option('--drop-indexes', action='store_true', dest='drop_indexes', default=False,
+            help='Drop the db_index indexes of the models in a chunk set before loading it and create them '
+                 'again afterwards. On SQLite and MySQL this commits the open transaction.'),
+        make_option('--progress', action='store_true', dest='progress', default=False,
+            help='Report the objects loaded out of the total (chunks, for chunk sets without a manifest), the '
+                 'rate and the time left on stderr.'),
+        make_option('--progress-interval', dest='progress_interval', type='float', default=DEFAULT_INTERVAL,
+            help='Seconds between progress reports. Defaults to %d.' % DEFAULT_INTERVAL),
+        make_option('--metrics-file', dest='metrics_file',
+            help='Time the load of every chunk and write the figures, per chunk and per model, to this file '
+                 'as JSON.'),
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a specific database to load '
+                'fixtures into. Defaults to the "default" database.'),
+    )
 
     def handle(self, *fixture_labels, **options):
+        """Load the fixtures, committing after each chunk or in the transactions the options ask for.
+
+        Grouped transactions pass commit=False down to loaddata and the chunk
+        loaders, which then leave committing to load_labels.
+        """
+        using = options.get('database', DEFAULT_DB_ALIAS)
+        if options.get('single_transaction'):
+            self.commit_every = 0
+        else:
+            self.commit_every = options.get('commit_every', None) or 1
+        grouped = self.commit_every != 1
+        if grouped and (options.get('jobs', None) or 1) > 1:
+            raise CommandError("--jobs can't be combined with --single-transaction or --commit-every: "
+                               "every worker has its own transaction.")
+        self.defer = options.get('defer_constraints', False)
+        self.chunk_count = 0
+        self.metrics = None
+        if options.get('metrics_file') or has_receivers() or int(options.get('verbosity', 1)) >= 2:
+            self.metrics = RunMetrics(Command, options.get('metrics_file'), command='loadchunks',
+                                      fixtures=list(fixture_labels), database=using)
+            options = dict(options, measure=True)
+
+        if grouped:
+            transaction.commit_unless_managed(using=using)
+            transaction.enter_transaction_management(using=using)
+            transaction.managed(True, using=using)
+            options = dict(options, commit=False)
+        try:
+            try:
+                if grouped and self.defer:
+                    # Ungrouped chunks defer in their own transactions.
+                    defer_constraints(connections[using])
+                self.load_labels(fixture_labels, options)
+                if grouped:
+                    transaction.commit(using=using)
+                if self.metrics is not None:
+                    self.metrics.finish()
+            except:
+                if grouped:
+                    transaction.rollback(using=using)
+                raise
+        finally:
+            if grouped:
+                transaction.leave_transaction_management(using=using)
+            if self.defer:
+                restore_constraints(connections[using])
+
+    def chunk_finished(self, path, metrics, progress=None, weight=1, verbosity=1):
+        """Report a chunk loaded here or by a worker, with the metrics load_chunk returned for it."""
+        if self.metrics is not None:
+            if verbosity >= 2:
+                print "Loaded %s: %s" % (path, describe(metrics))
+            self.metrics.add(metrics)
+        if progress is not None:
+            progress.add(weight)
+
+    def chunk_loaded(self, using):
+        self.chunk_count += 1
+        if self.commit_every > 1 and self.chunk_count % self.commit_every == 0:
+            transaction.commit(using=using)
+            if self.defer:
+                defer_constraints(connections[using])
+
+    def load_labels(self, fixture_labels, options):
         formats = serializers.get_public_serializer_formats()
+        # Chunk directories can also hold CSV files, which loaddata can't read.
+        chunk_formats = formats + [CSV_FORMAT]
+        jobs = options.get('jobs', None) or 1
+        using = options.get('database', DEFAULT_DB_ALIAS)
+        verbosity = int(options.get('verbosity', 1))
+        key_cache = NaturalKeyCache(options.get('key_cache_size', None))
         app_module_paths = []
         for app in get_apps():
             if hasattr(app, '__path__'):
@@ -39,23 +163,32 @@ class Command(BaseCommand):
                 app_module_paths.append(app.__file__)
 
         app_fixtures = [os.path.join(os.path.dirname(path), 'fixtures') for path in app_module_paths]
+        index = FixtureIndex(app_fixtures + list(settings.FIXTURE_DIRS) + [''])
 
         for fixture_label in fixture_labels:
             if os.path.isabs(fixture_label):
-                management.call_command('loaddata', *[fixture_label], **options)
+                call_loaddata([fixture_label], options)
+                continue
             else:
-                fixture_dirs = app_fixtures + list(settings.FIXTURE_DIRS) + ['']
-                fixture_dirs.sort()
                 label_fixtures = []
+                label_manifest = None
                 found_in_fix_dir = ''
                 try:
-                    for fixture_dir in fixture_dirs:
+                    for fixture_dir in index.fixture_dirs:
                         filepath = os.path.join(fixture_dir, fixture_label)
-                        if os.path.exists(filepath):
-                            if os.path.isdir(filepath):
-                                for item in os.listdir(filepath):
-                                    item_ext = os.path.splitext(item)[1]
-                                    if item_ext and item_ext[1:] in formats:
+                        manifest_file = manifest_path(os.path.dirname(filepath), os.path.basename(filepath))
+                        if index.isdir(filepath) and index.exists(manifest_file):
+                            # The manifest lists the chunks in load order
+                            if found_in_fix_dir and found_in_fix_dir != fixture_dir:
+                                raise MultipleFixturesFoundError("Found multiple files for %s\n" % fixture_label)
+                            label_manifest = read_manifest(manifest_file)
+                            label_fixtures = [os.path.join(filepath, c['file']) for c in label_manifest['chunks']]
+                            found_in_fix_dir = fixture_dir
+                        elif index.exists(filepath):
+                            if index.isdir(filepath):
+                                for item in index.listdir(filepath):
+                                    item_ext = os.path.splitext(split_compression(item)[0])[1]
+                                    if item_ext and item_ext[1:] in chunk_formats:
                                         if fixture_label.split('/')[-1] in [item, item.split('.')[0]]:
                                             if found_in_fix_dir and found_in_fix_dir != fixture_dir:
                                                 raise MultipleFixturesFoundError(
@@ -68,9 +201,367 @@ class Command(BaseCommand):
                         raise err
                     else:
                         raise CommandError("%s" % err)
+                except ManifestError, err:
+                    raise CommandError("%s" % err)
+
+            if len(label_fixtures) or label_manifest:
+                if label_manifest:
+                    chunk_dir = os.path.join(found_in_fix_dir, fixture_label)
+                    if options.get('verify'):
+                        try:
+                            for chunk in label_manifest['chunks']:
+                                verify_chunk(chunk_dir, chunk)
+                        except ManifestError, err:
+                            raise CommandError("%s" % err)
+                    chunks = [(os.path.join(chunk_dir, chunk['file']),
+                               set(get_model(*m['model'].split('.')) for m in chunk['models']))
+                              for chunk in label_manifest['chunks']]
+                    checksums = dict((os.path.join(chunk_dir, chunk['file']), chunk['checksum'])
+                                     for chunk in label_manifest['chunks'])
+                    chunk_counts = dict((os.path.join(chunk_dir, chunk['file']), chunk['models'])
+                                        for chunk in label_manifest['chunks'])
+                    weights = dict((os.path.join(chunk_dir, chunk['file']), chunk['objects'])
+                                   for chunk in label_manifest['chunks'])
+                else:
+                    label_fixtures.sort()
+                    chunks = None
+                    checksums = {}
+                    chunk_counts = {}
+                    # Without a manifest progress is counted in chunks.
+                    weights = {}
+                total = sum([weights.get(path, 1) for path in label_fixtures])
+
+                chunk_options = dict(options, ledger=None, key_cache=key_cache)
+                if options.get('measure'):
+                    chunk_options['chunk_counts'] = chunk_counts
+                if has_ledger(using):
+                    if options.get('resume'):
+                        loaded = loaded_chunks(using, fixture_label)
+                        remaining = [path for path in label_fixtures if not is_loaded(loaded, path, checksums.get(path))]
+                        if int(options.get('verbosity', 1)) > 0 and len(remaining) < len(label_fixtures):
+                            print "Skipping %d chunk(s) of %s loaded before" % (
+                                len(label_fixtures) - len(remaining), fixture_label)
+                        label_fixtures = remaining
+                        if chunks:
+                            chunks = [(path, models) for path, models in chunks if path in remaining]
+                    else:
+                        forget_chunks(using, fixture_label)
+                        transaction.commit_unless_managed(using=using)
+                    chunk_options.update(ledger=fixture_label, checksums=checksums)
+                elif options.get('resume'):
+                    raise CommandError("Can't resume: the %s table doesn't exist in the %s database. Run syncdb "
+                                       "to create it." % (LoadedChunk._meta.db_table, using))
+
+                progress = None
+                if options.get('progress'):
+                    progress = Progress(fixture_label, total, label_manifest and 'objects' or 'chunks',
+                                        done=total - sum([weights.get(path, 1) for path in label_fixtures]),
+                                        interval=options.get('progress_interval', DEFAULT_INTERVAL))
+                finished = lambda path, metrics: self.chunk_finished(path, metrics, progress, weights.get(path, 1),
+                                                                     verbosity)
 
-            if len(label_fixtures):
-                for label_fixture in label_fixtures:
-                    management.call_command('loaddata', label_fixture, **options)
+                dropped = []
+                if options.get('drop_indexes'):
+                    models = set()
+                    for path, chunk_model_set in chunks or [(path, chunk_models(path)) for path in label_fixtures]:
+                        models.update(chunk_model_set)
+                    dropped = drop_indexes(connections[using], models)
+                    if int(options.get('verbosity', 1)) > 0 and dropped:
+                        print "Dropped %d index(es) for %s" % (len(dropped), fixture_label)
+                try:
+                    if jobs > 1 and len(label_fixtures) > 1 and not is_process_local(connections[using]):
+                        try:
+                            load_parallel(chunks or [(path, chunk_models(path)) for path in label_fixtures],
+                                          chunk_options, jobs, using, finished)
+                        except WorkerError, err:
+                            if options.get('traceback'):
+                                raise
+                            raise CommandError("%s" % err)
+                    else:
+                        # Big jsonl chunks can still be decoded in parallel.
+                        chunk_options['parse_jobs'] = jobs
+                        for label_fixture in label_fixtures:
+                            finished(label_fixture, load_chunk(label_fixture, chunk_options))
+                            self.chunk_loaded(using)
+                finally:
+                    if dropped:
+                        create_indexes(connections[using], dropped)
+                        transaction.commit_unless_managed(using=using)
+                if progress is not None:
+                    progress.finish()
+                if options.get('delta') and label_manifest and label_manifest.get('deletions'):
+                    apply_deletions(label_manifest, options)
+                    key_cache.clear()
             else:
-                management.call_command('loaddata', fixture_label, **options)
\ No newline at end of file
+                # Saves loaddata searching every fixture directory again.
+                call_loaddata(index.fixture_files(fixture_label, formats, using) or [fixture_label], options)
+
+def fixture_format(path):
+    return os.path.splitext(split_compression(path)[0])[1][1:]
+
+def load_chunk(path, options):
+    """Load one chunk file, returning its metrics if the options ask to measure and None otherwise.
+
+    Chunks loaded by loaddata are only timed as a whole; their object counts
+    come from the manifest.
+    """
+    metrics = None
+    if options.get('measure'):
+        metrics = ChunkMetrics(io='read', work='parse')
+        unwatch = watch_queries(connections[options.get('database', DEFAULT_DB_ALIAS)], metrics)
+    try:
+        # loaddata reads gzip and bz2 fixtures itself but not xz ones, nor CSV
+        if options.get('bulk') or options.get('delta') or split_compression(path)[1] not in (None, 'gzip', 'bz2') \
+                or fixture_format(path) == CSV_FORMAT:
+            bulk_load_chunk(path, options, metrics)
+        else:
+            if metrics is not None:
+                for stats in options.get('chunk_counts', {}).get(path, []):
+                    metrics.count(stats['model'], stats['objects'])
+            if options.get('ledger') or options.get('defer_constraints'):
+                loaddata_chunk(path, options)
+            else:
+                call_loaddata([path], options)
+    finally:
+        if metrics is not None:
+            unwatch()
+    if metrics is not None:
+        return metrics.finish(file=path, file_bytes=os.path.getsize(path))
+
+def call_loaddata(labels, options):
+    """Run loaddata, raising CommandError on problems it reports when it doesn't commit itself.
+
+    loaddata catches its own errors and returns, so they can only be told
+    from its stderr option (new in Django 1.3), which it writes nothing but
+    errors to. Python's warnings go to sys.stderr and aren't counted.
+    """
+    if options.get('commit', True):
+        management.call_command('loaddata', *labels, **options)
+        return
+    stderr = ErrorRecorder(options.get('stderr', sys.stderr))
+    management.call_command('loaddata', *labels, **dict(options, stderr=stderr))
+    if stderr.written:
+        raise CommandError("Problem installing %s" % ', '.join(labels))
+
+class ErrorRecorder(object):
+    """Passes writes through to stream, noting whether there were any."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.written = False
+
+    def write(self, data):
+        self.written = True
+        self.stream.write(data)
+
+def loaddata_chunk(path, options):
+    """Load one chunk file with loaddata and record it in the ledger, if there is one, in one transaction.
+
+    loaddata reports problems on stderr instead of raising them, so anything
+    it writes there rolls the chunk back. With commit=False the chunk joins the
+    caller's transaction and problems are raised.
+    """
+    using = options.get('database', DEFAULT_DB_ALIAS)
+    if not options.get('commit', True):
+        call_loaddata([path], options)
+        if options.get('ledger'):
+            record_chunk(using, options['ledger'], path, options.get('checksums', {}).get(path))
+        return
+    stderr = ErrorRecorder(options.get('stderr', sys.stderr))
+
+    transaction.commit_unless_managed(using=using)
+    transaction.enter_transaction_management(using=using)
+    transaction.managed(True, using=using)
+    try:
+        try:
+            if options.get('defer_constraints'):
+                # Each commit ends the deferral.
+                defer_constraints(connections[using])
+            management.call_command('loaddata', path, **dict(options, commit=False, stderr=stderr))
+            if stderr.written:
+                transaction.rollback(using=using)
+                return
+            if options.get('ledger'):
+                record_chunk(using, options['ledger'], path, options.get('checksums', {}).get(path))
+        except:
+            transaction.rollback(using=using)
+            raise
+        transaction.commit(using=using)
+    finally:
+        transaction.leave_transaction_management(using=using)
+
+def bulk_load_chunk(path, options, metrics=None):
+    """Load one chunk file with a BulkLoader, in its own transaction like loaddata.
+
+    With commit=False the chunk joins the caller's transaction instead.
+    metrics, a ChunkMetrics, is charged with the reads and each model's saves.
+    An uncompressed jsonl chunk is decoded by parse_jobs processes if the
+    options give more than one. A CSV chunk is handed to the database's own
+    bulk import (see chunkdata.csvchunks).
+    """
+    using = options.get('database', DEFAULT_DB_ALIAS)
+    verbosity = int(options.get('verbosity', 1))
+    commit = options.get('commit', True)
+    format = fixture_format(path)
+    if format == CSV_FORMAT and options.get('delta'):
+        raise CommandError("CSV chunks can't be applied with --delta: %s" % path)
+    key_cache = options.get('key_cache', None)
+    loader = BulkLoader(using, batch_size=options.get('batch_size', None) or 1000,
+                        match_natural_keys=options.get('delta', False), key_cache=key_cache, metrics=metrics)
+
+    if commit:
+        transaction.commit_unless_managed(using=using)
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+    fixture = open_for_reading(path)
+    if metrics is not None:
+        fixture = MeteredFile(fixture, metrics)
+    try:
+        try:
+            if commit and options.get('defer_constraints'):
+                # Each commit ends the deferral.
+                defer_constraints(connections[using])
+            if format == CSV_FORMAT:
+                count, models = import_csv_chunk(path, fixture, using, loader.batch_size, metrics)
+            else:
+                if format == 'jsonl' and options.get('parse_jobs', 1) > 1 and not split_compression(path)[1]:
+                    loader.load_data(parse_parallel(path, options['parse_jobs']))
+                else:
+                    loader.load_fixture(format, fixture)
+                count, models = loader.count, loader.models
+            if count:
+                reset_sequences(connections[using], models)
+            if options.get('ledger'):
+                record_chunk(using, options['ledger'], path, options.get('checksums', {}).get(path))
+        except (SystemExit, KeyboardInterrupt):
+            if commit:
+                transaction.rollback(using=using)
+            raise
+        except Exception, e:
+            if commit:
+                transaction.rollback(using=using)
+            if key_cache is not None:
+                # It may hold keys of rows that were just rolled back.
+                key_cache.clear()
+            if options.get('traceback'):
+                raise
+            raise CommandError("Problem installing fixture '%s': %s" % (path, e))
+        if commit:
+            transaction.commit(using=using)
+    finally:
+        if commit:
+            transaction.leave_transaction_management(using=using)
+        fixture.close()
+    if verbosity > 0:
+        print "Installed %d object(s) from %s" % (count, path)
+
+def import_csv_chunk(path, fixture, using, batch_size, metrics=None):
+    """Import the rows of a CSV chunk into its model's table, returning the row count and [model]."""
+    model = table_model(path)
+    if model is None:
+        raise CommandError("No model for the CSV file %s" % path)
+    label = smart_unicode(model._meta)
+    if metrics is not None:
+        metrics.switch(label)
+    try:
+        count = import_table(connections[using], model, fixture, path, batch_size)
+    finally:
+        if metrics is not None:
+            metrics.switch(None)
+    if metrics is not None:
+        metrics.count(label, count)
+    return count, [model]
+
+def apply_deletions(manifest, options):
+    """Delete the objects listed in a manifest's deletions, in one transaction.
+
+    deletions maps model labels to lists of primary keys (or natural keys,
+    given as lists). Models are handled in reverse dump order, so objects go
+    before the objects they refer to. With commit=False the deletions join the
+    caller's transaction.
+    """
+    using = options.get('database', DEFAULT_DB_ALIAS)
+    verbosity = int(options.get('verbosity', 1))
+    commit = options.get('commit', True)
+    deletions = manifest['deletions']
+    labels = [label for label in reversed(manifest['models']) if label in deletions]
+    labels += [label for label in deletions if label not in labels]
+    deleted = 0
+
+    if commit:
+        transaction.commit_unless_managed(using=using)
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+    try:
+        try:
+            for label in labels:
+                model = get_model(*label.split('.'))
+                if model is None:
+                    raise CommandError("Unknown model in deletions: %s" % label)
+                deleted += delete_rows(using, model, deletions[label])
+        except (SystemExit, KeyboardInterrupt):
+            if commit:
+                transaction.rollback(using=using)
+            raise
+        except Exception, e:
+            if commit:
+                transaction.rollback(using=using)
+            if options.get('traceback') or isinstance(e, CommandError):
+                raise
+            raise CommandError("Problem deleting objects listed in %s: %s" % (manifest['name'], e))
+        if commit:
+            transaction.commit(using=using)
+    finally:
+        if commit:
+            transaction.leave_transaction_management(using=using)
+    if verbosity > 0:
+        print "Deleted %d object(s) listed in %s" % (deleted, manifest['name'])
+
+def load_parallel(chunks, options, jobs, using, callback=None):
+    """Load chunk files from a pool of worker processes in dependency order.
+
+    chunks is a list of (path, models) pairs in load order. Every worker opens
+    its own connection, so the parent's is closed before the pool is forked.
+    Concurrent loads of one model can leave its sequence behind the highest
+    key loaded, so sequences are reset once all chunks are in. callback is
+    called with each chunk's path and load_chunk's result as it finishes.
+    """
+    connections[using].close()
+    run_scheduled([path for path, models in chunks], chunk_dependencies(chunks), load_chunk, (options,), jobs,
+                  callback)
+
+    models = set()
+    for path, chunk_model_set in chunks:
+        models.update(chunk_model_set)
+    reset_sequences(connections[using], models)
+    transaction.commit_unless_managed(using=using)
+
+def chunk_models(path):
+    """Return the set of models that have objects in a fixture file.
+
+    Objects are read as plain data, without instantiating models or resolving
+    natural keys, since the objects they refer to may not be loaded yet.
+    """
+    format = fixture_format(path)
+    if format == CSV_FORMAT:
+        return set([table_model(path)])
+    f = open_for_reading(path)
+    try:
+        if format == 'json':
+            labels = set(obj['model'] for obj in JSONArrayReader(f))
+        elif format == 'jsonl':
+            labels = set(obj['model'] for obj in iter_json_lines(f))
+        elif format == 'columnar':
+            labels = set(header['model'] for header, columns in read_blocks(f, decode=False))
+        elif format == 'yaml':
+            import yaml
+            labels = set(obj['model'] for obj in yaml.safe_load(f))
+        elif format == 'xml':
+            labels = set(node.getAttribute('model') for event, node in pulldom.parse(f)
+                         if event == pulldom.START_ELEMENT and node.nodeName == 'object')
+        else:
+            labels = set('%s.%s' % (obj.object._meta.app_label, obj.object._meta.object_name)
+                         for obj in serializers.deserialize(format, f))
+    finally:
+        f.close()
+    return set(get_model(*label.split('.')) for label in labels)
@@ -0,0 +1,121 @@
+"""
+Chunk manifests.
+
+dumpchunks writes a manifest next to the directory of chunk files it creates,
+named ``<filespec>.manifest``. It is a JSON document describing the whole chunk
+set: the serialization format and compression, every dumped model in
+dependency order, and for each chunk file (in load order) the models it holds
+with their object counts and primary key ranges, its total object count, its
+size on disk and a checksum. loadchunks uses it to find and plan the chunks
+without listing the directory or parsing any fixture.
+
+The manifest also records a high-water mark for every model, the highest
+primary key (or value of a configured modification-time field) seen when the
+dump started. ``dumpchunks --incremental`` dumps only the rows beyond the
+marks of the newest manifest as a delta chunk set, ``<filespec>-delta-<n>``,
+with a manifest of its own. With ``--deletions`` the manifest also keeps the
+primary keys of every model as runs, ``keys``, and a delta lists the keys
+missing since the previous dump under ``deletions``.
+"""
+import hashlib
+import os
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
+from django.utils.encoding import smart_unicode
+
+MANIFEST_VERSION = 1
+MANIFEST_EXTENSION = 'manifest'
+
+class ManifestError(Exception):
+    pass
+
+class ChecksumFile(object):
+    """Write-through file wrapper that counts and checksums the bytes written to fileobj."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha1()
+        self.bytes = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.bytes += len(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+    @property
+    def checksum(self):
+        return 'sha1:%s' % self.hash.hexdigest()
+
+def file_checksum(path):
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        for block in iter(lambda: f.read(1 << 16), ''):
+            digest.update(block)
+    finally:
+        f.close()
+    return 'sha1:%s' % digest.hexdigest()
+
+def manifest_path(directory, name):
+    """Return the path of the manifest for the chunk set name kept in directory/name/."""
+    return os.path.join(directory, '%s.%s' % (name, MANIFEST_EXTENSION))
+
+def delta_name(name, number):
+    return '%s-delta-%d' % (name, number)
+
+def latest_manifest(directory, name):
+    """Return the path of the newest manifest of name and its delta sets, or None if it was never dumped."""
+    path = manifest_path(directory, name)
+    if not os.path.exists(path):
+        return None
+    number = 1
+    while os.path.exists(manifest_path(directory, delta_name(name, number))):
+        path = manifest_path(directory, delta_name(name, number))
+        number += 1
+    return path
+
+def manifest_value(value):
+    """Return a field value as it is kept in a manifest.
+
+    Numbers are kept as they are, anything else (dates, decimals) as text
+    that a lookup on the field accepts back without losing precision.
+    """
+    if value is None or isinstance(value, (int, long, float)):
+        return value
+    return smart_unicode(value)
+
+def write_manifest(path, manifest):
+    """Write a manifest, replacing any previous one only once it is complete."""
+    manifest = dict(manifest, version=MANIFEST_VERSION)
+    tmp_path = '%s.tmp' % path
+    f = open(tmp_path, 'wb')
+    try:
+        simplejson.dump(manifest, f, cls=DjangoJSONEncoder, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+def read_manifest(path):
+    f = open(path, 'rb')
+    try:
+        manifest = simplejson.load(f)
+    finally:
+        f.close()
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ManifestError("Unsupported manifest version in %s: %s" % (path, manifest.get('version')))
+    return manifest
+
+def verify_chunk(directory, chunk):
+    """Raise ManifestError unless a chunk file's size and checksum match its manifest entry."""
+    path = os.path.join(directory, chunk['file'])
+    if not os.path.exists(path):
+        raise ManifestError("Missing chunk file %s" % path)
+    if os.path.getsize(path) != chunk['bytes'] or file_checksum(path) != chunk['checksum']:
+        raise ManifestError("Chunk file %s does not match its manifest" % path)
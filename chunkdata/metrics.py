@@ -0,0 +1,251 @@
+"""
+Instrumentation of dumps and loads.
+
+When asked for metrics, dumpchunks and loadchunks time every chunk they
+write or load: the time spent in database queries, in writing or reading the
+file and, what is left of it, in serializing or parsing, along with the
+number of objects, bytes and queries, in total and per model.
+
+Each chunk's figures are sent with chunk_measured as soon as the chunk is
+done, and the report of the whole run with run_measured; both are sent from
+the main process, even with --jobs, and by the command's class. The report
+is also what --metrics-file holds. Connecting a receiver turns measuring on:
+
+    from chunkdata.metrics import chunk_measured
+
+    def ship(sender, metrics, **kwargs):
+        statsd.timing('chunks.query', metrics['query_seconds'])
+    chunk_measured.connect(ship)
+"""
+import datetime
+import time
+
+from django.dispatch import Signal
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+from django.utils.encoding import smart_unicode
+
+chunk_measured = Signal(providing_args=['metrics'])
+run_measured = Signal(providing_args=['report'])
+
+FIGURES = ('objects', 'bytes', 'queries', 'query_seconds', 'io_seconds', 'seconds')
+
+def has_receivers():
+    return bool(chunk_measured.receivers or run_measured.receivers)
+
+def new_figures():
+    return dict((name, 0) for name in FIGURES)
+
+class ChunkMetrics(object):
+    """The figures of one chunk, in total and per model.
+
+    Everything measured between switch(label) and the next switch is charged
+    to that model as well as to the total. io names what file time is spent
+    on and work what the rest of the time goes to, 'write' and 'serialize'
+    for dumps.
+    """
+
+    def __init__(self, io='write', work='serialize'):
+        self.io = io
+        self.work = work
+        self.total = new_figures()
+        self.models = SortedDict()
+        self.model = None
+        self.started = self.switched = time.time()
+
+    def switch(self, label):
+        """Charge what follows to the model label, or to no model if it's None."""
+        now = time.time()
+        if self.model is not None:
+            self.model['seconds'] += now - self.switched
+        self.switched = now
+        self.model = label is not None and self.figures_for(label) or None
+
+    def figures_for(self, label):
+        if label not in self.models:
+            self.models[label] = new_figures()
+        return self.models[label]
+
+    def add(self, name, value):
+        self.total[name] += value
+        if self.model is not None:
+            self.model[name] += value
+
+    def count(self, label, objects):
+        self.total['objects'] += objects
+        self.figures_for(label)['objects'] += objects
+
+    def finish(self, **info):
+        """Return the figures as a dict, along with info."""
+        self.switch(None)
+        self.total['seconds'] = time.time() - self.started
+        result = dict(info)
+        result.update(self.derive(self.total))
+        result['models'] = dict((label, self.derive(figures)) for label, figures in self.models.items())
+        return result
+
+    def derive(self, figures):
+        result = dict(figures)
+        io_seconds = result.pop('io_seconds')
+        result['%s_seconds' % self.io] = io_seconds
+        result['%s_seconds' % self.work] = max(0, figures['seconds'] - figures['query_seconds'] - io_seconds)
+        for name, value in result.items():
+            if isinstance(value, float):
+                result[name] = round(value, 6)
+        return result
+
+def switching(querysets, metrics):
+    """Yield querysets, charging what happens until the next one to the model of each."""
+    for qs in querysets:
+        metrics.switch(smart_unicode(qs.model._meta))
+        yield qs
+
+def switching_objects(objects, metrics):
+    """Yield objects, charging what happens until one of another model comes to the model of each."""
+    label = None
+    for obj in objects:
+        if isinstance(obj, dict):
+            # A row serialized by --fast
+            current = obj['model']
+        else:
+            current = smart_unicode(obj._meta)
+        if current != label:
+            metrics.switch(current)
+            label = current
+        yield obj
+
+def watch_queries(connection, metrics):
+    """Charge the queries run on connection to metrics until the returned function is called."""
+    installed = connection.__dict__.get('cursor')
+    cursor = connection.cursor
+    connection.cursor = lambda: MeteredCursor(cursor(), metrics)
+    def unwatch():
+        if installed is None:
+            del connection.cursor
+        else:
+            connection.cursor = installed
+    return unwatch
+
+class MeteredCursor(object):
+    """Cursor wrapper that counts statements and times them and their fetches."""
+
+    def __init__(self, cursor, metrics):
+        self.cursor = cursor
+        self.metrics = metrics
+
+    def timed(self, method, args, kwargs):
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.metrics.add('query_seconds', time.time() - start)
+
+    def execute(self, *args, **kwargs):
+        self.metrics.add('queries', 1)
+        return self.timed(self.cursor.execute, args, kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.metrics.add('queries', 1)
+        return self.timed(self.cursor.executemany, args, kwargs)
+
+    def fetchone(self, *args, **kwargs):
+        return self.timed(self.cursor.fetchone, args, kwargs)
+
+    def fetchmany(self, *args, **kwargs):
+        return self.timed(self.cursor.fetchmany, args, kwargs)
+
+    def fetchall(self, *args, **kwargs):
+        return self.timed(self.cursor.fetchall, args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class MeteredFile(object):
+    """File wrapper that charges the time spent reading and writing, and the bytes, to metrics."""
+
+    def __init__(self, fileobj, metrics):
+        self.fileobj = fileobj
+        self.metrics = metrics
+
+    def write(self, data):
+        start = time.time()
+        self.fileobj.write(data)
+        self.metrics.add('io_seconds', time.time() - start)
+        self.metrics.add('bytes', len(data))
+
+    def read(self, *args):
+        start = time.time()
+        data = self.fileobj.read(*args)
+        self.metrics.add('io_seconds', time.time() - start)
+        self.metrics.add('bytes', len(data))
+        return data
+
+    def readline(self, *args):
+        start = time.time()
+        data = self.fileobj.readline(*args)
+        self.metrics.add('io_seconds', time.time() - start)
+        self.metrics.add('bytes', len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+class RunMetrics(object):
+    """Collects the chunk metrics of one run of a command into its report.
+
+    sender is the command's class, path the --metrics-file to write the
+    report to, if any, and info is added to the report as it is.
+    """
+
+    def __init__(self, sender, path=None, **info):
+        self.sender = sender
+        self.path = path
+        self.info = info
+        self.chunks = []
+        self.started = time.time()
+        self.started_at = datetime.datetime.now()
+
+    def add(self, metrics):
+        self.chunks.append(metrics)
+        chunk_measured.send(sender=self.sender, metrics=metrics)
+
+    def report(self):
+        totals = {}
+        models = {}
+        for chunk in self.chunks:
+            add_figures(totals, chunk)
+            for label, figures in chunk['models'].items():
+                add_figures(models.setdefault(label, {}), figures)
+        seconds = time.time() - self.started
+        report = dict(self.info, started=self.started_at.isoformat(), seconds=round(seconds, 6),
+                      objects=totals.get('objects', 0), totals=totals, models=models, chunks=self.chunks)
+        if seconds:
+            report['objects_per_second'] = round(report['objects'] / seconds, 1)
+        return report
+
+    def finish(self):
+        """Write the report to path, send run_measured and return the report."""
+        report = self.report()
+        if self.path:
+            f = open(self.path, 'w')
+            try:
+                simplejson.dump(report, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+        run_measured.send(sender=self.sender, report=report)
+        return report
+
+def add_figures(totals, figures):
+    for name, value in figures.items():
+        if isinstance(value, float):
+            totals[name] = round(totals.get(name, 0) + value, 6)
+        elif isinstance(value, (int, long)) and name != 'number':
+            totals[name] = totals.get(name, 0) + value
+
+def describe(metrics):
+    """Sum up a chunk's metrics in a line for verbose output."""
+    return "%d objects, %d bytes in %.2fs (%d queries, %.2fs)" % (
+        metrics['objects'], metrics['bytes'], metrics['seconds'], metrics['queries'], metrics['query_seconds'])
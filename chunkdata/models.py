@@ -0,0 +1,17 @@
+from django.db import models
+
+class LoadedChunk(models.Model):
+    """A chunk file loadchunks has committed, so that a resumed load can skip it.
+
+    The row is written in the transaction that loads the chunk.
+    """
+    fixture = models.CharField(max_length=255)
+    file = models.CharField(max_length=255)
+    checksum = models.CharField(max_length=50)
+    loaded = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('fixture', 'file'),)
+
+    def __unicode__(self):
+        return u'%s/%s' % (self.fixture, self.file)
@@ -0,0 +1,171 @@
+"""
+Natural key resolution for bulk loads.
+
+Django's deserializers call get_by_natural_key for every foreign key and
+many-to-many value given as a natural key, one query per reference. A
+NaturalKeyCache remembers the primary keys those lookups find, keeping the
+most recently used ones, so a natural key is only looked up once per load
+however many rows refer to it. For models whose natural key is just the
+values of some of their own fields, every key a chunk refers to can be
+resolved with one query on those fields.
+"""
+import itertools
+import os
+from collections import OrderedDict
+
+from django.db.models import Q
+
+from chunkdata.loader import MAX_QUERY_PARAMS
+
+DEFAULT_SIZE = 100000
+
+class FieldMarker(object):
+    def __init__(self, field):
+        self.field = field
+
+_key_fields = {}
+
+def natural_key_fields(model):
+    """Return the fields whose values make up model's natural key, in order, or None.
+
+    natural_key is called on an instance whose fields hold markers; if all it
+    returns are markers, they name the fields. Natural keys that follow
+    relations or transform the values aren't recognised.
+    """
+    if model not in _key_fields:
+        fields = None
+        obj = model()
+        for field in model._meta.local_fields:
+            if field.rel is None and not field.primary_key:
+                setattr(obj, field.attname, FieldMarker(field))
+        try:
+            key = obj.natural_key()
+            if key and all(isinstance(value, FieldMarker) for value in key):
+                fields = [value.field for value in key]
+        except Exception:
+            pass
+        _key_fields[model] = fields
+    return _key_fields[model]
+
+def hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(hashable(v) for v in value)
+    return value
+
+def normalize_key(model, key):
+    """Return key as a tuple of the values its fields would hold, so fixture and database keys compare equal."""
+    fields = natural_key_fields(model)
+    if fields and len(fields) == len(key):
+        try:
+            return tuple(field.to_python(value) for field, value in zip(fields, key))
+        except Exception:
+            pass
+    return hashable(key)
+
+class NaturalKeyCache(object):
+    """Maps (model, natural key) to primary keys, forgetting the least recently used beyond size entries.
+
+    A cache handed to worker processes arrives empty, and each worker keeps
+    its own copy for every chunk it loads.
+    """
+    _tokens = itertools.count()
+
+    def __init__(self, size=DEFAULT_SIZE, token=None):
+        self.size = size or DEFAULT_SIZE
+        self.token = token or '%d.%d' % (os.getpid(), self._tokens.next())
+        self.clear()
+
+    def __reduce__(self):
+        return process_cache, (self.token, self.size)
+
+    def clear(self):
+        # Not a SortedDict: removing a key from one takes time proportional
+        # to its size, and the cache moves a key on every hit. OrderedDict is
+        # why chunkdata needs Python 2.7.
+        self.pks = OrderedDict()
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.pks)
+
+    def get(self, model, key):
+        entry = (model, normalize_key(model, key))
+        pk = self.pks.get(entry)
+        if pk is not None:
+            # Move the entry to the most recently used end.
+            del self.pks[entry]
+            self.pks[entry] = pk
+        return pk
+
+    def set(self, model, key, pk):
+        entry = (model, normalize_key(model, key))
+        self.discard(model, pk)
+        if entry in self.pks:
+            del self.pks[entry]
+        self.pks[entry] = pk
+        self.keys[(model, pk)] = entry
+        while len(self.pks) > self.size:
+            (old_model, old_key), old_pk = self.pks.popitem(last=False)
+            self.keys.pop((old_model, old_pk), None)
+
+    def discard(self, model, pk):
+        """Forget the natural key of model's object with primary key pk."""
+        entry = self.keys.pop((model, pk), None)
+        if entry is not None:
+            self.pks.pop(entry, None)
+
+    def lookup(self, model, key, using):
+        """Return the primary key of model's object with natural key key, or None if there is none."""
+        pk = self.get(model, key)
+        if pk is None:
+            try:
+                pk = model._default_manager.db_manager(using).get_by_natural_key(*key).pk
+            except model.DoesNotExist:
+                return None
+            self.set(model, key, pk)
+        return pk
+
+    def can_resolve(self, model):
+        """Whether natural keys of model can be resolved in bulk, and worked out without queries."""
+        return bool(natural_key_fields(model))
+
+    def resolve(self, model, keys, using):
+        """Look up every key in keys that isn't cached yet with one query per MAX_QUERY_PARAMS values.
+
+        Returns the primary key of each of keys, None for those that don't
+        exist, even if there are more than the cache holds; or None, without
+        querying, if model's natural key can't be turned into a filter.
+        """
+        fields = natural_key_fields(model)
+        if not fields:
+            return None
+        keys = [normalize_key(model, key) for key in keys]
+        found = {}
+        missing = []
+        for key in set([key for key in keys if len(key) == len(fields)]):
+            pk = self.get(model, key)
+            if pk is None:
+                missing.append(key)
+            else:
+                found[key] = pk
+        names = [field.name for field in fields]
+        manager = model._default_manager.db_manager(using)
+        step = max(1, MAX_QUERY_PARAMS // len(names))
+        for i in range(0, len(missing), step):
+            batch = missing[i:i + step]
+            if len(names) == 1:
+                qs = manager.filter(**{'%s__in' % names[0]: [key[0] for key in batch]})
+            else:
+                qs = manager.filter(reduce(lambda a, b: a | b, [Q(**dict(zip(names, key))) for key in batch]))
+            for row in qs.values_list('pk', *names):
+                found[normalize_key(model, row[1:])] = row[0]
+                self.set(model, row[1:], row[0])
+        return [found.get(key) for key in keys]
+
+_process_caches = {}
+
+def process_cache(token, size):
+    """Return this process's cache for the load identified by token, starting an empty one if need be."""
+    if token not in _process_caches:
+        _process_caches[token] = NaturalKeyCache(size, token)
+    return _process_caches[token]
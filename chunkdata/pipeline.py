@@ -0,0 +1,185 @@
+"""
+Pipelined dumps.
+
+Writing a chunk file takes three steps that wait on different things:
+reading rows from the database, serializing them, which is Python code, and
+compressing and writing the result, which waits on zlib and the disk. Done in
+turn each waits for the other two. With --pipeline dumpchunks overlaps them:
+a ReadAhead thread fetches the objects of the chunks in order, a batch at a
+time, and carries on into the next chunk while the current one is being
+serialized, and a BackgroundWriter thread compresses and writes what the
+serializer produces and fsyncs each file before it goes into the checkpoint.
+The queues between the threads hold a few batches or blocks at most, so a
+stage that gets ahead waits for the next one and memory use stays flat.
+Database drivers, zlib and file writes release the GIL, so a dump runs about
+as fast as its slowest stage rather than the sum of all three.
+
+The reader thread opens a database connection of its own, so like --jobs it
+can't be used with an in-memory SQLite database, where only the writer
+thread is.
+"""
+import os
+import Queue
+import sys
+import threading
+import time
+
+from django.db import connections
+
+from chunkdata.loader import batches
+
+# Objects per batch handed from the reader thread to the serializer.
+BATCH_SIZE = 1000
+
+# Bytes per block handed from the serializer to the writer thread.
+BLOCK_SIZE = 1 << 20
+
+# Batches or blocks a queue holds before the stage filling it waits.
+DEPTH = 4
+
+END = object()
+
+class Failure(object):
+    """An exception raised in a pipeline thread, to be raised again in the thread that reads its results."""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+class ReadAhead(object):
+    """Iterates over each of iterables in turn in a thread of its own, a batch at a time.
+
+    chunk() gives the objects of the next iterable, which the thread reads up
+    to depth batches ahead of, going on into the iterables after it. With
+    using, the connection the thread opened to that database is closed when
+    it is done. close() stops the thread early.
+    """
+
+    def __init__(self, iterables, using=None, batch_size=BATCH_SIZE, depth=DEPTH):
+        self.queue = Queue.Queue(depth)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, args=(iter(iterables), using, batch_size))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, iterables, using, batch_size):
+        try:
+            try:
+                for iterable in iterables:
+                    for batch in batches(iterable, batch_size):
+                        self.queue.put(batch)
+                        if self.stopped:
+                            return
+                    self.queue.put(END)
+                    if self.stopped:
+                        return
+            except Exception:
+                self.queue.put(Failure(sys.exc_info()))
+        finally:
+            if using is not None:
+                connections[using].close()
+
+    def chunk(self, metrics=None):
+        """Yield the objects of the next iterable.
+
+        The time spent waiting for the thread is charged to metrics, a
+        ChunkMetrics, as query time.
+        """
+        while True:
+            start = time.time()
+            item = self.queue.get()
+            if metrics is not None:
+                metrics.add('query_seconds', time.time() - start)
+            if item is END:
+                return
+            if isinstance(item, Failure):
+                item.reraise()
+            for obj in item:
+                yield obj
+
+    def close(self):
+        self.stopped = True
+        while self.thread.isAlive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.thread.join()
+
+class BackgroundWriter(object):
+    """Write-only file object that has a thread of its own write to fileobj.
+
+    Writes are gathered into blocks of about block_size bytes, up to depth of
+    which wait for the thread. close() waits for the thread to write and close
+    fileobj, raising anything that went wrong in it.
+    """
+
+    def __init__(self, fileobj, block_size=BLOCK_SIZE, depth=DEPTH):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.block = []
+        self.block_bytes = 0
+        self.failure = None
+        self.queue = Queue.Queue(depth)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                block = self.queue.get()
+                if block is END:
+                    break
+                # Written as they came, so str and unicode aren't joined.
+                for data in block:
+                    self.fileobj.write(data)
+            self.fileobj.close()
+        except Exception:
+            self.failure = Failure(sys.exc_info())
+            # Keep taking blocks so the serializer doesn't wait forever.
+            while block is not END:
+                block = self.queue.get()
+
+    def write(self, data):
+        self.block.append(data)
+        self.block_bytes += len(data)
+        if self.block_bytes >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """Hand what has been written so far to the thread, without waiting for it to be written."""
+        if self.failure is not None:
+            self.failure.reraise()
+        if self.block:
+            self.queue.put(self.block)
+            self.block = []
+            self.block_bytes = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.queue.put(END)
+            self.thread.join()
+        if self.failure is not None:
+            self.failure.reraise()
+
+class SyncedFile(object):
+    """File wrapper whose close() makes sure what was written is on disk first."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        self.fileobj.close()
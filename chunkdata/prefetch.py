@@ -0,0 +1,98 @@
+"""
+Many-to-many prefetching for dumps.
+
+Django's serializers read each object's many-to-many relations through its
+related manager, one query per object and field. prefetch_m2m reads the
+relations of every object in a queryset at once instead: one query on the
+through table and one for the related objects per field, with the queryset
+itself as a subquery, so the number of queries for a chunk doesn't depend on
+how many objects it holds. The chunkdata serializers use the related objects
+stored on each object under PREFETCHED_M2M in place of the related manager.
+iter_prefetched walks a queryset BATCH_SIZE objects at a time, so the
+relations held in memory don't grow with the size of the table.
+"""
+from itertools import islice
+
+from django.db import connections
+
+from chunkdata.loader import MAX_QUERY_PARAMS
+
+PREFETCHED_M2M = '_chunkdata_m2m'
+
+# Objects whose many-to-many relations are prefetched together.
+BATCH_SIZE = MAX_QUERY_PARAMS
+
+def prefetched_fields(model):
+    return [field for field in model._meta.many_to_many
+            if field.serialize and field.rel.through._meta.auto_created]
+
+def pk_sources(qs):
+    """Return what to filter on the primary keys of qs's objects with, as a list of __in values.
+
+    That is qs itself as a subquery, unless it is sliced and the database
+    can't take sliced subqueries, in which case the keys are read and split
+    into lists that fit in a query.
+    """
+    if qs.query.can_filter() or connections[qs.db].features.allow_sliced_subqueries:
+        return [qs.values('pk')]
+    pks = list(qs.values_list('pk', flat=True))
+    return [pks[i:i + MAX_QUERY_PARAMS] for i in range(0, len(pks), MAX_QUERY_PARAMS)]
+
+def prefetch_m2m(qs):
+    """Return {field name: {pk: [related objects]}} for the serialized many-to-many fields of qs's objects.
+
+    Related objects come from the related model's default manager in its
+    Meta.ordering (or primary key order), as the related manager returns them.
+    """
+    fields = prefetched_fields(qs.model)
+    if not fields:
+        return {}
+    using = qs.db
+    sources = pk_sources(qs)
+
+    prefetched = {}
+    for field in fields:
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        through = field.rel.through._base_manager.using(using)
+        related_manager = field.rel.to._default_manager.using(using)
+        related = prefetched[field.name] = {}
+        for pks in sources:
+            links = through.filter(**{'%s__in' % source: pks})
+            objects = related_manager.filter(pk__in=links.values(target))
+            if not field.rel.to._meta.ordering:
+                objects = objects.order_by('pk')
+            position = {}
+            by_pk = {}
+            for i, obj in enumerate(objects):
+                position[obj.pk] = i
+                by_pk[obj.pk] = obj
+            pairs = {}
+            for source_pk, target_pk in links.values_list(source, target):
+                if target_pk in by_pk:
+                    pairs.setdefault(source_pk, []).append(target_pk)
+            for source_pk, target_pks in pairs.items():
+                target_pks.sort(key=position.get)
+                related[source_pk] = [by_pk[pk] for pk in target_pks]
+    return prefetched
+
+def iter_prefetched(qs):
+    """Yield the objects of qs without caching them, with their many-to-many relations prefetched.
+
+    The relations are read for BATCH_SIZE objects at a time, filtering on the
+    primary keys of the batch.
+    """
+    objects = qs.iterator()
+    if not prefetched_fields(qs.model):
+        for obj in objects:
+            yield obj
+        return
+    manager = qs.model._base_manager.using(qs.db)
+    while True:
+        batch = list(islice(objects, BATCH_SIZE))
+        if not batch:
+            return
+        prefetched = prefetch_m2m(manager.filter(pk__in=[obj.pk for obj in batch]))
+        for obj in batch:
+            setattr(obj, PREFETCHED_M2M, dict((name, related.get(obj.pk, []))
+                                              for name, related in prefetched.items()))
+            yield obj
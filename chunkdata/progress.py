@@ -0,0 +1,78 @@
+"""
+Progress reports for long dumps and loads.
+
+A Progress counts the rows (or chunks) done out of a total known up front
+and writes a line with the rate so far and the time left, at most once every
+interval seconds, so counting costs a clock read per update. On a terminal
+the line is rewritten in place; anywhere else, such as a log file, each
+report is a line of its own.
+"""
+import datetime
+import sys
+import time
+
+DEFAULT_INTERVAL = 10
+
+# Objects a dump writes between updates of its progress.
+PROGRESS_STEP = 1000
+
+class Progress(object):
+    """Counts what is done of total, which may be None if it isn't known, and reports it to stream.
+
+    done is what was already done before, which doesn't count towards the rate.
+    """
+
+    def __init__(self, label, total=None, unit='objects', done=0, stream=None, interval=DEFAULT_INTERVAL,
+                 clock=time.time):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.done = self.initial = done
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.clock = clock
+        self.started = self.reported = clock()
+        self.tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+
+    def add(self, count):
+        self.done += count
+        now = self.clock()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.write(self.describe(now))
+
+    def finish(self):
+        now = self.clock()
+        line = "%s: %d %s in %s, %s" % (self.label, self.done, self.unit, format_seconds(now - self.started),
+                                        self.rate(now))
+        self.write(line, end=True)
+
+    def rate(self, now):
+        seconds = now - self.started
+        if not seconds:
+            return "? %s/s" % self.unit
+        return "%.0f %s/s" % ((self.done - self.initial) / seconds, self.unit)
+
+    def describe(self, now):
+        if not self.total:
+            return "%s: %d %s, %s" % (self.label, self.done, self.unit, self.rate(now))
+        percent = 100.0 * self.done / self.total
+        seconds = now - self.started
+        if self.done > self.initial and seconds:
+            left = (self.total - self.done) * seconds / (self.done - self.initial)
+            eta = format_seconds(max(0, left))
+        else:
+            eta = '?'
+        return "%s: %d/%d %s (%.1f%%), %s, ETA %s" % (self.label, self.done, self.total, self.unit, percent,
+                                                      self.rate(now), eta)
+
+    def write(self, line, end=False):
+        if self.tty:
+            # Pad over what is left of a longer line before.
+            self.stream.write('\r%-79s' % line + (end and '\n' or ''))
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+def format_seconds(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
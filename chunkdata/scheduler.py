@@ -0,0 +1,101 @@
+"""
+Dependency-aware scheduling of chunk loads across worker processes.
+
+A chunk can only be loaded once every chunk holding objects it refers to has
+been committed; chunks of unrelated models (and the separate chunks of one
+big model) can be loaded at the same time.
+"""
+import multiprocessing
+import Queue
+import traceback
+
+from chunkdata.management.commands.dumpchunks import get_model_dependencies
+from chunkdata.workers import POLL_INTERVAL, WorkerDied, check_workers, worker_pids
+
+class WorkerError(Exception):
+    pass
+
+def chunk_dependencies(chunks):
+    """Map each chunk to the set of chunks that have to be loaded before it.
+
+    chunks is a list of (chunk, models) pairs in file order. A chunk waits for
+    every other chunk containing a model one of its own models has a FK, M2M
+    or natural key relation to. Chunks of a model that refers to itself are
+    loaded one after another in file order, since rows in a later chunk can
+    point at rows in an earlier one.
+    """
+    chunks_by_model = {}
+    for chunk, models in chunks:
+        for model in models:
+            chunks_by_model.setdefault(model, []).append(chunk)
+
+    dependencies = {}
+    for chunk, models in chunks:
+        dependencies[chunk] = set()
+        for model in models:
+            for dep in get_model_dependencies(model, all_relations=True):
+                if dep is model:
+                    earlier = chunks_by_model[model]
+                    dependencies[chunk].update(earlier[:earlier.index(chunk)])
+                else:
+                    dependencies[chunk].update(chunks_by_model.get(dep, []))
+        dependencies[chunk].discard(chunk)
+    return dependencies
+
+def run_scheduled(chunks, dependencies, func, args=(), jobs=2, callback=None):
+    """Call func(chunk, *args) for every chunk from a pool of jobs processes.
+
+    A chunk is only handed to the pool once all of its dependencies have
+    finished. If the remaining chunks only depend on each other (a dependency
+    cycle) the first of them in file order is released so loading can go on,
+    which is the order a serial load would have used anyway. The first error
+    raised by a worker stops the scheduling and is re-raised here, as is a
+    worker dying or a chunk's arguments or result failing to pickle. With a
+    callback, callback(chunk, result) is called here as each chunk finishes.
+    """
+    pending = list(chunks)
+    done = set()
+    running = {}
+    finished = Queue.Queue()
+    pool = multiprocessing.Pool(jobs)
+    pids = worker_pids(pool)
+    try:
+        while pending or running:
+            ready = [chunk for chunk in pending if dependencies.get(chunk, set()) <= done]
+            if not ready and not running:
+                ready = pending[:1]
+            for chunk in ready:
+                pending.remove(chunk)
+                running[chunk] = pool.apply_async(_call, (func, chunk, args), callback=finished.put)
+            try:
+                chunk, error, result = finished.get(True, POLL_INTERVAL)
+            except Queue.Empty:
+                # The callback only hears of chunks that ran; look for the
+                # ones that couldn't be sent or returned, or whose worker died.
+                for chunk, async_result in running.items():
+                    if async_result.ready() and not async_result.successful():
+                        try:
+                            async_result.get()
+                        except Exception, err:
+                            raise WorkerError("%s failed: %s" % (chunk, err))
+                try:
+                    check_workers(pool, pids)
+                except WorkerDied, err:
+                    raise WorkerError("%s Running: %s" % (err, ', '.join(sorted(running))))
+                continue
+            if error:
+                raise WorkerError("%s failed:\n%s" % (chunk, error))
+            del running[chunk]
+            done.add(chunk)
+            if callback is not None:
+                callback(chunk, result)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _call(func, chunk, args):
+    try:
+        result = func(chunk, *args)
+    except Exception:
+        return chunk, traceback.format_exc(), None
+    return chunk, None, result
@@ -0,0 +1,40 @@
+"""
+Serializers used by the chunkdata commands.
+
+Django's json and yaml serializers collect every object in a list and only
+encode it once the whole queryset has been consumed. The versions in
+``chunkdata.serializers.streaming`` write each object to the output stream as
+soon as it has been serialized, so memory use does not grow with the size of
+the table being dumped. All of them, xml included, use many-to-many relations
+prefetched for the chunk when they are there.
+
+Importing this package registers the jsonl and columnar formats (see
+``chunkdata.serializers.jsonl`` and ``chunkdata.serializers.columnar``) with
+Django.
+"""
+from django.core import serializers
+
+from chunkdata.serializers import columnar, jsonl, streaming
+
+serializers.register_serializer('jsonl', 'chunkdata.serializers.jsonl')
+serializers.register_serializer('columnar', 'chunkdata.serializers.columnar')
+
+STREAMING_SERIALIZERS = {
+    'columnar': columnar.Serializer,
+    'json': streaming.JSONSerializer,
+    'jsonl': jsonl.Serializer,
+    'xml': streaming.XMLSerializer,
+}
+if streaming.YAMLSerializer is not None:
+    STREAMING_SERIALIZERS['yaml'] = streaming.YAMLSerializer
+
+def get_serializer(format):
+    """Return a serializer class for format that writes to its stream as it goes.
+
+    Other formats fall back to Django's registered serializer. Django's xml
+    serializer already writes as it goes, so it is only subclassed to use
+    prefetched many-to-many relations.
+    """
+    if format in STREAMING_SERIALIZERS:
+        return STREAMING_SERIALIZERS[format]
+    return serializers.get_serializer(format)
@@ -0,0 +1,53 @@
+"""
+Binary columnar serialization (see chunkdata.columnar for the encoding).
+
+A columnar fixture holds the objects the json format would, column by column
+for runs of objects of the same model, so field names are stored once per
+run rather than once per object and numbers are stored packed rather than as
+text. It round-trips with the json format: deserializing either gives the
+same objects.
+
+The chunkdata commands register the format when they are imported; to use
+it with dumpdata and loaddata as well, add it to SERIALIZATION_MODULES:
+
+    SERIALIZATION_MODULES = {'columnar': 'chunkdata.serializers.columnar'}
+"""
+from StringIO import StringIO
+
+from django.core.serializers.python import Serializer as PythonSerializer
+from django.core.serializers.python import Deserializer as PythonDeserializer
+
+from chunkdata.columnar import BlockWriter, read_objects
+from chunkdata.serializers.streaming import PrefetchedM2MMixin
+
+class Serializer(PrefetchedM2MMixin, PythonSerializer):
+    """
+    Convert a queryset to columnar blocks, writing each block as it fills up.
+    """
+    internal_use_only = False
+
+    def start_serialization(self):
+        super(Serializer, self).start_serialization()
+        self.writer = BlockWriter(self.stream)
+
+    def end_object(self, obj):
+        super(Serializer, self).end_object(obj)
+        self.writer.write(self.objects.pop())
+
+    def end_serialization(self):
+        self.writer.close()
+
+    def getvalue(self):
+        if callable(getattr(self.stream, 'getvalue', None)):
+            return self.stream.getvalue()
+
+def Deserializer(stream_or_string, **options):
+    """
+    Deserialize a stream or string of columnar data.
+    """
+    if isinstance(stream_or_string, basestring):
+        stream = StringIO(stream_or_string)
+    else:
+        stream = stream_or_string
+    for obj in PythonDeserializer(read_objects(stream), **options):
+        yield obj
@@ -0,0 +1,53 @@
+"""
+JSON Lines serialization: one JSON object per line.
+
+A jsonl fixture holds the objects the json format would, each on a line of
+its own instead of as the items of one array. The serializer writes each
+object out as soon as it has been serialized, a file can be appended to or
+split at any line, and the deserializer reads it a line at a time.
+
+The chunkdata commands register the format when they are imported; to use
+it with dumpdata and loaddata as well, add it to SERIALIZATION_MODULES:
+
+    SERIALIZATION_MODULES = {'jsonl': 'chunkdata.serializers.jsonl'}
+"""
+from StringIO import StringIO
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.serializers.python import Serializer as PythonSerializer
+from django.core.serializers.python import Deserializer as PythonDeserializer
+from django.utils import simplejson
+
+from chunkdata.jsonstream import iter_json_lines
+from chunkdata.serializers.streaming import PrefetchedM2MMixin, json_options
+
+class Serializer(PrefetchedM2MMixin, PythonSerializer):
+    """
+    Convert a queryset to JSON Lines.
+    """
+    internal_use_only = False
+
+    def start_serialization(self):
+        super(Serializer, self).start_serialization()
+        # An object has to stay on one line.
+        self.options.pop('indent', None)
+        self.json_options = json_options(self.options)
+
+    def end_object(self, obj):
+        super(Serializer, self).end_object(obj)
+        self.stream.write(simplejson.dumps(self.objects.pop(), cls=DjangoJSONEncoder, **self.json_options) + '\n')
+
+    def getvalue(self):
+        if callable(getattr(self.stream, 'getvalue', None)):
+            return self.stream.getvalue()
+
+def Deserializer(stream_or_string, **options):
+    """
+    Deserialize a stream or string of JSON Lines data.
+    """
+    if isinstance(stream_or_string, basestring):
+        stream = StringIO(stream_or_string)
+    else:
+        stream = stream_or_string
+    for obj in PythonDeserializer(iter_json_lines(stream), **options):
+        yield obj
@@ -0,0 +1,183 @@
+"""
+Serialization straight from database rows.
+
+Django's serializers need a model instance per object and convert every field
+through ``value_to_string``, and with natural keys they run a query for every
+foreign key of every object. The RowSerializer reads a queryset with
+``values_list()`` instead and converts each column with a converter chosen
+once per field. Foreign keys are written as their column values, natural keys
+and many-to-many relations are looked up for a whole batch of rows at once.
+The objects it produces are the dictionaries Django's python serializer
+builds, so they are written out exactly as the json and yaml serializers
+would write them and load back with loaddata.
+"""
+from itertools import islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.fields import Field
+from django.utils import simplejson
+from django.utils.encoding import is_protected_type, smart_unicode
+
+from chunkdata.columnar import write_objects
+from chunkdata.loader import MAX_QUERY_PARAMS
+from chunkdata.serializers.streaming import JSONArrayWriter, json_options
+
+try:
+    import yaml
+    from django.core.serializers.pyyaml import DjangoSafeDumper
+except ImportError:
+    yaml = None
+
+ROW_FORMATS = ('columnar', 'json', 'jsonl', 'yaml')
+
+# Rows whose natural keys and many-to-many relations are looked up together.
+BATCH_SIZE = 1000
+
+class Row(object):
+    """Stands in for a model instance when a field's own value_to_string has to be called."""
+    pass
+
+def field_converter(field):
+    """Return a function converting a column value of field the way the python serializer does."""
+    if type(field).value_to_string.im_func is Field.value_to_string.im_func:
+        def convert(value):
+            if isinstance(value, unicode) or is_protected_type(value):
+                return value
+            return smart_unicode(value)
+    else:
+        def convert(value):
+            if is_protected_type(value):
+                return value
+            row = Row()
+            setattr(row, field.attname, value)
+            return field.value_to_string(row)
+    return convert
+
+class RowSerializer(object):
+    """Turns the rows of a model's querysets into python serializer dictionaries."""
+
+    def __init__(self, model, use_natural_keys=False, batch_size=BATCH_SIZE):
+        self.model = model
+        self.label = smart_unicode(model._meta)
+        self.use_natural_keys = use_natural_keys
+        self.batch_size = batch_size
+        self.fields = []
+        self.fks = []
+        for field in model._meta.local_fields:
+            if field.serialize:
+                if field.rel is None:
+                    self.fields.append(field)
+                else:
+                    self.fks.append(field)
+        self.m2ms = [field for field in model._meta.many_to_many
+                     if field.serialize and field.rel.through._meta.auto_created]
+        self.converters = [field_converter(field) for field in self.fields]
+
+    def rows(self, qs):
+        """Yield the serialized objects of qs in its order."""
+        names = ['pk'] + [field.name for field in self.fields] + [field.name for field in self.fks]
+        using = qs.db
+        values = qs.values_list(*names).iterator()
+        while True:
+            batch = list(islice(values, self.batch_size))
+            if not batch:
+                return
+            for obj in self.serialize_batch(batch, using):
+                yield obj
+
+    def serialize_batch(self, batch, using):
+        first_fk = 1 + len(self.fields)
+        fk_values = []
+        for i, field in enumerate(self.fks):
+            fk_values.append(self.fk_converter(field, [row[first_fk + i] for row in batch], using))
+        m2m_values = [self.m2m_values(field, [row[0] for row in batch], using) for field in self.m2ms]
+
+        fields = zip([field.name for field in self.fields], self.converters)
+        fk_names = [field.name for field in self.fks]
+        m2m_names = [field.name for field in self.m2ms]
+        for row in batch:
+            current = {}
+            for i, (name, convert) in enumerate(fields):
+                current[name] = convert(row[1 + i])
+            for i, name in enumerate(fk_names):
+                current[name] = fk_values[i](row[first_fk + i])
+            for i, name in enumerate(m2m_names):
+                current[name] = m2m_values[i].get(row[0], [])
+            yield {
+                "model": self.label,
+                "pk": smart_unicode(row[0], strings_only=True),
+                "fields": current,
+            }
+
+    def fk_converter(self, field, values, using):
+        """Return a function giving the serialized value of field for one of values."""
+        rel = field.rel
+        if self.use_natural_keys and hasattr(rel.to, 'natural_key'):
+            keys = natural_keys(rel.to, rel.field_name, values, using)
+            return lambda value: value is not None and keys.get(value) or None
+        if rel.field_name == rel.to._meta.pk.name:
+            return lambda value: value
+        return lambda value: smart_unicode(value, strings_only=True)
+
+    def m2m_values(self, field, pks, using):
+        """Map each of pks to the serialized values of its field relations."""
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        through = field.rel.through._base_manager.using(using)
+        # Django's serializer reads relations through the related model's
+        # default manager, which may leave some of them out.
+        related_manager = field.rel.to._default_manager.using(using)
+        ordering = [o for o in field.rel.to._meta.ordering if o != '?'] or ['pk']
+        order_by = ['%s%s__%s' % (o.startswith('-') and '-' or '', target, o.lstrip('-')) for o in ordering]
+        pairs = []
+        for i in range(0, len(pks), MAX_QUERY_PARAMS):
+            pairs.extend(through.filter(**{'%s__in' % source: pks[i:i + MAX_QUERY_PARAMS],
+                                           '%s__in' % target: related_manager.values('pk')})
+                         .order_by(*order_by).values_list(source, target))
+        if self.use_natural_keys and hasattr(field.rel.to, 'natural_key'):
+            keys = natural_keys(field.rel.to, field.rel.to._meta.pk.name, [pk for s, pk in pairs], using)
+            convert = keys.get
+        else:
+            convert = lambda value: smart_unicode(value, strings_only=True)
+        related = {}
+        for source_pk, target_pk in pairs:
+            related.setdefault(source_pk, []).append(convert(target_pk))
+        return related
+
+def natural_keys(model, field_name, values, using):
+    """Map values of model's field_name to the natural keys of the objects that have them."""
+    values = list(set([value for value in values if value is not None]))
+    keys = {}
+    manager = model._base_manager.using(using)
+    for i in range(0, len(values), MAX_QUERY_PARAMS):
+        for obj in manager.filter(**{'%s__in' % field_name: values[i:i + MAX_QUERY_PARAMS]}):
+            keys[getattr(obj, field_name)] = obj.natural_key()
+    return keys
+
+def iter_rows(querysets, use_natural_keys=False):
+    """Yield the serialized objects of each queryset in turn."""
+    for qs in querysets:
+        for obj in RowSerializer(qs.model, use_natural_keys).rows(qs):
+            yield obj
+
+def write_rows(format, objects, stream, indent=None):
+    """Write serialized objects to stream as the streaming columnar, json, jsonl or yaml serializer would."""
+    if format == 'json':
+        writer = JSONArrayWriter(stream, **json_options({'indent': indent}))
+        for obj in objects:
+            writer.write(obj)
+        writer.close()
+    elif format == 'columnar':
+        write_objects(objects, stream)
+    elif format == 'jsonl':
+        options = json_options({})
+        for obj in objects:
+            stream.write(simplejson.dumps(obj, cls=DjangoJSONEncoder, **options) + '\n')
+    elif format == 'yaml' and yaml is not None:
+        first = True
+        for obj in objects:
+            yaml.dump([obj], stream, Dumper=DjangoSafeDumper, indent=indent)
+            first = False
+        if first:
+            yaml.dump([], stream, Dumper=DjangoSafeDumper, indent=indent)
+    else:
+        raise ValueError("Can't write %s from rows" % format)
@@ -0,0 +1,142 @@
+"""
+Incremental versions of Django's json and yaml serializers.
+
+All of the chunkdata serializers also take many-to-many relations that were
+prefetched for a whole chunk (see chunkdata.prefetch) from the object instead
+of querying its related manager.
+"""
+from django.core.serializers.json import Serializer as BaseJSONSerializer, DjangoJSONEncoder
+from django.core.serializers.xml_serializer import Serializer as BaseXMLSerializer
+from django.utils import simplejson
+
+from chunkdata.prefetch import PREFETCHED_M2M
+
+try:
+    import yaml
+    from django.core.serializers.pyyaml import Serializer as BaseYAMLSerializer, DjangoSafeDumper
+except ImportError:
+    yaml = None
+
+
+def json_options(options):
+    """Return the simplejson options Django's json serializer would write with, given serializer options."""
+    options = dict(options)
+    options.pop('stream', None)
+    options.pop('fields', None)
+    if simplejson.__version__.split('.') >= ['2', '1', '3']:
+        # Use JS strings to represent Python Decimal instances (ticket #16850)
+        options['use_decimal'] = False
+    return options
+
+
+class JSONArrayWriter(object):
+    """Writes objects to a stream one at a time as the items of a JSON array.
+
+    The result is what simplejson.dump writes for the list of all of them with
+    the same options: each object is encoded as an item of a one-item list,
+    and the brackets and separators around it are taken from how simplejson
+    lays out a list.
+    """
+
+    def __init__(self, stream, **options):
+        self.stream = stream
+        self.options = options
+        one = self.encode([0])
+        start = one.index('0')
+        self.start, self.end = one[:start], one[start + 1:]
+        two = self.encode([0, 0])
+        self.separator = two[start + 1:len(two) - len(self.end) - 1]
+        self.first = True
+
+    def encode(self, value):
+        # dumps encodes in one go, where dump writes each token separately.
+        return simplejson.dumps(value, cls=DjangoJSONEncoder, **self.options)
+
+    def write(self, obj):
+        item = self.encode([obj])[len(self.start):-len(self.end)]
+        self.stream.write((self.first and self.start or self.separator) + item)
+        self.first = False
+
+    def close(self):
+        if self.first:
+            self.stream.write(self.encode([]))
+        else:
+            self.stream.write(self.end)
+
+
+class PrefetchedRelation(object):
+    """Stands in for a related manager, iterating over prefetched objects."""
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def iterator(self):
+        return iter(self.objects)
+
+class PrefetchedView(object):
+    """An object whose many-to-many field name reads from prefetched related objects."""
+
+    def __init__(self, obj, name, related):
+        self._obj = obj
+        self._name = name
+        self._related = related
+
+    def __getattr__(self, name):
+        if name == self._name:
+            return PrefetchedRelation(self._related)
+        return getattr(self._obj, name)
+
+class PrefetchedM2MMixin(object):
+
+    def handle_m2m_field(self, obj, field):
+        related = getattr(obj, PREFETCHED_M2M, {}).get(field.name)
+        if related is not None:
+            obj = PrefetchedView(obj, field.name, related)
+        super(PrefetchedM2MMixin, self).handle_m2m_field(obj, field)
+
+
+class JSONSerializer(PrefetchedM2MMixin, BaseJSONSerializer):
+    """
+    Writes a JSON array one object at a time instead of dumping a list of
+    every object in end_serialization.
+    """
+
+    def start_serialization(self):
+        super(JSONSerializer, self).start_serialization()
+        self.writer = JSONArrayWriter(self.stream, **json_options(self.options))
+
+    def end_object(self, obj):
+        super(JSONSerializer, self).end_object(obj)
+        self.writer.write(self.objects.pop())
+
+    def end_serialization(self):
+        self.writer.close()
+
+
+if yaml is not None:
+    class YAMLSerializer(PrefetchedM2MMixin, BaseYAMLSerializer):
+        """
+        Writes each object as its own item of a YAML sequence; the concatenated
+        items read back as one list. Without any objects that would be an empty
+        stream, so an empty list is written instead.
+        """
+
+        def start_serialization(self):
+            super(YAMLSerializer, self).start_serialization()
+            self.first = True
+
+        def end_object(self, obj):
+            super(YAMLSerializer, self).end_object(obj)
+            yaml.dump(self.objects[-1:], self.stream, Dumper=DjangoSafeDumper, **self.options)
+            self.objects = []
+            self.first = False
+
+        def end_serialization(self):
+            if self.first:
+                yaml.dump([], self.stream, Dumper=DjangoSafeDumper, **self.options)
+else:
+    YAMLSerializer = None
+
+
+class XMLSerializer(PrefetchedM2MMixin, BaseXMLSerializer):
+    pass
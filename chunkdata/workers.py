@@ -0,0 +1,55 @@
+"""
+Waiting on worker pools without hanging.
+
+multiprocessing.Pool never finishes the task of a worker that died, killed by
+the OOM killer or a signal: it starts a new worker in its place and the result
+is never set. On Python 2 a wait without a timeout can't be interrupted with
+Ctrl-C either. The helpers here wait POLL_INTERVAL seconds at a time and
+check in between that none of the pool's workers has died.
+"""
+import multiprocessing
+
+# Seconds to wait on a pool before checking its workers again.
+POLL_INTERVAL = 1
+
+class WorkerDied(Exception):
+    pass
+
+def worker_pids(pool):
+    """Return the process ids of pool's live workers."""
+    return set([process.pid for process in pool._pool if process.exitcode is None])
+
+def check_workers(pool, pids):
+    """Raise WorkerDied unless every one of pids is still a live worker of pool.
+
+    The pool replaces a worker that dies, so its pid drops out of the pool.
+    """
+    if not pids <= worker_pids(pool):
+        raise WorkerDied("A worker process died before finishing its task; it may have been killed by a "
+                         "signal or for running out of memory.")
+
+def wait_for(result, pool, pids):
+    """Return the value of result, an AsyncResult of pool, once it is ready.
+
+    Raises WorkerDied instead if one of pids, the pool's workers, dies first.
+    """
+    while True:
+        try:
+            return result.get(POLL_INTERVAL)
+        except multiprocessing.TimeoutError:
+            check_workers(pool, pids)
+
+def iter_unordered(pool, func, iterable):
+    """Yield func(item) for every item of iterable from pool, as pool.imap_unordered does.
+
+    Raises WorkerDied instead of waiting forever for the task of a dead worker.
+    """
+    pids = worker_pids(pool)
+    results = pool.imap_unordered(func, iterable)
+    while True:
+        try:
+            yield results.next(POLL_INTERVAL)
+        except multiprocessing.TimeoutError:
+            check_workers(pool, pids)
+        except StopIteration:
+            return
@@ -9,6 +9,7 @@ setup(
     author='Aaron McCall',
     author_email='aaron@andyet.net',
     packages=find_packages(),
+    install_requires=['Django>=1.3'],
     url='https://github.com/aaronmccall/chunkdata/',
     license='MIT License',
     description='Chunked fixture tools for Django',
@@ -20,6 +21,7 @@ setup(
                    'License :: OSI Approved :: MIT License',
                    'Operating System :: OS Independent',
                    'Programming Language :: Python',
+                   'Programming Language :: Python :: 2.7',
                    'Topic :: Internet :: WWW/HTTP',
                    'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
                    'Topic :: Internet :: WWW/HTTP :: WSGI',
@@ -0,0 +1,73 @@
+"""
+Synthetic data for the benchmarks.
+
+generate fills a database with a given number of objects spread over
+TestLocation, TestPerson and the bench models, written straight to the
+tables with executemany so that even tens of millions of rows take minutes
+rather than hours. The data only depends on the row count and the seed.
+"""
+import datetime
+import random
+
+from django.db import connections, transaction
+
+from chunkdata.loader import insert_rows
+from testapp.models import TestPerson, TestLocation
+from bench.models import BenchPublisher, BenchBook
+
+BATCH_SIZE = 10000
+
+FIRST_NAMES = ['Ada', 'Alan', 'Barbara', 'Dennis', 'Edsger', 'Grace', 'John', 'Ken', 'Margaret', 'Niklaus']
+LAST_NAMES = ['Hopper', 'Knuth', 'Liskov', 'Lovelace', 'Ritchie', 'Thompson', 'Turing', 'Wirth']
+CITIES = [('Austin', 'TX'), ('Boston', 'MA'), ('Chicago', 'IL'), ('Denver', 'CO'), ('Portland', 'OR')]
+WORDS = ['data', 'chunk', 'fixture', 'model', 'query', 'index', 'table', 'row', 'field', 'key']
+
+def split_rows(rows):
+    """Return how many objects of each model make up rows objects in all."""
+    locations = max(1, rows // 5)
+    people = max(1, rows * 3 // 10)
+    publishers = max(1, rows // 100)
+    books = max(0, rows - locations - people - publishers)
+    return [(TestLocation, locations), (TestPerson, people), (BenchPublisher, publishers), (BenchBook, books)]
+
+def generate(using, rows, seed=0):
+    """Add rows objects to the empty tables of the database using, returning {model label: count}."""
+    connection = connections[using]
+    rng = random.Random(seed)
+    counts = dict(split_rows(rows))
+    locations, people, publishers = counts[TestLocation], counts[TestPerson], counts[BenchPublisher]
+
+    def location(pk):
+        city, state = rng.choice(CITIES)
+        return [pk, 'Venue %d' % pk, '%d %s St' % (rng.randint(1, 9999), rng.choice(LAST_NAMES)), city, state,
+                '%05d' % rng.randint(0, 99999)]
+    def person(pk):
+        return [pk, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)]
+    def publisher(pk):
+        return [pk, 'Publisher %d' % pk]
+    start = datetime.date(1970, 1, 1)
+    def book(pk):
+        published = start + datetime.timedelta(days=rng.randint(0, 15000))
+        return [pk, ' '.join([rng.choice(WORDS) for i in range(4)]), connection.ops.value_to_db_date(published),
+                rng.randint(50, 900), rng.randint(1, publishers), rng.randint(1, locations)]
+
+    for model, make_row in [(TestLocation, location), (TestPerson, person), (BenchPublisher, publisher),
+                            (BenchBook, book)]:
+        columns = [field.column for field in model._meta.local_fields]
+        write_batches(connection, model._meta.db_table, columns, make_row, counts[model])
+
+    authors = BenchBook._meta.get_field('authors')
+    per_book = min(2, people)
+    def book_authors(pk):
+        # Consecutive people, so no (book, person) pair comes up twice.
+        book_pk = (pk - 1) // per_book + 1
+        return [pk, book_pk, (book_pk * per_book + (pk - 1) % per_book) % people + 1]
+    write_batches(connection, authors.m2m_db_table(), ['id', authors.m2m_column_name(), authors.m2m_reverse_name()],
+                  book_authors, counts[BenchBook] * per_book)
+    transaction.commit_unless_managed(using=using)
+    return dict((u'%s.%s' % (model._meta.app_label, model._meta.object_name), count)
+                for model, count in counts.items())
+
+def write_batches(connection, table, columns, make_row, count):
+    for first in xrange(1, count + 1, BATCH_SIZE):
+        insert_rows(connection, table, columns, [make_row(pk) for pk in range(first, min(first + BATCH_SIZE, count + 1))])
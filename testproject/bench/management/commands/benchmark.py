@@ -0,0 +1,218 @@
+import json
+import multiprocessing
+import os
+import Queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from optparse import make_option
+
+from django.core import management, serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from chunkdata.manifest import manifest_path, read_manifest
+from chunkdata.workers import POLL_INTERVAL
+from bench.generate import generate, split_rows
+
+DEFAULT_ROWS = [10000]
+DEFAULT_CHUNKS = [1000, 10000]
+LOAD_MODES = {
+    'loaddata': {},
+    'bulk': {'bulk': True},
+    'single': {'bulk': True, 'single_transaction': True, 'defer_constraints': True, 'drop_indexes': True},
+}
+
+class Command(BaseCommand):
+    help = ('Generates synthetic data in a scratch SQLite database and times dumpchunks and loadchunks on it, '
+            'writing one JSON result per line.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('-r', '--rows', dest='rows', action='append', type='int', default=[],
+            help='Number of objects to generate; repeat for several data sets. Defaults to %s.' %
+                 ', '.join(map(str, DEFAULT_ROWS))),
+        make_option('-c', '--chunk', dest='chunks', action='append', type='int', default=[],
+            help='Chunk size to dump with; repeat for several. Defaults to %s.' % ', '.join(map(str, DEFAULT_CHUNKS))),
+        make_option('--format', dest='formats', action='append', default=[],
+            help='Format to dump in; repeat for several. Defaults to json and xml, and yaml if PyYAML is installed.'),
+        make_option('-m', '--mode', dest='modes', action='append', default=[],
+            help='Load mode: %s; repeat for several. Defaults to all of them.' % ', '.join(sorted(LOAD_MODES))),
+        make_option('-n', '--natural', action='store_true', dest='use_natural_keys', default=False,
+            help='Dump with natural keys, so loads resolve them.'),
+        make_option('--fast', action='store_true', dest='fast', default=False,
+            help='Dump with --fast where the format allows it.'),
+        make_option('-o', '--output', dest='output', default=None,
+            help='Append the results to this file instead of writing them to stdout.'),
+        make_option('--keep', dest='keep', default=None,
+            help='Build the databases and chunk files in this directory and leave them there.'),
+    )
+
+    def handle(self, **options):
+        rows_list = options.get('rows') or DEFAULT_ROWS
+        chunks = options.get('chunks') or DEFAULT_CHUNKS
+        formats = options.get('formats') or [f for f in ('json', 'xml', 'yaml')
+                                             if f in serializers.get_public_serializer_formats()]
+        modes = options.get('modes') or sorted(LOAD_MODES)
+        for mode in modes:
+            if mode not in LOAD_MODES:
+                raise CommandError("Unknown load mode: %s" % mode)
+        verbosity = int(options.get('verbosity', 1))
+        output = options.get('output') and open(options['output'], 'a') or sys.stdout
+
+        directory = options.get('keep') or tempfile.mkdtemp(prefix='chunkdata-bench-')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        cwd = os.getcwd()
+        # dumpchunks writes a multi-app dump to ./fixtures, where loadchunks finds it again.
+        os.chdir(directory)
+        try:
+            for rows in rows_list:
+                source = scratch_database(directory, 'source-%d' % rows)
+                result, counts = measure(generate, (source, rows))
+                report(output, dict(result, step='generate', rows=rows, models=counts))
+                total = sum(counts.values())
+
+                for format in formats:
+                    for chunk in chunks:
+                        name = 'bench-%d-%s-%d' % (rows, format, chunk)
+                        dump_options = dict(format=format, chunk=chunk, filespec=name, database=source,
+                                            use_natural_keys=options.get('use_natural_keys', False),
+                                            fast=options.get('fast', False) and format in ('json', 'yaml'),
+                                            verbosity=0)
+                        result, value = measure(management.call_command, ('dumpchunks', 'testapp', 'bench'),
+                                                dump_options)
+                        manifest = read_manifest(manifest_path('fixtures', name))
+                        files = manifest['chunks']
+                        report(output, dict(result, step='dump', rows=total, format=format, chunk=chunk,
+                                            files=len(files), bytes=sum([f['bytes'] for f in files])))
+                        if verbosity > 1:
+                            print >> sys.stderr, "Dumped %s" % name
+
+                        for mode in modes:
+                            target = scratch_database(directory, '%s-%s' % (name, mode))
+                            load_options = dict(LOAD_MODES[mode], database=target, verbosity=0)
+                            result, value = measure(management.call_command,
+                                                    ('loadchunks', os.path.join('fixtures', name)), load_options)
+                            report(output, dict(result, step='load', rows=total, format=format, chunk=chunk,
+                                                mode=mode))
+                            loaded = object_counts(target)
+                            if loaded != counts:
+                                raise CommandError("Loading %s with %s gave %s instead of %s" % (
+                                    name, mode, loaded, counts))
+                            drop_database(directory, target)
+                        if not options.get('keep'):
+                            shutil.rmtree(os.path.join('fixtures', name))
+                            os.remove(manifest_path('fixtures', name))
+                if not options.get('keep'):
+                    drop_database(directory, source)
+        finally:
+            os.chdir(cwd)
+            if not options.get('keep'):
+                shutil.rmtree(directory)
+            if output is not sys.stdout:
+                output.close()
+
+def scratch_database(directory, name):
+    """Add a database alias for a new SQLite file in directory, with every table created, and return it."""
+    alias = 'bench-%s' % name
+    path = os.path.join(directory, '%s.sqlite3' % name)
+    if os.path.exists(path):
+        os.remove(path)
+    connections.databases[alias] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+    management.call_command('syncdb', database=alias, interactive=False, verbosity=0)
+    connections[alias].close()
+    return alias
+
+def object_counts(alias):
+    return dict((u'%s.%s' % (model._meta.app_label, model._meta.object_name),
+                 model._base_manager.using(alias).count()) for model, count in split_rows(0))
+
+def drop_database(directory, alias):
+    connections[alias].close()
+    os.remove(connections.databases[alias]['NAME'])
+
+def report(output, result):
+    if result.get('rows') and result.get('seconds'):
+        result['rows_per_sec'] = round(result['rows'] / result['seconds'], 1)
+    output.write(json.dumps(result, sort_keys=True) + '\n')
+    output.flush()
+
+def measure(func, args=(), kwargs={}):
+    """Run func in a child process and return its time, peak RSS and query count, and its return value.
+
+    Connections are closed first so the child opens its own; rows_per_sec is
+    added by report from the rows the step handled.
+    """
+    for alias in connections.databases:
+        connections[alias].close()
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measured, args=(queue, func, args, kwargs))
+    process.start()
+    # A child killed by a signal or the OOM killer never reports back.
+    while True:
+        try:
+            result = queue.get(timeout=POLL_INTERVAL)
+            break
+        except Queue.Empty:
+            if not process.is_alive() and queue.empty():
+                process.join()
+                raise CommandError("Benchmark step died with exit code %s before reporting its result; it may "
+                                   "have been killed by a signal or for running out of memory." % process.exitcode)
+    process.join()
+    if 'error' in result:
+        raise CommandError("Benchmark step failed: %s" % result['error'])
+    value = result.pop('value')
+    return result, value
+
+def _measured(queue, func, args, kwargs):
+    # What the commands print, such as dumpchunks' summary, would land among
+    # the results on stdout.
+    sys.stdout = open(os.devnull, 'w')
+    counter = QueryCounter()
+    for alias in connections.databases:
+        counter.install(connections[alias])
+    try:
+        start = time.time()
+        value = func(*args, **kwargs)
+        seconds = time.time() - start
+    except BaseException, e:
+        queue.put({'error': '%s: %s' % (e.__class__.__name__, e)})
+        return
+    queue.put({
+        'seconds': round(seconds, 3),
+        'queries': counter.count,
+        # Kilobytes on Linux, bytes on Mac OS X.
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'value': value,
+    })
+
+class QueryCounter(object):
+    """Counts the statements run through the cursors of the connections it is installed on."""
+
+    def __init__(self):
+        self.count = 0
+
+    def install(self, connection):
+        cursor = connection.cursor
+        connection.cursor = lambda: CountingCursor(cursor(), self)
+
+class CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
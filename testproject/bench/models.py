@@ -0,0 +1,23 @@
+from django.db import models
+
+from testapp.models import TestPerson, TestLocation
+
+class BenchPublisherManager(models.Manager):
+    def get_by_natural_key(self, name):
+        return self.get(name=name)
+
+class BenchPublisher(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+
+    objects = BenchPublisherManager()
+
+    def natural_key(self):
+        return (self.name,)
+
+class BenchBook(models.Model):
+    title = models.CharField(max_length=200)
+    published = models.DateField()
+    pages = models.IntegerField()
+    publisher = models.ForeignKey(BenchPublisher)
+    location = models.ForeignKey(TestLocation)
+    authors = models.ManyToManyField(TestPerson)
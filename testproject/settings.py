@@ -95,6 +95,7 @@ FIXTURE_DIRS = (
 INSTALLED_APPS = (
     'chunkdata',
     'testapp',
+    'bench',
 )
 
 DICTIONARY = "/usr/share/dict/words"
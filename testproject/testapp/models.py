@@ -9,4 +9,42 @@ class TestLocation(models.Model):
     address = models.CharField(blank=True, max_length=100)
     city = models.CharField(max_length=100)
     state = models.CharField(blank=True, max_length=2)
-    postal_code = models.CharField(blank=True, max_length=10)
\ No newline at end of file
+    postal_code = models.CharField(blank=True, max_length=10)
+
+class TestTagManager(models.Manager):
+    def get_by_natural_key(self, name):
+        return self.get(name=name)
+
+class TestTag(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+
+    objects = TestTagManager()
+
+    def natural_key(self):
+        return (self.name,)
+
+class TestEvent(models.Model):
+    title = models.CharField(max_length=100)
+    location = models.ForeignKey(TestLocation)
+    parent = models.ForeignKey('self', blank=True, null=True)
+    attendees = models.ManyToManyField(TestPerson, blank=True)
+    tags = models.ManyToManyField(TestTag, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+class TestBadge(models.Model):
+    label = models.CharField(max_length=100)
+    code = models.CharField(max_length=20, primary_key=True)
+
+class TestActiveManager(models.Manager):
+    def get_query_set(self):
+        return super(TestActiveManager, self).get_query_set().filter(active=True)
+
+class TestMember(models.Model):
+    name = models.CharField(max_length=100)
+    active = models.BooleanField(default=True)
+
+    objects = TestActiveManager()
+
+class TestTeam(models.Model):
+    name = models.CharField(max_length=100)
+    members = models.ManyToManyField(TestMember, blank=True)
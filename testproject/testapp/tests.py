@@ -1,11 +1,40 @@
 from StringIO import StringIO
-import os, json, shutil
+import os, json, multiprocessing, shutil, signal, struct, sys, tempfile, warnings
 
-from django.core import management
-from django.test import TestCase
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
-from models import TestPerson, TestLocation
+from django.core import management, serializers
+from django.core.management.base import CommandError
+from django.conf import settings
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test import TestCase, TransactionTestCase
+from django.utils.unittest import skipUnless
+
+from models import TestPerson, TestLocation, TestTag, TestEvent, TestBadge, TestMember, TestTeam
+from bench.generate import generate, split_rows
+from bench.models import BenchBook
+from bench.management.commands import benchmark
 from chunkdata.management.commands import loadchunks, dumpchunks
+from chunkdata import ledger, prefetch
+from chunkdata.loader import BulkLoader
+from chunkdata.models import LoadedChunk
+from chunkdata.naturalkeys import NaturalKeyCache
+from chunkdata.columnar import decode_column, encode_column, read_objects
+from chunkdata.compression import COMPRESSION_TYPES, open_for_reading
+from chunkdata.constraints import create_indexes, drop_indexes, index_names, secondary_indexes
+from chunkdata.discovery import FixtureIndex
+from chunkdata.metrics import chunk_measured
+from chunkdata.manifest import file_checksum, read_manifest, write_manifest
+from chunkdata.jsonstream import JSONArrayReader, iter_json_lines, parse_parallel
+from chunkdata.keyset import get_page, key_runs, keyset_ordering, missing_keys, page_bounds
+from chunkdata.pipeline import BackgroundWriter, ReadAhead
+from chunkdata.progress import Progress
+from chunkdata.scheduler import chunk_dependencies, run_scheduled, WorkerError
+from chunkdata.workers import WorkerDied, iter_unordered, wait_for, worker_pids
 
 
 class TestLoadChunks(TestCase):
@@ -47,9 +76,445 @@ class TestLoadChunks(TestCase):
             **{'traceback': True}
         )
         
+    def test_bulk_load_matches_loaddata(self):
+        management.call_command('loadchunks', 'chunks')
+        expected = dumpchunks.Command().handle('testapp')
+        TestPerson.objects.all().delete()
+        TestLocation.objects.all().delete()
+
+        management.call_command('loadchunks', 'chunks', bulk=True, batch_size=64)
+        self.assertEqual(dumpchunks.Command().handle('testapp'), expected)
+
+        # Loading again updates the existing rows instead of failing on them.
+        management.call_command('loadchunks', 'chunks', bulk=True)
+        self.assertEqual(dumpchunks.Command().handle('testapp'), expected)
+
+    def test_bulk_load_writes_many_to_many_rows(self):
+        management.call_command('loadchunks', 'test_dump')
+        music = TestTag.objects.create(name='music')
+        art = TestTag.objects.create(name='art')
+        show = TestEvent.objects.create(title='show', location=TestLocation.objects.get(pk=1))
+        show.attendees = [1, 2, 3]
+        show.tags = [music, art]
+        TestEvent.objects.create(title='encore', location=show.location, parent=show).attendees = [3]
+        fixture = dumpchunks.Command().handle('testapp.TestTag', 'testapp.TestEvent', use_natural_keys=True)
+        path = os.path.join(tempfile.mkdtemp(), 'events.000001.json')
+        open(path, 'w').write(fixture)
+        try:
+            TestEvent.objects.all().delete()
+            TestTag.objects.all().delete()
+            loadchunks.bulk_load_chunk(path, {'verbosity': 0, 'batch_size': 1})
+            self.assertEqual(dumpchunks.Command().handle('testapp.TestTag', 'testapp.TestEvent', use_natural_keys=True),
+                             fixture)
+            show = TestEvent.objects.get(title='show')
+            self.assertEqual(sorted(show.attendees.values_list('pk', flat=True)), [1, 2, 3])
+            self.assertEqual(sorted(show.tags.values_list('name', flat=True)), ['art', 'music'])
+
+            show.attendees = [4]
+            loadchunks.bulk_load_chunk(path, {'verbosity': 0})
+            self.assertEqual(sorted(show.attendees.values_list('pk', flat=True)), [1, 2, 3])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    @skipUnless(yaml is not None, 'PyYAML is not installed')
+    def test_bulk_load_yaml_chunk(self):
+        management.call_command('loadchunks', 'test_dump')
+        fixture = dumpchunks.Command().handle('testapp', format='yaml')
+        path = os.path.join(tempfile.mkdtemp(), 'people.000001.yaml')
+        open(path, 'w').write(fixture)
+        try:
+            TestPerson.objects.all().delete()
+            TestLocation.objects.all().delete()
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                loadchunks.bulk_load_chunk(path, {'verbosity': 0})
+            # A plain yaml.load warns on PyYAML 5.1 and later, and fails on 6.
+            self.assertEqual([w for w in caught if 'yaml' in str(w.message).lower()], [])
+            self.assertEqual(dumpchunks.Command().handle('testapp', format='yaml'), fixture)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_bulk_load_writes_many_to_many_rows_with_each_batch(self):
+        location = TestLocation.objects.create(name='hall', city='Springfield')
+        events = [{'model': 'testapp.testevent', 'pk': i,
+                   'fields': {'title': 'event %d' % i, 'location': location.pk, 'updated': '2012-01-01 00:00:00',
+                              'attendees': [1, 2], 'tags': []}}
+                  for i in range(1, 8)]
+        loader = BulkLoader(batch_size=3)
+        pending = []
+        original = loader.flush_m2m
+        def flush_m2m():
+            pending.append(len(loader.m2m))
+            original()
+        loader.flush_m2m = flush_m2m
+        loader.load_data(events)
+        self.assertEqual(pending, [3, 3, 1])
+        self.assertEqual(sorted(TestEvent.attendees.through.objects.values_list('testevent', flat=True)),
+                         sorted(range(1, 8) * 2))
+
+    def test_delta_matches_natural_keys(self):
+        red = TestTag.objects.create(name='red')
+        TestTag.objects.create(name='green')
+        loader = BulkLoader(match_natural_keys=True)
+        loader.load_data([{'model': 'testapp.testtag', 'pk': 99, 'fields': {'name': 'red'}},
+                          {'model': 'testapp.testtag', 'pk': 100, 'fields': {'name': 'blue'}}])
+        self.assertEqual(TestTag.objects.get(name='red').pk, red.pk)
+        self.assertEqual(sorted(TestTag.objects.values_list('name', flat=True)), ['blue', 'green', 'red'])
+        self.assertFalse(TestTag.objects.filter(pk=99).exists())
+
+    def test_delta_matches_more_natural_keys_than_cache_holds(self):
+        tags = dict((tag.name, tag.pk) for tag in [TestTag.objects.create(name='tag %d' % i) for i in range(5)])
+        loader = BulkLoader(match_natural_keys=True, key_cache=NaturalKeyCache(size=2))
+        loader.load_data([{'model': 'testapp.testtag', 'pk': 100 + i, 'fields': {'name': 'tag %d' % i}}
+                          for i in range(5)])
+        self.assertEqual(dict(TestTag.objects.values_list('name', 'pk')), tags)
+
+    def test_natural_keys_resolved_once_per_load(self):
+        tags = [TestTag.objects.create(name='tag %d' % i) for i in range(30)]
+        location = TestLocation.objects.create(name='hall', city='Springfield')
+        for i in range(40):
+            TestEvent.objects.create(title='event %d' % i, location=location).tags = tags[i % 30:i % 30 + 3]
+        fixture = dumpchunks.Command().handle('testapp.TestEvent', use_natural_keys=True)
+        def tag_queries(loader):
+            settings.DEBUG = True
+            connection.queries = []
+            try:
+                loader.load_data(json.loads(fixture))
+                return len([q for q in connection.queries if '"testapp_testtag"' in q['sql']])
+            finally:
+                settings.DEBUG = False
+
+        cache = NaturalKeyCache()
+        TestEvent.objects.all().delete()
+        self.assertEqual(tag_queries(BulkLoader(key_cache=cache)), 1)
+        self.assertEqual(dumpchunks.Command().handle('testapp.TestEvent', use_natural_keys=True), fixture)
+        self.assertEqual(tag_queries(BulkLoader(key_cache=cache)), 0)
+        self.assertEqual(tag_queries(BulkLoader(match_natural_keys=True, key_cache=NaturalKeyCache())), 1)
+
+        cache = NaturalKeyCache(size=2)
+        cache.set(TestTag, ['tag 0'], tags[0].pk)
+        cache.set(TestTag, ['tag 1'], tags[1].pk)
+        self.assertEqual(cache.get(TestTag, ['tag 0']), tags[0].pk)
+        cache.set(TestTag, ['tag 2'], tags[2].pk)
+        self.assertEqual(cache.get(TestTag, ['tag 1']), None)
+        self.assertEqual(cache.lookup(TestTag, ['tag 1'], 'default'), tags[1].pk)
+        self.assertEqual(len(cache), 2)
+
+    def test_resumed_load_skips_committed_chunks(self):
+        TestPerson.objects.all().delete()
+        TestLocation.objects.all().delete()
+        original = loadchunks.load_chunk
+        loaded = []
+        def failing_load_chunk(path, options):
+            if len(loaded) == 3:
+                raise IOError('connection lost')
+            loaded.append(os.path.basename(path))
+            original(path, options)
+        loadchunks.load_chunk = failing_load_chunk
+        try:
+            self.assertRaises(IOError, management.call_command, 'loadchunks', 'chunks', verbosity=0)
+            self.assertEqual(sorted(LoadedChunk.objects.values_list('file', flat=True)), loaded)
+
+            del loaded[:]
+            loadchunks.load_chunk = lambda path, options: (loaded.append(os.path.basename(path)),
+                                                           original(path, options))
+            management.call_command('loadchunks', 'chunks', resume=True, verbosity=0)
+        finally:
+            loadchunks.load_chunk = original
+        self.assertEqual(len(loaded), 18)
+        self.assertEqual(loaded[0], 'chunks.000004.json')
+        self.assertEqual(LoadedChunk.objects.filter(fixture='chunks').count(), 21)
+        self.assertEqual(TestPerson.objects.count(), 1000)
+        self.assertEqual(TestLocation.objects.count(), 1013)
+
+    def test_ledger_records_chunks_without_a_checksum_by_size_and_time(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'people.000001.json')
+            open(path, 'w').write(serializers.serialize('json', TestPerson.objects.all()[:10]))
+            ledger.record_chunk('default', 'people', path)
+            loaded = ledger.loaded_chunks('default', 'people')
+            self.assertTrue(loaded['people.000001.json'].startswith('stat:'))
+            self.assertTrue(ledger.is_loaded(loaded, path))
+            os.utime(path, (0, 0))
+            self.assertFalse(ledger.is_loaded(loaded, path))
+            self.assertTrue(ledger.is_loaded({'people.000001.json': 'sha1:x'}, path, 'sha1:x'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_fixture_index_lists_each_directory_once(self):
+        fixtures_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'fixtures')
+        original = os.listdir
+        listed = []
+        def listdir(path):
+            listed.append(path)
+            return original(path)
+        os.listdir = listdir
+        try:
+            index = FixtureIndex([fixtures_path, os.path.join(fixtures_path, 'missing')])
+            formats = serializers.get_public_serializer_formats()
+            expected = [os.path.join(fixtures_path, 'test_dump.json')]
+            self.assertEqual(index.fixture_files('test_dump', formats, 'default'), expected)
+            self.assertEqual(index.fixture_files('test_dump.json', formats, 'default'), expected)
+            self.assertEqual(index.fixture_files('test_dump.xml', formats, 'default'), None)
+            self.assertEqual(index.fixture_files('chunks.000001', formats, 'default'), None)
+            self.assertEqual(index.fixture_files('chunks/chunks.000001.json', formats, 'default'),
+                             [os.path.join(fixtures_path, 'chunks', 'chunks.000001.json')])
+            self.assertTrue(index.isdir(os.path.join(fixtures_path, 'chunks')))
+            self.assertFalse(index.isdir(os.path.join(fixtures_path, 'test_dump.json')))
+        finally:
+            os.listdir = original
+        self.assertEqual(sorted(listed), sorted(set(listed)))
+
+        management.call_command('loadchunks', 'test_dump', 'chunks', verbosity=0)
+        self.failUnlessEqual(TestPerson.objects.count(), 1000)
+
+    def test_label_in_two_fixture_dirs_loads_like_loaddata(self):
+        root = tempfile.mkdtemp(prefix='chunkdata-test-')
+        original = settings.FIXTURE_DIRS
+        try:
+            dirs = [os.path.join(root, name) for name in ('b', 'a')]
+            for path in dirs:
+                os.mkdir(path)
+                write_fixture(os.path.join(path, 'person.json'), [{'model': 'testapp.testperson', 'pk': 1,
+                    'fields': {'first_name': os.path.basename(path), 'last_name': 'Twice'}}])
+            settings.FIXTURE_DIRS = dirs
+            self.assertEqual(FixtureIndex(dirs + [dirs[0]]).fixture_dirs, dirs)
+            management.call_command('loaddata', 'person', verbosity=0)
+            expected = TestPerson.objects.get(pk=1).first_name
+            TestPerson.objects.all().delete()
+            management.call_command('loadchunks', 'person', verbosity=0)
+            self.assertEqual(TestPerson.objects.get(pk=1).first_name, expected)
+        finally:
+            settings.FIXTURE_DIRS = original
+            shutil.rmtree(root)
+
+    def test_commit_every_groups_chunks(self):
+        original = loadchunks.transaction.commit
+        commits = []
+        loadchunks.transaction.commit = lambda using=None: commits.append(using)
+        try:
+            for options, expected in [({}, 21), ({'commit_every': 5}, 5), ({'single_transaction': True}, 1)]:
+                TestPerson.objects.all().delete()
+                TestLocation.objects.all().delete()
+                del commits[:]
+                management.call_command('loadchunks', 'chunks', bulk=True, verbosity=0, **options)
+                self.assertEqual(len(commits), expected)
+                self.assertEqual(TestPerson.objects.count(), 1000)
+        finally:
+            loadchunks.transaction.commit = original
+        self.assertRaises(CommandError, loadchunks.Command().handle, 'chunks', jobs=2, commit_every=5)
+
+    def test_json_array_read_one_object_at_a_time(self):
+        for name in (u'Ren\xe9e', u'\u5f20\u4f1f', u'Zo\xeb'):
+            TestPerson.objects.create(first_name=name, last_name='Smith')
+        fixture = dumpchunks.Command().handle('testapp.TestPerson', indent=2)
+        expected = json.loads(fixture)
+        self.assertEqual(len(expected), 3)
+        for read_size in (1, 7, 4096):
+            self.assertEqual(list(JSONArrayReader(StringIO(fixture), read_size=read_size)), expected)
+        self.assertEqual(list(JSONArrayReader(StringIO(' [ ] '))), [])
+        self.assertEqual(list(JSONArrayReader(StringIO('[1, 23 ,456]'), read_size=2)), [1, 23, 456])
+        for bad in ('{}', '[1, 2', '[1 2]', '[1] 2', '[{"a": 1}'):
+            self.assertRaises(ValueError, list, JSONArrayReader(StringIO(bad), read_size=3))
+
+    def test_chunk_models_reads_models_without_loading(self):
+        chunk = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'fixtures', 'chunks', 'chunks.000021.json')
+        self.assertEqual(loadchunks.chunk_models(chunk), set([TestLocation]))
+
+
+def record_chunk(chunk, path):
+    f = open(path, 'a')
+    f.write('%s\n' % chunk)
+    f.close()
+
+def kill_worker(chunk, *args):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def unpicklable_result(chunk, *args):
+    return lambda: chunk
+
+def write_fixture(path, objects):
+    f = open(path, 'w')
+    try:
+        json.dump(objects, f)
+    finally:
+        f.close()
+
+def file_database():
+    """Add a database alias for a new SQLite file with every table created, for what the in-memory one can't do."""
+    directory = tempfile.mkdtemp(prefix='chunkdata-test-')
+    alias = os.path.basename(directory)
+    connections.databases[alias] = {'ENGINE': 'django.db.backends.sqlite3',
+                                     'NAME': os.path.join(directory, 'test.sqlite3')}
+    management.call_command('syncdb', database=alias, interactive=False, verbosity=0)
+    return alias
+
+def drop_file_database(alias):
+    connections[alias].close()
+    directory = os.path.dirname(connections.databases[alias]['NAME'])
+    # The test case checks every database it knows of for transactions.
+    del connections.databases[alias]
+    shutil.rmtree(directory)
+
+class TestDeferConstraints(TransactionTestCase):
+
+    def test_constraints_deferred_in_every_chunk(self):
+        alias = file_database()
+        def enforce_foreign_keys(sender, connection, **kwargs):
+            if connection.alias == alias:
+                connection.connection.execute('PRAGMA foreign_keys = ON')
+        connection_created.connect(enforce_foreign_keys)
+        connections[alias].close()
+        chunk_dir = os.path.join(os.path.dirname(__file__), 'fixtures', 'fkorder')
+        os.makedirs(chunk_dir)
+        try:
+            location = {'model': 'testapp.testlocation', 'fields': {'name': 'hall', 'city': 'Springfield'}}
+            write_fixture(os.path.join(chunk_dir, 'fkorder.000001.json'), [dict(location, pk=1)])
+            # The second chunk's event comes before the location it is at.
+            write_fixture(os.path.join(chunk_dir, 'fkorder.000002.json'), [
+                {'model': 'testapp.testevent', 'pk': 1,
+                 'fields': {'title': 'show', 'location': 2, 'updated': '2012-01-01 00:00:00'}},
+                dict(location, pk=2)])
+            for options in ({}, {'bulk': True}, {'bulk': True, 'jobs': 2}):
+                TestEvent.objects.using(alias).all().delete()
+                TestLocation.objects.using(alias).all().delete()
+                LoadedChunk.objects.using(alias).all().delete()
+                if options:
+                    self.assertRaises(CommandError, loadchunks.Command().handle, 'fkorder', database=alias,
+                                      verbosity=0, **options)
+                    LoadedChunk.objects.using(alias).all().delete()
+                loadchunks.Command().handle('fkorder', database=alias, defer_constraints=True, verbosity=0,
+                                            **options)
+                self.assertEqual(TestEvent.objects.using(alias).get().location_id, 2)
+
+            # Ungrouped loads defer inside each chunk's transaction, and
+            # nowhere else.
+            deferred = []
+            original = loadchunks.defer_constraints
+            loadchunks.defer_constraints = lambda connection: (deferred.append(connection.alias),
+                                                               original(connection))
+            try:
+                TestEvent.objects.using(alias).all().delete()
+                TestLocation.objects.using(alias).all().delete()
+                LoadedChunk.objects.using(alias).all().delete()
+                loadchunks.Command().handle('fkorder', database=alias, defer_constraints=True, verbosity=0)
+            finally:
+                loadchunks.defer_constraints = original
+            self.assertEqual(deferred, [alias, alias])
+        finally:
+            connection_created.disconnect(enforce_foreign_keys)
+            shutil.rmtree(chunk_dir)
+            drop_file_database(alias)
+
+class TestSecondaryIndexes(TransactionTestCase):
+
+    def test_drop_and_create_indexes(self):
+        # Dropping and creating indexes commits on SQLite, so this can't run inside a TestCase.
+        before = index_names(connection, TestEvent._meta.db_table)
+        indexes = secondary_indexes(connection, [TestEvent])
+        self.assertEqual(set([table for name, table, sql in indexes]),
+                         set([TestEvent._meta.db_table, 'testapp_testevent_attendees', 'testapp_testevent_tags']))
+        dropped = drop_indexes(connection, [TestEvent])
+        try:
+            self.assertEqual(len(dropped), len(indexes))
+            self.assertEqual(index_names(connection, TestEvent._meta.db_table) & set([d[0] for d in dropped]), set())
+        finally:
+            create_indexes(connection, dropped)
+        self.assertEqual(index_names(connection, TestEvent._meta.db_table), before)
+        self.assertEqual(drop_indexes(connection, [TestPerson]), [])
+
+
+class TestChunkScheduler(TestCase):
+
+    def test_dependencies_follow_relations(self):
+        chunks = [('people', set([TestPerson])), ('events.1', set([TestEvent])), ('places', set([TestLocation])),
+                  ('events.2', set([TestEvent])), ('tags', set([TestTag]))]
+        deps = chunk_dependencies(chunks)
+        self.assertEqual(deps['people'], set())
+        self.assertEqual(deps['tags'], set())
+        self.assertEqual(deps['events.1'], set(['people', 'places', 'tags']))
+        # TestEvent refers to itself, so its chunks load in file order
+        self.assertEqual(deps['events.2'], set(['people', 'places', 'tags', 'events.1']))
+
+    def test_run_scheduled_respects_dependencies(self):
+        deps = {'b': set(['a']), 'c': set(['a', 'b']), 'd': set()}
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            run_scheduled(['c', 'b', 'a', 'd'], deps, record_chunk, (path,), jobs=3)
+            order = open(path).read().split()
+        finally:
+            os.remove(path)
+        self.assertEqual(sorted(order), ['a', 'b', 'c', 'd'])
+        self.assertTrue(order.index('a') < order.index('b') < order.index('c'))
+
+    def test_run_scheduled_breaks_cycles_in_file_order(self):
+        deps = {'a': set(['b']), 'b': set(['a'])}
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            run_scheduled(['a', 'b'], deps, record_chunk, (path,), jobs=2)
+            order = open(path).read().split()
+        finally:
+            os.remove(path)
+        self.assertEqual(order, ['a', 'b'])
+
+    def test_run_scheduled_raises_when_a_worker_dies_or_a_result_cannot_be_returned(self):
+        self.assertRaises(WorkerError, run_scheduled, ['a', 'b'], {}, kill_worker, jobs=2)
+        self.assertRaises(WorkerError, run_scheduled, ['a', 'b'], {}, unpicklable_result, jobs=2)
+
+class TestParallelDump(TransactionTestCase):
+
+    def test_jobs_on_file_database_write_same_files_as_serial_run(self):
+        alias = file_database()
+        chunk_dir = os.path.join(os.path.dirname(__file__), 'fixtures', 'testapp')
+        pools = []
+        original = multiprocessing.Pool
+        def counted_pool(*args, **kwargs):
+            pools.append(args)
+            return original(*args, **kwargs)
+        try:
+            management.call_command('loaddata', 'test_dump', database=alias, verbosity=0)
+            management.call_command('dumpchunks', 'testapp', chunk=300, database=alias)
+            serial = dict((name, open(os.path.join(chunk_dir, name)).read()) for name in os.listdir(chunk_dir))
+            shutil.rmtree(chunk_dir)
+
+            multiprocessing.Pool = counted_pool
+            management.call_command('dumpchunks', 'testapp', chunk=300, database=alias, jobs=3)
+            self.assertEqual(len(pools), 1)
+            parallel = dict((name, open(os.path.join(chunk_dir, name)).read()) for name in os.listdir(chunk_dir))
+            self.assertEqual(serial, parallel)
+        finally:
+            multiprocessing.Pool = original
+            if os.path.exists(chunk_dir):
+                shutil.rmtree(chunk_dir)
+            os.remove(chunk_dir + '.manifest')
+            drop_file_database(alias)
+
+    def test_dead_worker_raises_instead_of_hanging(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertRaises(WorkerDied, list, iter_unordered(pool, kill_worker, [1, 2]))
+        finally:
+            pool.terminate()
+            pool.join()
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertRaises(WorkerDied, wait_for, pool.apply_async(kill_worker, (1,)), pool, worker_pids(pool))
+        finally:
+            pool.terminate()
+            pool.join()
+
 class TestDumpChunks(TestCase):
     fixtures = ['test_dump']
 
+    def tearDown(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        for name in os.listdir(fixtures_path):
+            if name.endswith('.manifest') or name.endswith('.checkpoint'):
+                os.remove(os.path.join(fixtures_path, name))
+
     def test_no_chunks_when_no_chunk_arg(self):
 
         dc = dumpchunks.Command()
@@ -81,3 +546,695 @@ class TestDumpChunks(TestCase):
 
         if chunk_dir_exists:
             shutil.rmtree(chunk_dir)
+
+    def test_stream_writes_fixture_to_stdout(self):
+        out = StringIO()
+        management.call_command('dumpchunks', 'testapp', stream=True, stdout=out)
+        out_list = json.loads(out.getvalue())
+        self.assertEqual(len(out_list), 2013)
+        self.assertEqual(out_list[0]['model'], 'testapp.testperson')
+
+    def test_model_overflowing_chunk_starts_new_file(self):
+
+        management.call_command('dumpchunks', 'testapp', chunk=1500)
+
+        chunk_dir = os.path.join(os.path.dirname(__file__), 'fixtures', 'testapp')
+        try:
+            file_list = sorted(os.listdir(chunk_dir))
+            self.assertEqual(len(file_list), 2)
+            ppl = json.loads(open(os.path.join(chunk_dir, file_list[0])).read())
+            self.assertEqual(len(ppl), 1000)
+            locations = json.loads(open(os.path.join(chunk_dir, file_list[1])).read())
+            self.assertEqual(len(locations), 1013)
+        finally:
+            shutil.rmtree(chunk_dir)
+
+    def test_jobs_write_same_files_as_serial_run(self):
+        chunk_dir = os.path.join(os.path.dirname(__file__), 'fixtures', 'testapp')
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=300)
+            serial = dict((name, open(os.path.join(chunk_dir, name)).read()) for name in os.listdir(chunk_dir))
+            shutil.rmtree(chunk_dir)
+
+            # The in-memory test database can't be shared with worker
+            # processes, so this exercises the serial fallback of the plan.
+            self.assertTrue(dumpchunks.is_process_local(connection))
+            management.call_command('dumpchunks', 'testapp', chunk=300, jobs=3)
+            parallel = dict((name, open(os.path.join(chunk_dir, name)).read()) for name in os.listdir(chunk_dir))
+            self.assertEqual(serial, parallel)
+        finally:
+            shutil.rmtree(chunk_dir)
+
+    def test_pipeline_writes_same_files_as_serial_run(self):
+        chunk_dir = os.path.join(os.path.dirname(__file__), 'fixtures', 'testapp')
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=300, compression='gzip')
+            serial = dict((name, open_for_reading(os.path.join(chunk_dir, name)).read())
+                          for name in os.listdir(chunk_dir))
+            shutil.rmtree(chunk_dir)
+
+            # Objects of the in-memory test database are read in the main
+            # thread, so this exercises the writer thread.
+            management.call_command('dumpchunks', 'testapp', chunk=300, compression='gzip', pipeline=True)
+            pipelined = dict((name, open_for_reading(os.path.join(chunk_dir, name)).read())
+                             for name in os.listdir(chunk_dir))
+            self.assertEqual(serial, pipelined)
+        finally:
+            shutil.rmtree(chunk_dir)
+
+    def test_compressed_chunks_round_trip(self):
+        chunk_dir = os.path.join(os.path.dirname(__file__), 'fixtures', 'testapp')
+        expected = dumpchunks.Command().handle('testapp')
+        for compression, ext in [(name, COMPRESSION_TYPES[name][0]) for name in sorted(COMPRESSION_TYPES)]:
+            try:
+                management.call_command('dumpchunks', 'testapp', chunk=300, compression=compression)
+                file_list = sorted(os.listdir(chunk_dir))
+                self.assertEqual(file_list[0], 'testapp.000001.json.%s' % ext)
+                ppl = json.loads(open_for_reading(os.path.join(chunk_dir, file_list[0])).read())
+                self.assertEqual(len(ppl), 300)
+
+                for bulk in (False, True):
+                    TestPerson.objects.all().delete()
+                    TestLocation.objects.all().delete()
+                    management.call_command('loadchunks', 'testapp', bulk=bulk, verbosity=0)
+                    self.assertEqual(dumpchunks.Command().handle('testapp'), expected)
+            finally:
+                shutil.rmtree(chunk_dir)
+
+    def test_manifest_describes_chunks(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        chunk_dir = os.path.join(fixtures_path, 'testapp')
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=300)
+            manifest = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+            self.assertEqual(manifest['format'], 'json')
+            self.assertEqual(manifest['objects'], 2013)
+            self.assertEqual(manifest['models'][:2], ['testapp.testperson', 'testapp.testlocation'])
+            self.assertEqual([c['file'] for c in manifest['chunks']], sorted(os.listdir(chunk_dir)))
+            last_person_chunk = manifest['chunks'][3]
+            self.assertEqual(last_person_chunk['objects'], 100)
+            self.assertEqual(last_person_chunk['models'],
+                             [{'model': 'testapp.testperson', 'objects': 100, 'pk_range': [901, 1000]}])
+            path = os.path.join(chunk_dir, last_person_chunk['file'])
+            self.assertEqual(last_person_chunk['bytes'], os.path.getsize(path))
+            self.assertEqual(last_person_chunk['checksum'], file_checksum(path))
+        finally:
+            shutil.rmtree(chunk_dir)
+
+    def test_loadchunks_plans_from_manifest(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        chunk_dir = os.path.join(fixtures_path, 'testapp')
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=300)
+            manifest_file = os.path.join(fixtures_path, 'testapp.manifest')
+            manifest = read_manifest(manifest_file)
+            # Only the chunks listed in the manifest are loaded.
+            manifest['chunks'] = manifest['chunks'][4:]
+            write_manifest(manifest_file, manifest)
+            TestPerson.objects.all().delete()
+            TestLocation.objects.all().delete()
+            management.call_command('loadchunks', 'testapp', verify=True, verbosity=0)
+            self.assertEqual(TestPerson.objects.count(), 0)
+            self.assertEqual(TestLocation.objects.count(), 1013)
+
+            open(os.path.join(chunk_dir, manifest['chunks'][0]['file']), 'a').write(' ')
+            self.assertRaises(SystemExit, management.call_command, 'loadchunks', 'testapp', verify=True,
+                              verbosity=0, stderr=StringIO())
+        finally:
+            shutil.rmtree(chunk_dir)
+
+    def test_incremental_dump_writes_new_rows_as_delta(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=300)
+            manifest = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+            self.assertEqual(manifest['watermarks']['testapp.testperson'], {'field': 'id', 'value': 1000})
+
+            for i in range(3):
+                TestPerson.objects.create(first_name='New', last_name='Person %d' % i)
+            management.call_command('dumpchunks', 'testapp', chunk=300, incremental=True)
+            delta = read_manifest(os.path.join(fixtures_path, 'testapp-delta-1.manifest'))
+            self.assertEqual((delta['base'], delta['delta'], delta['objects']), ('testapp', 1, 3))
+            self.assertEqual(delta['chunks'][0]['models'],
+                             [{'model': 'testapp.testperson', 'objects': 3, 'pk_range': [1001, 1003]}])
+            self.assertEqual(delta['watermarks']['testapp.testperson']['value'], 1003)
+
+            self.assertEqual(dumpchunks.Command().handle('testapp', chunk=300, incremental=True),
+                             "No changes since %s\n" % os.path.join(fixtures_path, 'testapp-delta-1.manifest'))
+        finally:
+            shutil.rmtree(os.path.join(fixtures_path, 'testapp'))
+            shutil.rmtree(os.path.join(fixtures_path, 'testapp-delta-1'))
+
+    def test_incremental_dump_by_updated_field(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        location = TestLocation.objects.get(pk=1)
+        show = TestEvent.objects.create(title='show', location=location)
+        TestEvent.objects.create(title='matinee', location=location)
+        try:
+            management.call_command('dumpchunks', 'testapp.TestEvent', filespec='events', updated_fields=['updated'])
+            show.title = 'late show'
+            show.save()
+            management.call_command('dumpchunks', 'testapp.TestEvent', filespec='events', updated_fields=['updated'],
+                                    incremental=True)
+            delta = read_manifest(os.path.join(fixtures_path, 'events-delta-1.manifest'))
+            f = open(os.path.join(fixtures_path, 'events-delta-1', delta['chunks'][0]['file']))
+            try:
+                objects = json.load(f)
+            finally:
+                f.close()
+            self.assertEqual([(o['pk'], o['fields']['title']) for o in objects], [(show.pk, 'late show')])
+        finally:
+            shutil.rmtree(os.path.join(fixtures_path, 'events'))
+            shutil.rmtree(os.path.join(fixtures_path, 'events-delta-1'))
+
+    def test_delta_load_applies_incremental_dump(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=300, deletions=True)
+            added = TestPerson.objects.create(first_name='New', last_name='Person')
+            TestPerson.objects.filter(pk__in=[7, 8, 9, 500]).delete()
+            management.call_command('dumpchunks', 'testapp', chunk=300, incremental=True, deletions=True)
+            delta = read_manifest(os.path.join(fixtures_path, 'testapp-delta-1.manifest'))
+            self.assertEqual(delta['deletions'], {'testapp.testperson': [7, 8, 9, 500]})
+
+            # Load into a copy of the database as it was.
+            for pk in (7, 8, 9, 500):
+                TestPerson.objects.create(pk=pk, first_name='Deleted', last_name='Person')
+            TestPerson.objects.filter(pk=added.pk).update(first_name='Stale')
+            management.call_command('loadchunks', 'testapp-delta-1', delta=True, verbosity=0)
+            self.assertEqual(TestPerson.objects.count(), 997)
+            self.assertEqual(TestPerson.objects.get(pk=added.pk).first_name, 'New')
+            self.assertFalse(TestPerson.objects.filter(pk__in=[7, 8, 9, 500]).exists())
+
+            # A delta can hold deletions and nothing else.
+            TestPerson.objects.filter(pk=added.pk).delete()
+            management.call_command('dumpchunks', 'testapp', chunk=300, incremental=True, deletions=True)
+            delta = read_manifest(os.path.join(fixtures_path, 'testapp-delta-2.manifest'))
+            self.assertEqual((delta['chunks'], delta['deletions']), ([], {'testapp.testperson': [added.pk]}))
+            TestPerson.objects.create(pk=added.pk, first_name='New', last_name='Person')
+            management.call_command('loadchunks', 'testapp-delta-2', delta=True, verbosity=0)
+            self.assertFalse(TestPerson.objects.filter(pk=added.pk).exists())
+        finally:
+            for name in ('testapp', 'testapp-delta-1', 'testapp-delta-2'):
+                if os.path.exists(os.path.join(fixtures_path, name)):
+                    shutil.rmtree(os.path.join(fixtures_path, name))
+
+    def test_resumed_dump_writes_remaining_chunks(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        chunk_dir = os.path.join(fixtures_path, 'testapp')
+        original = dumpchunks.write_chunk
+        written = []
+        def failing_write_chunk(job):
+            if len(written) == 3:
+                raise IOError('disk full')
+            written.append(job[1])
+            return original(job)
+        dumpchunks.write_chunk = failing_write_chunk
+        try:
+            self.assertRaises(CommandError, dumpchunks.Command().handle, 'testapp', chunk=300)
+            self.assertFalse(os.path.exists(os.path.join(fixtures_path, 'testapp.manifest')))
+            self.assertTrue(os.path.exists(os.path.join(fixtures_path, 'testapp.checkpoint')))
+
+            del written[:]
+            dumpchunks.write_chunk = lambda job: (written.append(job[1]), original(job))[1]
+            management.call_command('dumpchunks', 'testapp', chunk=300, resume=True, verbosity=0)
+            self.assertEqual(written, [4, 5, 6, 7, 8])
+            self.assertFalse(os.path.exists(os.path.join(fixtures_path, 'testapp.checkpoint')))
+            resumed = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+
+            dumpchunks.write_chunk = original
+            management.call_command('dumpchunks', 'testapp', chunk=300)
+            manifest = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+            self.assertEqual(resumed['objects'], 2013)
+            self.assertEqual([c['checksum'] for c in resumed['chunks']], [c['checksum'] for c in manifest['chunks']])
+        finally:
+            dumpchunks.write_chunk = original
+            shutil.rmtree(chunk_dir)
+
+    def test_resume_with_checkpoint_cut_short_starts_again(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        chunk_dir = os.path.join(fixtures_path, 'testapp')
+        f = open(os.path.join(fixtures_path, 'testapp.checkpoint'), 'wb')
+        f.write('{"filters": {}, "manifest"')
+        f.close()
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=300, resume=True, verbosity=0)
+            self.assertFalse(os.path.exists(os.path.join(fixtures_path, 'testapp.checkpoint')))
+            self.assertEqual(read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))['objects'], 2013)
+        finally:
+            shutil.rmtree(chunk_dir)
+
+    def test_max_bytes_splits_chunk_files_by_size(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        chunk_dir = os.path.join(fixtures_path, 'testapp')
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=500, max_bytes='20K')
+            manifest = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+            names = [c['file'] for c in manifest['chunks']]
+            self.assertEqual(names, sorted(os.listdir(chunk_dir)))
+            self.assertEqual(names[:2], ['testapp.000001.0001.json', 'testapp.000001.0002.json'])
+            self.assertEqual(sum([c['objects'] for c in manifest['chunks']]), 2013)
+            for c in manifest['chunks']:
+                self.assertTrue(c['objects'] <= 500)
+                # A file only goes past the limit by the last object written to it.
+                self.assertTrue(c['bytes'] < 20 * 1024 + 200)
+
+            TestPerson.objects.all().delete()
+            TestLocation.objects.all().delete()
+            management.call_command('loadchunks', 'testapp', verbosity=0)
+            self.assertEqual(TestPerson.objects.count(), 1000)
+            self.assertEqual(TestLocation.objects.count(), 1013)
+        finally:
+            shutil.rmtree(chunk_dir)
+        self.assertRaises(CommandError, dumpchunks.Command().handle, 'testapp', chunk=500, max_bytes='20K',
+                          format='columnar')
+        self.assertFalse(os.path.exists(chunk_dir))
+
+    def test_chunk_for_overrides_model_chunk_size(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=300, chunk_for=['testapp.TestLocation=600'])
+            manifest = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+            self.assertEqual([c['objects'] for c in manifest['chunks']], [300, 300, 300, 100, 600, 413])
+        finally:
+            shutil.rmtree(os.path.join(fixtures_path, 'testapp'))
+
+    def test_target_bytes_sizes_chunks_per_model(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        person_bytes = dumpchunks.sample_row_bytes(TestPerson.objects.all(), 'json')
+        location_bytes = dumpchunks.sample_row_bytes(TestLocation.objects.all(), 'json')
+        self.assertTrue(location_bytes > person_bytes)
+        try:
+            management.call_command('dumpchunks', 'testapp', target_bytes='16K')
+            manifest = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+            sizes = {}
+            for c in manifest['chunks']:
+                sizes.setdefault(c['models'][0]['model'], c['objects'])
+            self.assertEqual(sizes['testapp.testperson'], 16 * 1024 // person_bytes)
+            self.assertEqual(sizes['testapp.testlocation'], 16 * 1024 // location_bytes)
+            for c in manifest['chunks']:
+                if c['objects'] == sizes[c['models'][0]['model']]:
+                    self.assertTrue(12 * 1024 < c['bytes'] < 20 * 1024)
+        finally:
+            shutil.rmtree(os.path.join(fixtures_path, 'testapp'))
+
+    def test_adaptive_chunk_size_meets_every_target(self):
+        self.assertEqual(dumpchunks.adaptive_chunk_size(100, target_bytes=10000), 100)
+        self.assertEqual(dumpchunks.adaptive_chunk_size(100, target_bytes=10000, target_seconds=0.05,
+                                                        load_rate=1000), 50)
+        self.assertEqual(dumpchunks.adaptive_chunk_size(100, target_bytes=10000, chunk=20), 20)
+        self.assertEqual(dumpchunks.adaptive_chunk_size(50000, target_bytes=10000), 1)
+
+    def test_fast_dump_matches_serializer_output(self):
+        music = TestTag.objects.create(name='music')
+        art = TestTag.objects.create(name='art')
+        show = TestEvent.objects.create(title='show', location=TestLocation.objects.get(pk=1))
+        show.attendees = [1, 2, 3]
+        show.tags = [music, art]
+        TestEvent.objects.create(title='encore', location=show.location, parent=show).attendees = [3]
+        variants = [{}, {'use_natural_keys': True}, {'indent': 2}]
+        if 'yaml' in serializers.get_public_serializer_formats():
+            variants.append({'format': 'yaml'})
+        for options in variants:
+            self.assertEqual(dumpchunks.Command().handle('testapp', fast=True, **options),
+                             dumpchunks.Command().handle('testapp', **options))
+
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=300, use_natural_keys=True)
+            expected = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+            management.call_command('dumpchunks', 'testapp', chunk=300, use_natural_keys=True, fast=True)
+            manifest = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+            self.assertEqual([c['checksum'] for c in manifest['chunks']], [c['checksum'] for c in expected['chunks']])
+        finally:
+            shutil.rmtree(os.path.join(fixtures_path, 'testapp'))
+
+    def test_fast_dump_leaves_out_members_hidden_by_the_default_manager(self):
+        team = TestTeam.objects.create(name='team')
+        team.members = [TestMember.objects.create(name='ann'), TestMember.objects.create(name='bob'),
+                        TestMember.objects.create(name='cat', active=False)]
+        expected = dumpchunks.Command().handle('testapp.TestTeam')
+        self.assertEqual(dumpchunks.Command().handle('testapp.TestTeam', fast=True), expected)
+        self.assertEqual(json.loads(expected)[0]['fields']['members'], [1, 2])
+
+    def test_json_layout_matches_serializer(self):
+        people = TestPerson.objects.order_by('pk')
+        chunk_dir = os.path.join(os.path.dirname(__file__), 'fixtures', 'people')
+        for indent in (None, 2):
+            expected = serializers.serialize('json', people, indent=indent)
+            for fast in (False, True):
+                self.assertEqual(dumpchunks.Command().handle('testapp.TestPerson', indent=indent, fast=fast), expected)
+                try:
+                    management.call_command('dumpchunks', 'testapp.TestPerson', filespec='people', chunk=400,
+                                            indent=indent, fast=fast)
+                    for number, start in ((1, 0), (2, 400), (3, 800)):
+                        path = os.path.join(chunk_dir, 'people.%06d.json' % number)
+                        self.assertEqual(open(path).read(),
+                                         serializers.serialize('json', people[start:start + 400], indent=indent))
+                finally:
+                    shutil.rmtree(chunk_dir)
+
+    def test_empty_model_dumps_like_serializer(self):
+        formats = ['json']
+        if 'yaml' in serializers.get_public_serializer_formats():
+            formats.append('yaml')
+        for format in formats:
+            expected = serializers.serialize(format, TestTag.objects.all())
+            self.assertEqual(dumpchunks.Command().handle('testapp.TestTag', format=format), expected)
+            self.assertEqual(dumpchunks.Command().handle('testapp.TestTag', format=format, fast=True), expected)
+
+    def test_many_to_many_prefetched_per_queryset(self):
+        location = TestLocation.objects.get(pk=1)
+        tags = [TestTag.objects.create(name=name) for name in ('music', 'art', 'film')]
+        def add_events(n):
+            for i in range(n):
+                event = TestEvent.objects.create(title='event %d' % i, location=location)
+                event.attendees = [1, 2, 3][:i % 4]
+                event.tags = tags[i % 3:]
+        def count_queries(format):
+            settings.DEBUG = True
+            connection.queries = []
+            try:
+                output = dumpchunks.Command().handle('testapp.TestEvent', format=format, use_natural_keys=True)
+                # Foreign keys are still fetched per object for their natural keys.
+                return output, len([q for q in connection.queries
+                                    if 'testevent_attendees' in q['sql'] or 'testevent_tags' in q['sql']])
+            finally:
+                settings.DEBUG = False
+
+        add_events(5)
+        output, per_batch = count_queries('json')
+        self.assertEqual(json.loads(output),
+                         json.loads(serializers.serialize('json', TestEvent.objects.all(), use_natural_keys=True)))
+        add_events(20)
+        self.assertEqual(count_queries('json')[1], per_batch)
+        output, queries = count_queries('xml')
+        self.assertEqual(output, serializers.serialize('xml', TestEvent.objects.all(), use_natural_keys=True))
+        self.assertEqual(queries, per_batch)
+
+        # The relations of a whole table are read a batch at a time, not all at once.
+        original = prefetch.BATCH_SIZE
+        prefetch.BATCH_SIZE = 10
+        try:
+            output, queries = count_queries('json')
+        finally:
+            prefetch.BATCH_SIZE = original
+        self.assertEqual(queries, 3 * per_batch)
+        self.assertEqual(json.loads(output),
+                         json.loads(serializers.serialize('json', TestEvent.objects.all(), use_natural_keys=True)))
+
+    def test_jsonl_chunks_split_across_parse_workers(self):
+        lines = dumpchunks.Command().handle('testapp', format='jsonl').splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         json.loads(dumpchunks.Command().handle('testapp')))
+        self.assertEqual(dumpchunks.Command().handle('testapp', format='jsonl', fast=True).splitlines(), lines)
+
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        chunk_dir = os.path.join(fixtures_path, 'testapp')
+        try:
+            management.call_command('dumpchunks', 'testapp', format='jsonl', chunk=5000)
+            path = os.path.join(chunk_dir, 'testapp.000001.jsonl')
+            self.assertEqual(open(path).read().splitlines(), lines)
+            self.assertEqual(list(parse_parallel(path, 3, block_size=4096)), list(iter_json_lines(open(path))))
+
+            TestPerson.objects.all().delete()
+            TestLocation.objects.all().delete()
+            management.call_command('loadchunks', 'testapp', bulk=True, jobs=2, verbosity=0)
+            self.assertEqual(TestPerson.objects.count(), 1000)
+            self.assertEqual(TestLocation.objects.count(), 1013)
+        finally:
+            shutil.rmtree(chunk_dir)
+
+    def test_columnar_round_trips_with_json(self):
+        location = TestLocation.objects.get(pk=1)
+        tags = [TestTag.objects.create(name=name) for name in (u'm\xfcsic', 'art')]
+        first = TestEvent.objects.create(title='first', location=location)
+        second = TestEvent.objects.create(title=u'caf\xe9', location=location, parent=first)
+        second.tags = tags
+        second.attendees = [1, 2]
+        before = json.loads(dumpchunks.Command().handle('testapp'))
+        for natural in (False, True):
+            expected = json.loads(dumpchunks.Command().handle('testapp', use_natural_keys=natural))
+            for fast in (False, True):
+                data = dumpchunks.Command().handle('testapp', format='columnar', use_natural_keys=natural, fast=fast)
+                self.assertEqual(list(read_objects(StringIO(data))), expected)
+        self.assertTrue(len(data) < len(dumpchunks.Command().handle('testapp')))
+
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        chunk_dir = os.path.join(fixtures_path, 'testapp')
+        try:
+            management.call_command('dumpchunks', 'testapp', format='columnar', chunk=500)
+            for options in ({}, {'bulk': True}):
+                TestEvent.objects.all().delete()
+                TestPerson.objects.all().delete()
+                TestLocation.objects.all().delete()
+                TestTag.objects.all().delete()
+                management.call_command('loadchunks', 'testapp', verbosity=0, **options)
+                self.assertEqual(json.loads(dumpchunks.Command().handle('testapp')), before)
+        finally:
+            shutil.rmtree(chunk_dir)
+
+    def test_columnar_text_lengths_are_utf8_bytes(self):
+        for values in ([u'a', u'\U0001f600x', None, u'\xe9'], [{'name': u'\U0001f600'}, None, [u'\xe9', 1]]):
+            kind, nulls, data = encode_column(values)
+            if kind == 't':
+                self.assertEqual(struct.unpack('<3I', data[:12]), (1, 5, 2))
+            self.assertEqual(decode_column(kind, len(values), nulls, data), values)
+
+    def test_csv_chunks_round_trip(self):
+        location = TestLocation.objects.get(pk=1)
+        tags = [TestTag.objects.create(name=name) for name in (u'm\xfcsic', 'a "quoted", tag', '')]
+        first = TestEvent.objects.create(title='two\nlines', location=location)
+        second = TestEvent.objects.create(title=u'caf\xe9', location=location, parent=first)
+        second.tags = tags
+        second.attendees = [1, 2]
+        before = json.loads(dumpchunks.Command().handle('testapp'))
+
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        chunk_dir = os.path.join(fixtures_path, 'testapp')
+        try:
+            management.call_command('dumpchunks', 'testapp', format='csv', chunk=500)
+            manifest = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+            files = [chunk['file'] for chunk in manifest['chunks']]
+            self.assertTrue('testapp.000001.testapp.testperson.csv' in files)
+            tags_file = [chunk for chunk in manifest['chunks'] if chunk['file'].endswith('.testevent_tags.csv')][0]
+            self.assertEqual(tags_file['models'][0]['model'], 'testapp.testevent_tags')
+            self.assertEqual(tags_file['objects'], 3)
+            # Only the events with tags have rows in the through table.
+            self.assertEqual(len([f for f in files if f.endswith('.testevent_attendees.csv')]), 1)
+
+            TestEvent.objects.all().delete()
+            TestPerson.objects.all().delete()
+            TestLocation.objects.all().delete()
+            TestTag.objects.all().delete()
+            management.call_command('loadchunks', 'testapp', verbosity=0)
+            self.assertEqual(json.loads(dumpchunks.Command().handle('testapp')), before)
+            self.assertEqual(TestEvent.objects.get(pk=first.pk).parent, None)
+            self.assertRaises(CommandError, loadchunks.Command().handle, 'testapp', delta=True, verbosity=0)
+        finally:
+            shutil.rmtree(chunk_dir)
+
+    def test_csv_pk_range_when_pk_is_not_the_first_column(self):
+        TestBadge.objects.create(code='A1', label='zeta')
+        TestBadge.objects.create(code='B2', label='alpha')
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        chunk_dir = os.path.join(fixtures_path, 'badges')
+        try:
+            management.call_command('dumpchunks', 'testapp.TestBadge', filespec='badges', format='csv', chunk=500)
+            manifest = read_manifest(os.path.join(fixtures_path, 'badges.manifest'))
+            self.assertEqual([chunk['models'] for chunk in manifest['chunks']],
+                             [[{'model': 'testapp.testbadge', 'objects': 2, 'pk_range': ['A1', 'B2']}]])
+        finally:
+            shutil.rmtree(chunk_dir)
+
+    def test_metrics_file_reports_every_chunk(self):
+        fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+        chunk_dir = os.path.join(fixtures_path, 'testapp')
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        measured = []
+        def receiver(sender, metrics, **kwargs):
+            measured.append((sender, metrics))
+        chunk_measured.connect(receiver)
+        try:
+            management.call_command('dumpchunks', 'testapp', chunk=500, metrics_file=path)
+            report = json.load(open(path))
+            self.assertEqual(report['command'], 'dumpchunks')
+            self.assertEqual(report['objects'], 2013)
+            self.assertEqual(sorted([c['number'] for c in report['chunks']]), [1, 2, 3, 4, 5])
+            self.assertEqual([m for s, m in measured], report['chunks'])
+            self.assertEqual(measured[0][0], dumpchunks.Command)
+            self.assertEqual(report['models']['testapp.testperson']['objects'], 1000)
+            manifest = read_manifest(os.path.join(fixtures_path, 'testapp.manifest'))
+            self.assertEqual(report['totals']['file_bytes'], sum([c['bytes'] for c in manifest['chunks']]))
+            for chunk in report['chunks']:
+                self.assertEqual(chunk['queries'], 1)
+                self.assertTrue(chunk['seconds'] >= chunk['query_seconds'] + chunk['write_seconds'])
+
+            del measured[:]
+            management.call_command('loadchunks', 'testapp', bulk=True, metrics_file=path, verbosity=0)
+            report = json.load(open(path))
+            self.assertEqual(report['command'], 'loadchunks')
+            self.assertEqual(len(measured), 5)
+            self.assertEqual(report['models']['testapp.testlocation']['objects'], 1013)
+            self.assertTrue(report['totals']['queries'] > 0)
+            self.assertEqual(sorted(report['chunks'][0]), ['bytes', 'file', 'file_bytes', 'models', 'objects',
+                                                           'parse_seconds', 'queries', 'query_seconds',
+                                                           'read_seconds', 'seconds'])
+        finally:
+            chunk_measured.disconnect(receiver)
+            os.remove(path)
+            shutil.rmtree(chunk_dir)
+
+class TestKeysetPages(TestCase):
+    fixtures = ['test_dump']
+
+    def assertPagesCoverQueryset(self, qs, size):
+        # Pages are read back last first, as dumpchunks' workers may read them.
+        bounds = list(page_bounds(qs, size))
+        pages = [list(get_page(qs, page).values_list('pk', flat=True)) for page in reversed(bounds)][::-1]
+        for page in pages:
+            self.assertTrue(0 < len(page) <= size)
+        pks = [pk for page in pages for pk in page]
+        self.assertEqual(sorted(pks), sorted(qs.values_list('pk', flat=True)))
+        return pages
+
+    def test_pages_are_pk_ranges(self):
+        pages = self.assertPagesCoverQueryset(TestPerson.objects.all(), 300)
+        self.assertEqual([len(page) for page in pages], [300, 300, 300, 100])
+        self.assertEqual(pages[1][0], pages[0][-1] + 1)
+
+    def test_exact_multiple_has_no_empty_page(self):
+        pages = self.assertPagesCoverQueryset(TestPerson.objects.all(), 250)
+        self.assertEqual(len(pages), 4)
+
+    def test_composite_ordering(self):
+        meta = TestPerson._meta
+        original = meta.ordering
+        meta.ordering = ['last_name', '-first_name']
+        try:
+            self.assertEqual([name for name, field, desc in keyset_ordering(TestPerson)],
+                             ['last_name', 'first_name', 'pk'])
+            pages = self.assertPagesCoverQueryset(TestPerson.objects.all(), 128)
+            ordered = list(TestPerson.objects.order_by('last_name', '-first_name', 'pk').values_list('pk', flat=True))
+            self.assertEqual([pk for page in pages for pk in page], ordered)
+        finally:
+            meta.ordering = original
+
+    def test_unusable_ordering_falls_back_to_pk(self):
+        meta = TestLocation._meta
+        original = meta.ordering
+        meta.ordering = ['?']
+        try:
+            self.assertEqual([name for name, field, desc in keyset_ordering(TestLocation)], ['pk'])
+            self.assertPagesCoverQueryset(TestLocation.objects.all(), 300)
+        finally:
+            meta.ordering = original
+
+    def test_sliced_queryset_uses_offsets(self):
+        self.assertPagesCoverQueryset(TestLocation.objects.all()[:700], 300)
+
+    def test_key_runs_and_missing_keys(self):
+        TestLocation.objects.filter(pk__in=[5, 6, 300]).delete()
+        runs = key_runs(TestLocation.objects.all())
+        self.assertEqual(runs[:3], [[1, 4], [7, 299], [301, runs[2][1]]])
+        self.assertEqual(missing_keys([[1, 10], [298, 305], [2000, 2001]], runs), [5, 6, 300, 2000, 2001])
+        self.assertEqual(missing_keys(runs, runs), [])
+
+
+class TestProgress(TestCase):
+
+    def test_reports_are_rate_limited(self):
+        now = [0]
+        stream = StringIO()
+        progress = Progress('dump', 1000, done=100, stream=stream, interval=10, clock=lambda: now[0])
+        now[0] = 5
+        progress.add(100)
+        self.assertEqual(stream.getvalue(), '')
+        now[0] = 10
+        progress.add(100)
+        now[0] = 12
+        progress.add(100)
+        self.assertEqual(stream.getvalue(), 'dump: 300/1000 objects (30.0%), 20 objects/s, ETA 0:00:35\n')
+        now[0] = 20
+        progress.finish()
+        self.assertEqual(stream.getvalue().splitlines()[-1], 'dump: 400 objects in 0:00:20, 15 objects/s')
+
+class TestPipeline(TestCase):
+
+    def test_read_ahead_yields_each_iterable_in_turn(self):
+        reader = ReadAhead([xrange(5), [], xrange(5, 12)], batch_size=2, depth=1)
+        try:
+            self.assertEqual(list(reader.chunk()), range(5))
+            self.assertEqual(list(reader.chunk()), [])
+            self.assertEqual(list(reader.chunk()), range(5, 12))
+        finally:
+            reader.close()
+
+    def test_read_ahead_raises_failures_and_stops_early(self):
+        def failing():
+            yield 1
+            raise ValueError('bad row')
+        reader = ReadAhead([failing()])
+        self.assertRaises(ValueError, list, reader.chunk())
+        reader.close()
+        reader = ReadAhead([xrange(100000)], batch_size=10, depth=1)
+        self.assertEqual(reader.chunk().next(), 0)
+        reader.close()
+        self.assertFalse(reader.thread.isAlive())
+
+    def test_background_writer_writes_in_order_and_raises_failures(self):
+        stream = StringIO()
+        stream.close = lambda: None
+        writer = BackgroundWriter(stream, block_size=4, depth=1)
+        for data in ['ab', 'cde', 'f', 'ghij', 'k']:
+            writer.write(data)
+        writer.close()
+        self.assertEqual(stream.getvalue(), 'abcdefghijk')
+
+        class Full(object):
+            def write(self, data):
+                raise IOError('disk full')
+        def write_all(writer):
+            for i in range(10):
+                writer.write('x')
+            writer.close()
+        self.assertRaises(IOError, write_all, BackgroundWriter(Full(), block_size=1, depth=1))
+
+class TestBenchmarkData(TestCase):
+
+    def test_benchmark_writes_only_json_lines(self):
+        # Measured steps run in child processes, so stdout is captured at the
+        # file descriptor.
+        captured = tempfile.TemporaryFile()
+        aliases = set(connections.databases)
+        sys.stdout.flush()
+        saved = os.dup(1)
+        os.dup2(captured.fileno(), 1)
+        try:
+            management.call_command('benchmark', rows=[200], chunks=[100], formats=['json'], modes=['bulk'],
+                                    verbosity=0)
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+            # The test case checks every database it knows of for transactions.
+            for alias in set(connections.databases) - aliases:
+                connections[alias].close()
+                del connections.databases[alias]
+        captured.seek(0)
+        results = [json.loads(line) for line in captured.read().splitlines()]
+        self.assertEqual([result['step'] for result in results], ['generate', 'dump', 'load'])
+
+    def test_measure_raises_when_the_step_dies(self):
+        self.assertRaisesRegexp(CommandError, 'exit code -9', benchmark.measure, kill_worker, (None,))
+
+    def test_generate_fills_every_model(self):
+        counts = generate('default', 500)
+        self.assertEqual(sum(counts.values()), 500)
+        self.assertEqual(TestPerson.objects.count(), counts['testapp.TestPerson'])
+        self.assertEqual(BenchBook.objects.count(), counts['bench.BenchBook'])
+        self.assertEqual(BenchBook.authors.through.objects.count(), counts['bench.BenchBook'] * 2)
+        book = BenchBook.objects.get(pk=1)
+        self.assertEqual(book.authors.count(), 2)
+        self.assertEqual([count for model, count in split_rows(1)], [1, 1, 1, 0])